@@ -12,6 +12,7 @@ tests_require = [
     "factory-boy",
     "flake8",
     "coverage",
+    "numpy",
 ]
 
 setup(
@@ -53,5 +54,5 @@ setup(
         "pillow",
     ],
     python_requires=">=3.6",
-    extras_require={"dev": tests_require},
+    extras_require={"dev": tests_require, "brotli": ["brotli"], "jenks": ["numpy"]},
 )
@@ -9,3 +9,7 @@ class TerraLayerConfig(PermissionRegistrationMixin, AppConfig):
         ("DataLayer", "can_manage_layers", "Can manage layers"),
         ("DataSource", "can_manage_sources", "Can manage sources"),
     )
+
+    def ready(self):
+        super().ready()
+        import terra_layer.signals  # NOQA
@@ -0,0 +1,161 @@
+from django_geosource.models import Field, Source
+
+from .models import Layer, LayerGroup, Scene
+from .serializers import LayerDetailSerializer
+
+
+def get_dump_queryset():
+    """Layers with everything their dump needs fetched in a constant number of queries"""
+    return Layer.objects.select_related("group__view").prefetch_related(
+        "fields_filters", "extra_styles"
+    )
+
+
+def dump_layers(layers):
+    """
+    Serialize layers with ids of related objects replaced by their slug, name
+    or label, so they can be loaded in another instance.
+    Related objects are fetched with one query per model, whatever the number
+    of layers.
+    """
+    serialized_layers = [LayerDetailSerializer(layer).data for layer in layers]
+
+    source_ids, field_ids, group_ids, scene_ids = set(), set(), set(), set()
+    for serialized in serialized_layers:
+        source_ids.add(serialized["source"])
+        source_ids.update(cs["source"] for cs in serialized["extra_styles"])
+        field_ids.update(field["field"] for field in serialized["fields"])
+        field_ids.add(serialized["main_field"])
+        group_ids.add(serialized["group"])
+        scene_ids.add(serialized["view"])
+
+    source_slugs = dict(
+        Source.objects.filter(pk__in=source_ids).values_list("pk", "slug")
+    )
+    field_names = dict(Field.objects.filter(pk__in=field_ids).values_list("pk", "name"))
+    fk_names = {
+        "group": dict(
+            LayerGroup.objects.filter(pk__in=group_ids).values_list("pk", "label")
+        ),
+        "view": dict(Scene.objects.filter(pk__in=scene_ids).values_list("pk", "slug")),
+        "source": source_slugs,
+        "main_field": field_names,
+    }
+
+    for serialized in serialized_layers:
+        serialized.pop("id")
+
+        # Clean custom_style id
+        for cs in serialized["extra_styles"]:
+            cs.pop("id")
+            cs["source"] = source_slugs[cs["source"]]
+
+        for field in serialized["fields"]:
+            field.pop("id")
+            field.pop("sourceFieldId")
+            field["field"] = field_names[field["field"]]
+
+        for field, names in fk_names.items():
+            if serialized.get(field):
+                serialized[field] = names[serialized[field]]
+
+    return serialized_layers
+
+
+class LayerLoadMaps:
+    """
+    Resolve slugs and names of layer dumps to ids, from objects fetched once
+    for all the dumps.
+    """
+
+    def __init__(self, layers_data):
+        # Dumps missing keys are reported when resolved, one by one
+        source_slugs = set()
+        for data in layers_data:
+            source_slugs.add(data.get("source"))
+            source_slugs.update(
+                cs.get("source")
+                for cs in data.get("extra_styles", [])
+                if isinstance(cs, dict)
+            )
+
+        self.sources = dict(
+            Source.objects.filter(slug__in=source_slugs).values_list("slug", "pk")
+        )
+        self.fields = {
+            (source_id, name): pk
+            for source_id, name, pk in Field.objects.filter(
+                source__slug__in=source_slugs
+            ).values_list("source_id", "name", "pk")
+        }
+        self.scenes = dict(
+            Scene.objects.filter(
+                slug__in=[data["view"] for data in layers_data if data.get("view")]
+            ).values_list("slug", "pk")
+        )
+
+    def get_source(self, slug):
+        try:
+            return self.sources[slug]
+        except KeyError:
+            raise ValueError(f"Source {slug} does not exist")
+
+    def get_field(self, source_id, name):
+        try:
+            return self.fields[(source_id, name)]
+        except KeyError:
+            raise ValueError(f"Field {name} does not exist")
+
+    def get_scene(self, slug):
+        try:
+            return self.scenes[slug]
+        except KeyError:
+            raise ValueError(f"Scene {slug} does not exist")
+
+    def resolve(self, data):
+        """Replace slugs and names of a layer dump by ids, in place"""
+        data["source"] = self.get_source(data["source"])
+
+        if data.get("view"):
+            data["view"] = self.get_scene(data["view"])
+
+        for cs in data.get("extra_styles", []):
+            cs["source"] = self.get_source(cs["source"])
+
+        if data.get("main_field"):
+            data["main_field"] = self.get_field(data["source"], data["main_field"])
+
+        for field in data.get("fields", []):
+            field["field"] = self.get_field(data["source"], field["field"])
+
+        return data
+
+
+def map_tree_layers(tree, layers):
+    """
+    Return a copy of a scene tree with layers replaced according to the
+    `layers` mapping, layers missing from it are dropped.
+    """
+    mapped_tree = []
+    for node in tree:
+        if "geolayer" in node:
+            if node["geolayer"] in layers:
+                mapped_tree.append({**node, "geolayer": layers[node["geolayer"]]})
+        elif "children" in node:
+            mapped_tree.append(
+                {**node, "children": map_tree_layers(node["children"], layers)}
+            )
+        else:
+            mapped_tree.append(dict(node))
+    return mapped_tree
+
+
+def get_tree_layer_ids(tree):
+    """Return ids of layers of a scene tree"""
+    layer_ids = []
+    for node in tree:
+        if "geolayer" in node:
+            layer_ids.append(node["geolayer"])
+        elif "children" in node:
+            layer_ids += get_tree_layer_ids(node["children"])
+    return layer_ids
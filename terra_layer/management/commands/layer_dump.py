@@ -1,7 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
-from terra_layer.models import Layer, LayerGroup, Scene
-from terra_layer.serializers import LayerDetailSerializer
-from django_geosource.models import Field, Source
+from terra_layer.dump import dump_layers, get_dump_queryset
+from terra_layer.models import Layer
 import json
 
 
@@ -12,42 +11,61 @@ class Command(BaseCommand):
         parser.add_argument(
             "-pk", type=int, action="store", help="Pk of the layer to export"
         )
+        parser.add_argument(
+            "--ndjson",
+            action="store_true",
+            help="dump every layer, or the filtered ones, one json per line",
+        )
+        parser.add_argument(
+            "--source",
+            action="append",
+            dest="sources",
+            help="name of a source whose layers are dumped, with --ndjson",
+        )
+        parser.add_argument(
+            "--scene",
+            action="append",
+            dest="scenes",
+            help="slug of a scene whose layers are dumped, with --ndjson",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=200,
+            help="number of layers fetched at once, with --ndjson",
+        )
 
     def handle(self, *args, **options):
+        if options["ndjson"]:
+            self.dump_ndjson(options)
+            return
+
         try:
-            self.layer = Layer.objects.get(pk=options.get("pk"))
+            self.layer = get_dump_queryset().get(pk=options.get("pk"))
         except Layer.DoesNotExist:
             raise CommandError("Layer does not exist")
 
-        serialized = LayerDetailSerializer(self.layer).data
-        self.clean_ids(serialized)
+        serialized = dump_layers([self.layer])[0]
 
         self.stdout.write(json.dumps(serialized))
 
-    def clean_ids(self, serialized):
-        excluded_fields = ("id",)
-        for field in excluded_fields:
-            serialized.pop(field)
-
-        # Clean custom_style id
-        for cs in serialized.get("extra_styles", []):
-            cs.pop("id")
-            cs["source"] = Source.objects.get(pk=cs["source"]).slug
-
-        for field in serialized.get("fields", []):
-            field.pop("id")
-            field.pop("sourceFieldId")
-            field["field"] = Field.objects.get(pk=field["field"]).name
-
-        fk_fields = (
-            (LayerGroup, "group", "label"),
-            (Scene, "view", "slug"),
-            (Source, "source", "slug"),
-            (Field, "main_field", "name"),
-        )
+    def dump_ndjson(self, options):
+        layers = get_dump_queryset().order_by("pk")
+        if options.get("pk"):
+            layers = layers.filter(pk=options["pk"])
+        if options.get("sources"):
+            layers = layers.filter(source__name__in=options["sources"])
+        if options.get("scenes"):
+            layers = layers.filter(group__view__slug__in=options["scenes"])
+
+        # Layers are fetched by chunks of pks, so memory doesn't grow with
+        # their number
+        last_pk = 0
+        while True:
+            chunk = list(layers.filter(pk__gt=last_pk)[: options["chunk_size"]])
+            if not chunk:
+                break
 
-        for klass, field, sfield in fk_fields:
-            if serialized.get(field):
-                serialized[field] = getattr(
-                    klass.objects.get(pk=serialized.get(field)), sfield
-                )
+            for serialized in dump_layers(chunk):
+                self.stdout.write(json.dumps(serialized))
+            last_pk = chunk[-1].pk
@@ -1,8 +1,12 @@
 import argparse
+from itertools import islice
 from django.core.management.base import BaseCommand, CommandError
-from terra_layer.models import Layer, Scene
+from django.db import DatabaseError, transaction
+from terra_layer.dump import LayerLoadMaps
+from terra_layer.models import Layer, Scene, deferred_layer_updates
+from terra_layer.restyle import restyle_loaded_layers
 from terra_layer.serializers import LayerDetailSerializer
-from django_geosource.models import Source
+from terra_layer.tree_cache import clear_changes_scenes_cache_on_commit
 import json
 
 
@@ -17,30 +21,155 @@ class Command(BaseCommand):
             action="store",
             help="json file path",
         )
+        parser.add_argument(
+            "--ndjson",
+            action="store_true",
+            help="load a file of dumped layers, one json per line",
+        )
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            help=(
+                "load all layers in a single transaction, generating styles "
+                "and scene trees once at the end, with --ndjson"
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help=(
+                "number of layers loaded in each transaction with --ndjson, "
+                "or resolved at once in the single transaction of --bulk"
+            ),
+        )
+        parser.add_argument(
+            "--offset",
+            type=int,
+            default=0,
+            help="number of lines to skip, to resume a failed load, with --ndjson",
+        )
 
     def handle(self, *args, **options):
-        data = json.load(options["file"])
-
-        source = Source.objects.get(slug=data["source"])
+        if options["bulk"] and not options["ndjson"]:
+            raise CommandError("--bulk requires --ndjson")
 
-        fk_fields = (
-            (Scene, "view", "slug"),
-            (Source, "source", "slug"),
-        )
+        if options["ndjson"] and options["bulk"]:
+            self.bulk_load_ndjson(
+                options["file"], options["batch_size"], options["offset"]
+            )
+            return
 
-        for klass, field, sfield in fk_fields:
-            if data.get(field):
-                data[field] = klass.objects.get(**{sfield: data[field]}).pk
+        if options["ndjson"]:
+            self.load_ndjson(options["file"], options["batch_size"], options["offset"])
+            return
 
-        for cs in data["extra_styles"]:
-            cs["source"] = Source.objects.get(slug=cs["source"]).pk
+        data = json.load(options["file"])
 
-        if data.get("main_field"):
-            data["main_field"] = source.fields.get(name=data["main_field"]).pk
+        try:
+            LayerLoadMaps([data]).resolve(data)
+        except ValueError as e:
+            raise CommandError(e)
+
+        self.load_layer(data)
+
+    def read_ndjson(self, file, offset):
+        """
+        Return non blank lines of the file with their number, from the line
+        `offset`. Lines are read lazily, so memory doesn't grow with the file size.
+        """
+        return (
+            (number, line)
+            for number, line in enumerate(islice(file, offset, None), offset)
+            if line.strip()
+        )
 
-        for field in data["fields"]:
-            field["field"] = source.fields.get(name=field["field"]).pk
+    def parse_layer(self, line):
+        data = json.loads(line)
+        if not isinstance(data, dict):
+            raise ValueError("Layer dump is not a JSON object")
+        return data
+
+    def load_ndjson(self, file, batch_size, offset):
+        lines = self.read_ndjson(file, offset)
+        loaded = 0
+        while True:
+            batch = list(islice(lines, batch_size))
+            if not batch:
+                break
+
+            first, last = batch[0][0], batch[-1][0]
+            try:
+                with transaction.atomic():
+                    layers_data = [self.parse_layer(line) for _, line in batch]
+                    maps = LayerLoadMaps(layers_data)
+                    for data in layers_data:
+                        self.load_layer(maps.resolve(data))
+            except (
+                CommandError,
+                ValueError,
+                DatabaseError,
+                # Malformed layer dumps
+                KeyError,
+                TypeError,
+            ) as e:
+                raise CommandError(
+                    f"Layers of lines {first} to {last} not loaded, "
+                    f"resume with --offset {first}: {e}"
+                )
+
+            loaded += len(batch)
+            self.stdout.write(f"{loaded} layer(s) loaded, next offset is {last + 1}")
+
+    @transaction.atomic
+    def bulk_load_ndjson(self, file, batch_size, offset):
+        lines = self.read_ndjson(file, offset)
+        number = offset
+        layer_pks = []
+        scenes = {}
+        try:
+            with deferred_layer_updates():
+                while True:
+                    batch = list(islice(lines, batch_size))
+                    if not batch:
+                        break
+
+                    layers_data = []
+                    for number, line in batch:
+                        layers_data.append(self.parse_layer(line))
+                    maps = LayerLoadMaps(layers_data)
+                    for (number, _), data in zip(batch, layers_data):
+                        layer = self.load_layer(maps.resolve(data), scenes)
+                        layer_pks.append(layer.pk)
+        except (
+            CommandError,
+            ValueError,
+            DatabaseError,
+            # Malformed layer dumps
+            KeyError,
+            TypeError,
+        ) as e:
+            raise CommandError(
+                f"Layer of line {number} not loaded, nothing loaded: {e}"
+            )
+
+        # Layer groups of each scene are built once, with all new layers
+        for scene in scenes.values():
+            scene.save()
+
+        # Styles are generated once for all layers, sharing source statistics
+        restyle_loaded_layers(Layer.objects.filter(pk__in=layer_pks))
+
+        clear_changes_scenes_cache_on_commit(layer_pks=layer_pks)
+        self.stdout.write(
+            f"{len(layer_pks)} layer(s) loaded, {len(scenes)} scene tree(s) updated"
+        )
 
+    def load_layer(self, data, scenes=None):
+        """
+        Load a layer dump, with ids of related objects. New layers are added
+        to the tree of their scene, saved at once unless collected in `scenes`.
+        """
         parts = data["name"].split("/")
         layer_name = parts.pop()
 
@@ -49,7 +178,8 @@ class Command(BaseCommand):
             layer = Layer.objects.get(uuid=data["uuid"])
             exists = True
         except Exception:
-            layer = Layer()
+            # Keep the uuid, so loading the layer again updates it
+            layer = Layer(uuid=data["uuid"])
             exists = False
 
         del data["group"]  # Remove group as we compute it later
@@ -64,6 +194,15 @@ class Command(BaseCommand):
         layer_detail_serializer.save()
 
         # Here we insert layer in tree if not previously existing
-        if not exists:
-            scene = Scene.objects.get(id=data["view"])
-            scene.insert_in_tree(layer_detail_serializer.instance, parts)
+        if not exists and data.get("view"):
+            if scenes is None:
+                scene = Scene.objects.get(id=data["view"])
+                scene.insert_in_tree(layer_detail_serializer.instance, parts)
+            else:
+                if data["view"] not in scenes:
+                    scenes[data["view"]] = Scene.objects.get(id=data["view"])
+                scenes[data["view"]].insert_in_tree(
+                    layer_detail_serializer.instance, parts, save=False
+                )
+
+        return layer_detail_serializer.instance
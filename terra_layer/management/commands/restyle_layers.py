@@ -0,0 +1,101 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from terra_layer.models import Layer
+from terra_layer.restyle import (
+    get_restyle_groups,
+    restyle_source_layers,
+    save_layers_styles,
+)
+from terra_layer.tree_cache import clear_scene_cache, get_layers_scenes
+from terra_layer.utils import invalidate_layer_data_revision
+
+
+class Command(BaseCommand):
+    help = "Generate again styles and legends of layers from their wizard settings"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source",
+            action="append",
+            dest="sources",
+            help="name of a source whose layers are restyled, all sources if not provided",
+        )
+        parser.add_argument(
+            "--scene",
+            action="append",
+            dest="scenes",
+            help="slug of a scene whose layers are restyled, all scenes if not provided",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of geostore layers analyzed in parallel",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="generate styles even if their setting and layer data are unchanged",
+        )
+
+    def handle(self, **options):
+        layers = Layer.objects.all()
+        if options.get("sources"):
+            layers = layers.filter(source__name__in=options["sources"])
+        if options.get("scenes"):
+            layers = layers.filter(group__view__slug__in=options["scenes"])
+
+        groups = get_restyle_groups(layers)
+        if options["force"]:
+            for source_layers in groups:
+                # Issue new layer data revisions, ignoring fingerprints and cached statistics
+                invalidate_layer_data_revision(source_layers[0].source.get_layer().pk)
+
+        updated_layers = []
+        updated_extra_styles = []
+        workers = options["workers"]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(self.restyle_source_layers, groups)
+                for index, (source_layers, (layers, extra_styles)) in enumerate(
+                    zip(groups, results), 1
+                ):
+                    updated_layers += layers
+                    updated_extra_styles += extra_styles
+                    self.write_progress(index, len(groups), source_layers, layers)
+        else:
+            for index, source_layers in enumerate(groups, 1):
+                layers, extra_styles = self.restyle_source_layers(
+                    source_layers, close_connection=False
+                )
+                updated_layers += layers
+                updated_extra_styles += extra_styles
+                self.write_progress(index, len(groups), source_layers, layers)
+
+        save_layers_styles(updated_layers, updated_extra_styles)
+
+        # Bulk updates send no signal, scenes cache is invalidated once for all
+        scene_pks = get_layers_scenes(layer_pks=[layer.pk for layer in updated_layers])
+        for scene_pk in scene_pks:
+            clear_scene_cache(scene_pk)
+
+        self.stdout.write(
+            f"{len(updated_layers)} layer(s) restyled in {len(scene_pks)} scene(s)"
+        )
+
+    def restyle_source_layers(self, source_layers, close_connection=True):
+        try:
+            return restyle_source_layers(source_layers)
+        finally:
+            if close_connection:
+                # Each worker thread owns its database connection
+                connection.close()
+
+    def write_progress(self, index, total, source_layers, layers):
+        self.stdout.write(
+            f"[{index}/{total}] Source {source_layers[0].source.name}: "
+            f"{len(layers)} layer(s) restyled"
+        )
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from terra_layer.dump import (
+    dump_layers,
+    get_dump_queryset,
+    get_tree_layer_ids,
+    map_tree_layers,
+)
+from terra_layer.models import Scene
+import json
+
+
+class Command(BaseCommand):
+    help = "Dump a scene with all its layers to json format"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-slug", type=str, action="store", help="Slug of the scene to export"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            scene = Scene.objects.prefetch_related("baselayer").get(
+                slug=options.get("slug")
+            )
+        except Scene.DoesNotExist:
+            raise CommandError("Scene does not exist")
+
+        layers = list(get_dump_queryset().filter(pk__in=get_tree_layer_ids(scene.tree)))
+
+        # Layers are referenced by uuid in the tree, as ids differ between instances
+        layer_uuids = {layer.pk: str(layer.uuid) for layer in layers}
+
+        serialized = {
+            "scene": {
+                "name": scene.name,
+                "slug": scene.slug,
+                "category": scene.category,
+                "order": scene.order,
+                "config": scene.config,
+                "baselayer": [baselayer.name for baselayer in scene.baselayer.all()],
+                "tree": map_tree_layers(scene.tree, layer_uuids),
+            },
+            "layers": dump_layers(layers),
+        }
+
+        self.stdout.write(json.dumps(serialized))
@@ -0,0 +1,84 @@
+import argparse
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from mapbox_baselayer.models import MapBaseLayer
+from terra_layer.dump import LayerLoadMaps, map_tree_layers
+from terra_layer.models import Layer, Scene, deferred_layer_updates
+from terra_layer.restyle import restyle_loaded_layers
+from terra_layer.serializers import LayerDetailSerializer
+from terra_layer.tree_cache import clear_changes_scenes_cache_on_commit
+import json
+
+
+class Command(BaseCommand):
+    help = "Load a dumped scene with all its layers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-file",
+            type=argparse.FileType("r"),
+            required=True,
+            action="store",
+            help="json file path",
+        )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        data = json.load(options["file"])
+        scene_data = data["scene"]
+        layers_data = data["layers"]
+
+        for layer_data in layers_data:
+            # Group and scene are computed from the tree
+            layer_data.pop("group", None)
+            layer_data.pop("view", None)
+
+        maps = LayerLoadMaps(layers_data)
+        try:
+            for layer_data in layers_data:
+                maps.resolve(layer_data)
+        except ValueError as e:
+            raise CommandError(e)
+
+        existing_layers = {
+            str(layer.uuid): layer
+            for layer in Layer.objects.filter(
+                uuid__in=[layer_data["uuid"] for layer_data in layers_data]
+            )
+        }
+
+        layer_ids = {}
+        # Styles and scene trees are generated once, after all layers are saved
+        with deferred_layer_updates():
+            for layer_data in layers_data:
+                layer = existing_layers.get(layer_data["uuid"])
+                layer_detail_serializer = LayerDetailSerializer(
+                    instance=layer, data=layer_data
+                )
+                try:
+                    layer_detail_serializer.is_valid(raise_exception=True)
+                except Exception as e:
+                    raise CommandError(f"A validation error occurred with data: {e}")
+
+                if layer is None:
+                    # Keep the uuid, so loading the scene again updates its layers
+                    layer_detail_serializer.save(uuid=layer_data["uuid"])
+                else:
+                    layer_detail_serializer.save()
+                layer_ids[layer_data["uuid"]] = layer_detail_serializer.instance.pk
+
+        scene = Scene.objects.filter(slug=scene_data["slug"]).first()
+        if scene is None:
+            scene = Scene(slug=scene_data["slug"])
+        for field in ("name", "category", "order", "config"):
+            setattr(scene, field, scene_data[field])
+        scene.tree = map_tree_layers(scene_data["tree"], layer_ids)
+        scene.save()  # Layer groups are built once for the whole tree
+        scene.baselayer.set(
+            MapBaseLayer.objects.filter(name__in=scene_data.get("baselayer", []))
+        )
+
+        restyle_loaded_layers(Layer.objects.filter(pk__in=layer_ids.values()))
+        clear_changes_scenes_cache_on_commit(layer_pks=layer_ids.values())
+
+        self.stdout.write(f"Scene {scene.slug}: {len(layer_ids)} layer(s) loaded")
@@ -0,0 +1,143 @@
+from hashlib import md5
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Prefetch
+from django_geosource.models import Field
+from geostore.models import Feature
+
+from terra_layer.models import Layer
+from terra_layer.style import get_wizard_statistics_requests
+from terra_layer.utils import NUMERIC_FIELD_TYPES
+
+INDEX_PREFIX = "terra_layer_stats_"
+
+
+def get_index_name(geo_layer_id, field):
+    return f"{INDEX_PREFIX}{geo_layer_id}_{md5(field.encode('utf-8')).hexdigest()[:16]}"
+
+
+def get_analyzed_fields():
+    """Return index names of numeric fields analyzed by wizards, with their (geostore layer pk, field)"""
+    analyzed_fields = {}
+    for layer in Layer.objects.select_related("source").prefetch_related(
+        "extra_styles",
+        Prefetch(
+            "source__fields",
+            Field.objects.filter(data_type__in=NUMERIC_FIELD_TYPES),
+            to_attr="numeric_fields",
+        ),
+    ):
+        style_configs = [
+            layer.main_style,
+            *[extra_style.style_config for extra_style in layer.extra_styles.all()],
+        ]
+        fields = {
+            request[1]
+            for style_config in style_configs
+            if style_config.get("type") == "wizard"
+            for request in get_wizard_statistics_requests(style_config)
+        } & {field.name for field in layer.source.numeric_fields}
+        if not fields:
+            continue
+
+        geo_layer_id = layer.source.get_layer().pk
+        for field in fields:
+            analyzed_fields[get_index_name(geo_layer_id, field)] = (
+                geo_layer_id,
+                field,
+            )
+    return analyzed_fields
+
+
+def get_existing_indexes():
+    """
+    Return names of existing wizard fields indexes, with whether they are
+    valid: a failed concurrent build leaves an invalid index behind.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT
+                index_class.relname,
+                pg_index.indisvalid
+            FROM
+                pg_index
+                JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+                JOIN pg_class AS table_class ON table_class.oid = pg_index.indrelid
+            WHERE
+                table_class.relname = %s AND
+                index_class.relname LIKE %s
+            """,
+            [Feature._meta.db_table, f"{INDEX_PREFIX}%"],
+        )
+        return dict(cursor.fetchall())
+
+
+class Command(BaseCommand):
+    help = (
+        "Create partial expression indexes on geostore features properties "
+        "analyzed by wizard styles, and drop the ones no longer used"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrently",
+            action="store_true",
+            help="build and drop indexes without locking writes on features",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="dry run with actions outputed instead",
+        )
+
+    def handle(self, **options):
+        self.concurrently = options.get("concurrently")
+        concurrently = "CONCURRENTLY " if self.concurrently else ""
+        dry_run = options.get("dry_run")
+
+        analyzed_fields = get_analyzed_fields()
+        existing_indexes = get_existing_indexes()
+        valid_indexes = {name for name, valid in existing_indexes.items() if valid}
+
+        # Invalid indexes are dropped to be built again
+        for index_name in sorted(
+            existing_indexes.keys() - (valid_indexes & analyzed_fields.keys())
+        ):
+            self.stdout.write(f"Drop index {index_name}")
+            if not dry_run:
+                self.execute_sql(
+                    f"DROP INDEX {concurrently}IF EXISTS "
+                    f"{connection.ops.quote_name(index_name)}"
+                )
+
+        for index_name in sorted(analyzed_fields.keys() - valid_indexes):
+            geo_layer_id, field = analyzed_fields[index_name]
+            self.stdout.write(
+                f"Create index {index_name} on field {field} of layer {geo_layer_id}"
+            )
+            if not dry_run:
+                # Same expression and predicate as the statistics queries of
+                # terra_layer.style.utils, for the planner to use the index.
+                self.execute_sql(
+                    f"CREATE INDEX {concurrently}IF NOT EXISTS "
+                    f"{connection.ops.quote_name(index_name)} "
+                    f"ON {connection.ops.quote_name(Feature._meta.db_table)} "
+                    "(((properties->>%(field)s)::numeric)) "
+                    "WHERE layer_id = %(layer_id)s",
+                    {"field": field, "layer_id": geo_layer_id},
+                )
+
+    def execute_sql(self, sql, params=None):
+        try:
+            if self.concurrently:
+                # Concurrent index operations can't run inside a transaction
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+            else:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+        except DatabaseError as error:
+            # Non numeric values of the field prevent the index creation
+            self.stdout.write(self.style.ERROR(f"{error}".strip()))
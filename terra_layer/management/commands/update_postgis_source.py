@@ -1,16 +1,23 @@
 import csv
+import json
 from django.core.management.base import BaseCommand
+from django.db import DatabaseError
 
 from django_geosource.models import Source
 from terra_layer.models import Layer
 
 
 class Command(BaseCommand):
-    help = "update a given layer with a given Source"
+    help = "update given layers with a given Source"
 
     def add_arguments(self, parser):
-        parser.add_argument("layer", type=int, help="pk of the layer")
+        parser.add_argument("layers", type=int, nargs="*", help="pks of the layers")
         parser.add_argument("source", action="store", help="name of the new source")
+        parser.add_argument(
+            "--from-source",
+            action="store",
+            help="name of a source whose every layer is updated, instead of layers pks",
+        )
         parser.add_argument(
             "--matches",
             action="store",
@@ -19,19 +26,46 @@ class Command(BaseCommand):
         parser.add_argument(
             "--dry-run",
             action="store_true",
-            help="dry run with actions outputed instead",
+            help="dry run with json plans of changes outputed instead",
+        )
+        parser.add_argument(
+            "--plan",
+            action="store",
+            help="json file of plans outputed by a dry run, applied as is, instead of layers pks",
         )
 
     def handle(self, **options):
-        layer_id = options.get("layer")
+        layer_ids = options.get("layers")
+        from_source = options.get("from_source")
         source_name = options.get("source")
         matches = options.get("matches")
         dry_run = options.get("dry_run")
 
-        if not Layer.objects.filter(id=layer_id).exists():
-            self.stdout.write(self.style.ERROR(f"Layer {layer_id} does not exists"))
+        if options.get("plan"):
+            self.apply_plans(options["plan"], source_name)
             return
 
+        # Filter fields of all layers are fetched at once
+        layers = (
+            Layer.objects.select_related("source")
+            .prefetch_related("fields_filters__field")
+            .order_by("pk")
+        )
+        if from_source:
+            layers = list(layers.filter(source__name=from_source))
+        else:
+            layers = list(layers.filter(id__in=layer_ids))
+            missing_ids = set(layer_ids) - {layer.pk for layer in layers}
+            if not layer_ids:
+                self.stdout.write(self.style.ERROR("No layer given"))
+                return
+            if missing_ids:
+                for layer_id in sorted(missing_ids):
+                    self.stdout.write(
+                        self.style.ERROR(f"Layer {layer_id} does not exists")
+                    )
+                return
+
         fields_matches = {}
         if matches:
             with open(matches, "r") as f:
@@ -40,6 +74,34 @@ class Command(BaseCommand):
                     old_name, new_name = row
                     fields_matches[old_name] = new_name
 
-        layer = Layer.objects.get(id=layer_id)
+        # Fields of the new source are fetched by the first layer, for all of them
+        source = Source.objects.get(name=source_name)
+        plans = []
+        for layer in layers:
+            plans.append(layer.replace_source(source, fields_matches, dry_run))
+            if not dry_run:
+                self.stdout.write(f"Layer {layer.pk}: source replaced by {source}")
+
+        if dry_run:
+            self.stdout.write(json.dumps(plans, indent=2))
+
+    def apply_plans(self, path, source_name):
+        with open(path, "r") as f:
+            plans = json.load(f)
+
         source = Source.objects.get(name=source_name)
-        layer.replace_source(source, fields_matches, dry_run)
+        layers = Layer.objects.in_bulk([plan["layer"] for plan in plans])
+        for plan in plans:
+            layer = layers.get(plan["layer"])
+            if layer is None:
+                self.stdout.write(
+                    self.style.ERROR(f"Layer {plan['layer']} does not exists")
+                )
+                continue
+
+            try:
+                layer.apply_replace_source_plan(plan, source)
+            except (ValueError, DatabaseError) as e:
+                self.stdout.write(self.style.ERROR(f"Layer {layer.pk}: {e}"))
+                continue
+            self.stdout.write(f"Layer {layer.pk}: source replaced by {source}")
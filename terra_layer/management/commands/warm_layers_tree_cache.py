@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from terra_layer.models import Scene
+from terra_layer.settings import CACHE_REFRESH_WORKERS
+from terra_layer.tree_cache import refresh_scene_cache
+
+
+class Command(BaseCommand):
+    help = "Build and cache layers trees of scenes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scene",
+            action="append",
+            dest="scenes",
+            help="slug of a scene to warm, all scenes if not provided",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=CACHE_REFRESH_WORKERS,
+            help="number of scenes built in parallel",
+        )
+
+    def handle(self, **options):
+        scenes = Scene.objects.all()
+        if options.get("scenes"):
+            scenes = scenes.filter(slug__in=options["scenes"])
+
+        scene_pks = list(scenes.values_list("pk", flat=True))
+        workers = options["workers"]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(self.warm_scene, scene_pks)
+                for message in results:
+                    self.stdout.write(message)
+        else:
+            for scene_pk in scene_pks:
+                self.stdout.write(self.warm_scene(scene_pk, close_connection=False))
+
+    def warm_scene(self, scene_pk, close_connection=True):
+        try:
+            scene = Scene.objects.get(pk=scene_pk)
+            if refresh_scene_cache(scene):
+                return f"Scene {scene.slug}: layers tree cached"
+            return f"Scene {scene.slug}: no layer to cache"
+        finally:
+            if close_connection:
+                # Each worker thread owns its database connection
+                connection.close()
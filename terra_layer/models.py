@@ -1,9 +1,10 @@
+from contextlib import contextmanager
 from hashlib import md5
+import threading
 import uuid
 
-from django.contrib.auth.models import Group
-from django.core.cache import cache
 from django.db import models, transaction
+from django.db.models import Q, prefetch_related_objects
 
 try:
     from django.db.models import JSONField
@@ -15,9 +16,30 @@ from django_geosource.models import Source, Field
 from rest_framework.reverse import reverse
 from mapbox_baselayer.models import MapBaseLayer
 
-from .utils import get_layer_group_cache_key
+from .tree_cache import clear_scene_cache
 from .schema import JSONSchemaValidator, SCENE_LAYERTREE
-from .style import generate_style_from_wizard
+from .style import (
+    generate_style_from_wizard,
+    get_wizard_fingerprint,
+    get_wizard_statistics_requests,
+)
+from .style.statistics import StatisticsContext
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_layer_updates():
+    """
+    Skip wizard style generation and scene cache invalidation of layers saved
+    in the block, for bulk imports to run them once for all layers afterwards.
+    """
+    previous = getattr(_deferred, "layer_updates", False)
+    _deferred.layer_updates = True
+    try:
+        yield
+    finally:
+        _deferred.layer_updates = previous
 
 
 class Scene(models.Model):
@@ -41,55 +63,187 @@ class Scene(models.Model):
     def get_absolute_url(self):
         return reverse("scene-detail", args=[self.pk])
 
-    def tree2models(self, current_node=None, parent=None, order=0):
+    def tree2models(self):
         """
         Generate groups structure from admin layer tree.
-        This is a recursive function to handle each step of process.
 
-        :param current_node: current node of the tree
-        :param parent: The parent group of current node
-        :param order: Current order to keep initial json order
+        The tree is walked level by level: groups of each level are created
+        with a single bulk insert, as their parents already exist, then all
+        layers are fetched and attached to their group with one bulk update.
+
         :returns: Nothing
         """
+        self.layer_groups.all().delete()  # Clear all groups to generate brand new one
+
+        # Create a default unique parent group that is ignored at export
+        root = LayerGroup.objects.create(view=self, label="Root")
+
+        layer_nodes = []  # (parent group, order, layer id) of each geolayer
+        level = [(root, self.tree)]
+        while level:
+            groups = []
+            next_level = []
+            for parent, nodes in level:
+                for order, node in enumerate(nodes):
+                    if "group" in node:
+                        # Handle groups
+                        group = LayerGroup(
+                            view=self,
+                            parent_id=parent.pk,
+                            label=node["label"],
+                            exclusive=node.get("exclusive", False),
+                            selectors=node.get("selectors"),
+                            settings=node.get("settings", {}),
+                            order=order,
+                        )
+                        groups.append(group)
+                        if "children" in node:
+                            next_level.append((group, node["children"]))
+
+                    elif "geolayer" in node:
+                        # Handle layers
+                        layer_nodes.append((parent, order, node["geolayer"]))
+
+            LayerGroup.objects.bulk_create(groups)
+            level = next_level
+
+        self._attach_layers(layer_nodes)
+
+    @transaction.atomic
+    def sync_tree2models(self):
+        """
+        Synchronize groups structure with admin layer tree, only writing what
+        changed since the previous synchronization.
 
-        # Init case, we've just launch the process
-        if current_node is None:
-            current_node = self.tree
-            self.layer_groups.all().delete()  # Clear all groups to generate brand new one
-
-        if not parent:
-            # Create a default unique parent group that is ignored at export
-            parent = LayerGroup.objects.create(view=self, label="Root")
-
-        if isinstance(current_node, list):
-            for idx, child in enumerate(current_node):
-                self.tree2models(current_node=child, parent=parent, order=idx)
-
-        elif "group" in current_node:
-            # Handle groups
-            group = parent.children.create(
-                view=self,
-                label=current_node["label"],
-                exclusive=current_node.get("exclusive", False),
-                selectors=current_node.get("selectors"),
-                settings=current_node.get("settings", {}),
-                order=order,
-            )
+        Existing groups are matched by label among the children of their
+        matched parent, so they keep their ids. Groups not found anymore in
+        the tree are deleted, and only moved layers are updated.
 
-            if "children" in current_node:
-                self.tree2models(current_node=current_node["children"], parent=group)
+        :returns: Nothing
+        """
+        existing_groups = list(self.layer_groups.all())
+        existing_children = {}
+        roots = []
+        for group in existing_groups:
+            if group.parent_id is None:
+                roots.append(group)
+            else:
+                existing_children.setdefault(group.parent_id, []).append(group)
 
-        elif "geolayer" in current_node:
-            # Handle layers
-            layer = Layer.objects.get(pk=current_node["geolayer"])
-            layer.group = parent
-            layer.order = order
-            layer.save(wizard_update=False)
+        if roots:
+            root = roots[0]
+        else:
+            # Create a default unique parent group that is ignored at export
+            root = LayerGroup.objects.create(view=self, label="Root")
+
+        matched_groups = {root.pk}
+        updated_groups = []
+        layer_nodes = []  # (parent group, order, layer id) of each geolayer
+        level = [(root, self.tree)]
+        while level:
+            created_groups = []
+            next_level = []
+            for parent, nodes in level:
+                candidates = existing_children.get(parent.pk, [])
+                for order, node in enumerate(nodes):
+                    if "group" in node:
+                        # Handle groups
+                        values = {
+                            "label": node["label"],
+                            "exclusive": node.get("exclusive", False),
+                            "selectors": node.get("selectors"),
+                            "settings": node.get("settings", {}),
+                            "order": order,
+                        }
+                        group = next(
+                            (
+                                candidate
+                                for candidate in candidates
+                                if candidate.label == node["label"]
+                                and candidate.pk not in matched_groups
+                            ),
+                            None,
+                        )
+                        if group is None:
+                            group = LayerGroup(view=self, parent_id=parent.pk, **values)
+                            created_groups.append(group)
+                        else:
+                            matched_groups.add(group.pk)
+                            if any(
+                                getattr(group, key) != value
+                                for key, value in values.items()
+                            ):
+                                for key, value in values.items():
+                                    setattr(group, key, value)
+                                updated_groups.append(group)
+
+                        if "children" in node:
+                            next_level.append((group, node["children"]))
+
+                    elif "geolayer" in node:
+                        # Handle layers
+                        layer_nodes.append((parent, order, node["geolayer"]))
+
+            LayerGroup.objects.bulk_create(created_groups)
+            level = next_level
+
+        LayerGroup.objects.bulk_update(
+            updated_groups, ["label", "exclusive", "selectors", "settings", "order"]
+        )
+
+        # Layers are moved before groups deletion, so they are not detached
+        self._attach_layers(layer_nodes)
+
+        deleted_groups = [
+            group.pk for group in existing_groups if group.pk not in matched_groups
+        ]
+        if deleted_groups:
+            LayerGroup.objects.filter(pk__in=deleted_groups).delete()
+
+    def _attach_layers(self, layer_nodes):
+        """
+        Update group and order of layers found in tree, and detach other
+        layers of the scene. Only modified layers are written.
 
-    def insert_in_tree(self, layer, parts, group_config=None):
+        :param layer_nodes: list of (parent group, order, layer id) of the tree
+        """
+        layers = {
+            layer.pk: layer
+            for layer in Layer.objects.filter(
+                Q(pk__in=[layer_id for _, _, layer_id in layer_nodes])
+                | Q(group__view=self)
+            )
+        }
+
+        updated_layers = {}
+        for parent, order, layer_id in layer_nodes:
+            if layer_id not in layers:
+                raise Layer.DoesNotExist(f"Layer {layer_id} does not exist")
+            layer = layers[layer_id]
+            if (layer.group_id, layer.order) != (parent.pk, order):
+                layer.group_id = parent.pk
+                layer.order = order
+                updated_layers[layer_id] = layer
+
+        # Layers not in tree anymore are removed from the scene
+        tree_layer_ids = {layer_id for _, _, layer_id in layer_nodes}
+        for layer_id, layer in layers.items():
+            if layer_id not in tree_layer_ids and layer.group_id is not None:
+                layer.group_id = None
+                updated_layers[layer_id] = layer
+
+        Layer.objects.bulk_update(updated_layers.values(), ["group", "order"])
+        self.clear_layers_cache()
+
+    def clear_layers_cache(self):
+        """Invalidate the cached layers tree of the scene, shared by all users."""
+        clear_scene_cache(self.pk)
+
+    def insert_in_tree(self, layer, parts, group_config=None, save=True):
         """Add the layer in tree. Each parts are a group name to find inside the tree.
         Here we assume that missing groups are added at first position of current node
         We create missing group with default exclusive group configuration (should be corrected later if necessary)
+        With save=False, the scene is left to be saved once after many insertions.
         """
         group_config = group_config or {}
 
@@ -117,14 +271,15 @@ class Scene(models.Model):
         if group_config and last_group:
             # And update tho config
             last_group.update(group_config)
-        self.save()
+        if save:
+            self.save()
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
 
         super().save(*args, **kwargs)
-        self.tree2models()  # Generate LayerGroups according to the tree
+        self.sync_tree2models()  # Update LayerGroups according to the tree
 
     class Meta:
         ordering = ["order"]
@@ -201,152 +356,292 @@ class Layer(models.Model):
     class Meta:
         ordering = ("order", "name")
 
-    def generate_style_and_legend(self, style_config):
+    def generate_style_and_legend(self, style_config, stats=None):
         # Add uid to style if missing
         if style_config and "uid" not in style_config:
             style_config["uid"] = str(uuid.uuid4())
 
         if style_config.get("type") == "wizard":
+            geo_layer = self.source.get_layer()
             generated_map_style, legend_additions = generate_style_from_wizard(
-                self.source.get_layer(), style_config
+                geo_layer, style_config, stats
             )
             style_config["map_style"] = generated_map_style
+            style_config["fingerprint"] = get_wizard_fingerprint(
+                geo_layer, style_config, stats and stats.get_revision(geo_layer)
+            )
             return legend_additions
 
         return []
 
-    def save(self, wizard_update=True, preserve_legend=False, **kwargs):
-        if wizard_update:
-            style_by_uid = {}
-            # Mark not updated auto legends
-            [
-                legend.update({"not_updated": True})
-                for legend in self.legends
-                if legend.get("auto")
-            ]
-            legend_additions = self.generate_style_and_legend(self.main_style)
-            if self.main_style:
-                style_by_uid[self.main_style["uid"]] = self.main_style
-
-            for extra_style in self.extra_styles.all():
-                legend_additions += self.generate_style_and_legend(
-                    extra_style.style_config
-                )
-                if extra_style.style_config:
-                    style_by_uid[
-                        extra_style.style_config["uid"]
-                    ] = extra_style.style_config
-                extra_style.save()
+    def is_style_up_to_date(self, style_config, stats=None):
+        """Whether the style generated from a wizard setting would be the same"""
+        if not (
+            style_config.get("type") == "wizard"
+            and "uid" in style_config
+            and "map_style" in style_config
+        ):
+            return False
+
+        geo_layer = self.source.get_layer()
+        revision = stats and stats.get_revision(geo_layer)
+        return style_config.get("fingerprint") == get_wizard_fingerprint(
+            geo_layer, style_config, revision
+        )
+
+    def update_styles(self, stats=None, preserve_legend=False):
+        """
+        Generate styles and legends of the layer and its extra styles from
+        their wizard settings, without saving anything.
+        `stats` is a StatisticsContext to share field statistics with other layers.
+        Return whether any wizard style was generated again, along with extra
+        styles whose style was generated again, to be saved.
+        """
+        # Field statistics are shared between main style and extra styles
+        stats = stats or StatisticsContext()
+        style_by_uid = {}
+        extra_styles = list(self.extra_styles.all())
+        style_configs = [
+            self.main_style,
+            *[extra_style.style_config for extra_style in extra_styles],
+        ]
+
+        # Styles whose wizard inputs are unchanged are not generated again
+        up_to_date_uids = {
+            style_config["uid"]
+            for style_config in style_configs
+            if self.is_style_up_to_date(style_config, stats)
+        }
+
+        # Independent statistics of styles to generate are computed concurrently
+        statistics_requests = [
+            request
+            for style_config in style_configs
+            if style_config.get("type") == "wizard"
+            and style_config.get("uid") not in up_to_date_uids
+            for request in get_wizard_statistics_requests(style_config)
+        ]
+        if statistics_requests:
+            stats.prefetch(self.source.get_layer(), statistics_requests)
+
+        # Mark not updated auto legends, legends of up to date styles are kept
+        [
+            legend.update({"not_updated": True})
+            for legend in self.legends
+            if legend.get("auto")
+            and legend["uid"].split("__")[0] not in up_to_date_uids
+        ]
+        legend_additions = []
+        updated_extra_styles = []
+        regenerated = False
+        if self.main_style.get("uid") not in up_to_date_uids:
+            legend_additions += self.generate_style_and_legend(self.main_style, stats)
+            regenerated = self.main_style.get("type") == "wizard"
+        if self.main_style:
+            style_by_uid[self.main_style["uid"]] = self.main_style
+
+        for extra_style in extra_styles:
+            if extra_style.style_config.get("uid") in up_to_date_uids:
+                style_by_uid[extra_style.style_config["uid"]] = extra_style.style_config
+                continue
+
+            legend_additions += self.generate_style_and_legend(
+                extra_style.style_config, stats
+            )
+            if extra_style.style_config:
+                style_by_uid[extra_style.style_config["uid"]] = extra_style.style_config
+            updated_extra_styles.append(extra_style)
+            regenerated |= extra_style.style_config.get("type") == "wizard"
 
-            all_legends = list(self.legends)
-            for legend_addition in legend_additions:
-                found = False
-                for legend in all_legends:
-                    if legend.get("uid") == legend_addition["uid"]:
-                        # Update found legend with addition
-                        legend.update(legend_addition)
-                        del legend["not_updated"]
-                        found = True
-                        break
-                if not found:
-                    # Add legend to legends
-                    legend_addition["title"] = f"{self.name}"
-                    legend_addition["auto"] = True
-                    self.legends.append(legend_addition)
-
-            # Update legend auto status and clean unused legends
-            kept_legend = []
-            for legend in self.legends:
-                # Do we remove that legend ?
-                if legend.get("auto") and legend.get("not_updated"):
-                    if not preserve_legend:
-                        continue
-
-                    # Here we try to keep deactivated legends
-                    style_uid, style_prop = legend["uid"].split("__")
-
-                    if style_uid not in style_by_uid:
-                        # Style is dropped, we remove that legend
-                        continue
-
-                    prop_config = style_by_uid[style_uid]["style"].get(style_prop)
-
-                    if not prop_config:
-                        # Style prop is dropped, we remove that legend
-                        continue
-
-                    if prop_config["type"] in ["fixed", "none"]:
-                        # Legend not needed anymore for this field
-                        continue
-
-                    # Here We've just need to deactivate the legend
-                    del legend["auto"]
-                    legend["uid"] = str(uuid.uuid4())
+        all_legends = list(self.legends)
+        for legend_addition in legend_additions:
+            found = False
+            for legend in all_legends:
+                if legend.get("uid") == legend_addition["uid"]:
+                    # Update found legend with addition
+                    legend.update(legend_addition)
                     del legend["not_updated"]
+                    found = True
+                    break
+            if not found:
+                # Add legend to legends
+                legend_addition["title"] = f"{self.name}"
+                legend_addition["auto"] = True
+                self.legends.append(legend_addition)
+
+        # Update legend auto status and clean unused legends
+        kept_legend = []
+        for legend in self.legends:
+            # Do we remove that legend ?
+            if legend.get("auto") and legend.get("not_updated"):
+                if not preserve_legend:
+                    continue
+
+                # Here we try to keep deactivated legends
+                style_uid, style_prop = legend["uid"].split("__")
 
-                kept_legend.append(legend)
+                if style_uid not in style_by_uid:
+                    # Style is dropped, we remove that legend
+                    continue
 
-            self.legends = kept_legend
+                prop_config = style_by_uid[style_uid]["style"].get(style_prop)
+
+                if not prop_config:
+                    # Style prop is dropped, we remove that legend
+                    continue
+
+                if prop_config["type"] in ["fixed", "none"]:
+                    # Legend not needed anymore for this field
+                    continue
+
+                # Here We've just need to deactivate the legend
+                del legend["auto"]
+                legend["uid"] = str(uuid.uuid4())
+                del legend["not_updated"]
+
+            kept_legend.append(legend)
+
+        self.legends = kept_legend
+
+        return regenerated, updated_extra_styles
+
+    def save(self, wizard_update=True, preserve_legend=False, **kwargs):
+        deferred = getattr(_deferred, "layer_updates", False)
+        if wizard_update and not deferred:
+            _, extra_styles = self.update_styles(preserve_legend=preserve_legend)
+            for extra_style in extra_styles:
+                extra_style.save()
 
         super().save(**kwargs)
 
         # Invalidate cache for layer group
-        if self.group:
-            cache.delete(get_layer_group_cache_key(self.group.view))
-
-            # deleting cache for Groups
-            groups = self.source.settings.get("groups", [])
-            for group in Group.objects.filter(id__in=groups):
-                cache.delete(
-                    get_layer_group_cache_key(
-                        self.group.view,
-                        [
-                            group.name,
-                        ],
-                    )
-                )
+        if self.group_id and not deferred:
+            clear_scene_cache(self.group.view_id)
 
     def __str__(self):
         return f"Layer({self.id}) - {self.name}"
 
-    @transaction.atomic()
-    def replace_source(self, new_source, fields_matches=None, dry_run=False):
+    def get_replace_source_plan(self, new_source, fields_matches=None):
+        """
+        Return changes moving the layer to a new source, as a json serializable
+        dict. Filter fields are remapped by name, or with fields_matches, old
+        names to new ones. Fields of both sources are fetched once, unless
+        already prefetched.
+        """
         fields_matches = fields_matches or {}
+        prefetch_related_objects([self], "fields_filters__field")
+        prefetch_related_objects([new_source], "fields")
+        new_fields = {field.name: field for field in new_source.fields.all()}
+
+        plan = {
+            "layer": self.pk,
+            "source": {"old": self.source_id, "new": new_source.pk},
+            "source_names": {"old": str(self.source), "new": str(new_source)},
+            "remapped": [],
+            "deleted": [],
+            "created": [],
+        }
+
         # update old field if ones from the new source
         # remove it when not present in the new source
+        kept_names = set()
         for filter_field in self.fields_filters.all():
             # if not fields_matches provided or found, we check with the filter_field name
             field_name = fields_matches.get(
                 filter_field.field.name, filter_field.field.name
             )
-            if new_source.fields.filter(name=field_name).exists():
-                new_field = new_source.fields.get(name=field_name)
-                if dry_run:
-                    print(f"{filter_field.field.name} replaced by {new_field.name}.")
-                else:
-                    filter_field.field = new_field
-                    filter_field.save()
+            if field_name in new_fields:
+                kept_names.add(field_name)
+                plan["remapped"].append(
+                    {
+                        "filter_field": filter_field.pk,
+                        "old_field": filter_field.field.name,
+                        "new_field": field_name,
+                        "new_field_id": new_fields[field_name].pk,
+                    }
+                )
             else:
-                if dry_run:
-                    print(f"Old field {field_name} deleted.")
-                else:
-                    filter_field.delete()
+                plan["deleted"].append(
+                    {"filter_field": filter_field.pk, "field": filter_field.field.name}
+                )
 
         # fields in the new source that don't exist in the old one are created
-        for field in new_source.fields.all():
+        for field in new_fields.values():
             if (
-                not self.fields_filters.filter(field__name=field.name).exists()
+                field.name not in kept_names
                 and field.name not in fields_matches.values()
             ):
-                if dry_run:
-                    print(f"New FilterField {field.name} created.")
-                else:
-                    self.fields_filters.create(field=field)
-        if dry_run:
-            print(f"{self.source} replaced by {new_source}.")
-        else:
-            self.source = new_source
-            self.save()
+                plan["created"].append({"field": field.name, "field_id": field.pk})
+
+        return plan
+
+    @transaction.atomic()
+    def apply_replace_source_plan(self, plan, new_source=None):
+        """
+        Write changes of a plan from `get_replace_source_plan`, in bulk, with
+        styles generated once. The plan is not computed again, but it must
+        have been computed from the current source and filter fields of the
+        layer, and fields of the new source must still exist.
+        """
+        if plan["layer"] != self.pk or plan["source"]["old"] != self.source_id:
+            raise ValueError(f"Plan does not apply to the current source of {self}")
+        if new_source is not None and new_source.pk != plan["source"]["new"]:
+            raise ValueError(f"Plan does not replace source of {self} by {new_source}")
+
+        planned_filter_fields = {
+            change["filter_field"] for change in plan["remapped"] + plan["deleted"]
+        }
+        if planned_filter_fields != set(
+            self.fields_filters.values_list("pk", flat=True)
+        ):
+            raise ValueError(f"Filter fields of {self} changed since the plan")
+
+        new_field_ids = {remapped["new_field_id"] for remapped in plan["remapped"]} | {
+            created["field_id"] for created in plan["created"]
+        }
+        if (
+            len(new_field_ids)
+            != Field.objects.filter(
+                pk__in=new_field_ids, source_id=plan["source"]["new"]
+            ).count()
+        ):
+            raise ValueError(
+                f"Fields of source {plan['source_names']['new']} changed since the plan"
+            )
+
+        FilterField.objects.bulk_update(
+            [
+                FilterField(
+                    pk=remapped["filter_field"], field_id=remapped["new_field_id"]
+                )
+                for remapped in plan["remapped"]
+            ],
+            ["field"],
+        )
+        if plan["deleted"]:
+            FilterField.objects.filter(
+                pk__in=[deleted["filter_field"] for deleted in plan["deleted"]]
+            ).delete()
+        FilterField.objects.bulk_create(
+            [
+                FilterField(layer=self, field_id=created["field_id"])
+                for created in plan["created"]
+            ]
+        )
+        if hasattr(self, "_prefetched_objects_cache"):
+            self._prefetched_objects_cache.pop("fields_filters", None)
+        self.source = new_source or Source.objects.get(pk=plan["source"]["new"])
+        self.save()
+
+    def replace_source(self, new_source, fields_matches=None, dry_run=False):
+        """
+        Move the layer to a new source, see `get_replace_source_plan`.
+        Return the plan of changes, only computed with dry_run.
+        """
+        plan = self.get_replace_source_plan(new_source, fields_matches)
+        if not dry_run:
+            self.apply_replace_source_plan(plan, new_source)
+        return plan
 
 
 class CustomStyle(models.Model):
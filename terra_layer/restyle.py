@@ -0,0 +1,73 @@
+from itertools import groupby
+
+from django.db import transaction
+
+from .models import CustomStyle, Layer
+from .style import StatisticsContext
+
+
+def has_wizard_style(layer):
+    return any(
+        style_config.get("type") == "wizard"
+        for style_config in [
+            layer.main_style,
+            *[extra_style.style_config for extra_style in layer.extra_styles.all()],
+        ]
+    )
+
+
+def get_restyle_groups(layers, wizard_only=True):
+    """
+    Return layers with wizard styles, or all of them, grouped by source.
+    Layers of a same source share their geostore layer, so field statistics
+    are computed once for all of them.
+    """
+    layers = (
+        layers.select_related("source")
+        .prefetch_related("extra_styles")
+        .order_by("source_id", "pk")
+    )
+    if wizard_only:
+        layers = filter(has_wizard_style, layers)
+    return [
+        list(source_layers)
+        for _, source_layers in groupby(layers, key=lambda layer: layer.source_id)
+    ]
+
+
+def restyle_source_layers(source_layers):
+    """
+    Generate styles of layers of a same source, without saving them.
+    Return layers with wizard styles generated again, and extra styles to be
+    saved with the layers.
+    """
+    stats = StatisticsContext()
+    restyled_layers, extra_styles = [], []
+    for layer in source_layers:
+        regenerated, updated_extra_styles = layer.update_styles(stats=stats)
+        if regenerated:
+            restyled_layers.append(layer)
+        extra_styles += updated_extra_styles
+    return restyled_layers, extra_styles
+
+
+@transaction.atomic
+def save_layers_styles(layers, extra_styles, batch_size=500):
+    """Write generated styles, with no signal sent nor cache invalidated"""
+    Layer.objects.bulk_update(layers, ["main_style", "legends"], batch_size=batch_size)
+    CustomStyle.objects.bulk_update(
+        extra_styles, ["style_config"], batch_size=batch_size
+    )
+
+
+def restyle_loaded_layers(layers):
+    """
+    Generate and save styles of all layers loaded with deferred updates,
+    sharing field statistics between layers of a same source.
+    """
+    restyled_layers, extra_styles = [], []
+    for source_layers in get_restyle_groups(layers, wizard_only=False):
+        _, source_extra_styles = restyle_source_layers(source_layers)
+        extra_styles += source_extra_styles
+        restyled_layers += source_layers
+    save_layers_styles(restyled_layers, extra_styles)
@@ -6,7 +6,11 @@ from rest_framework.fields import SerializerMethodField
 from rest_framework.reverse import reverse
 from rest_framework.serializers import ModelSerializer, PrimaryKeyRelatedField
 
+from django_geosource.models import Source
+
 from .models import CustomStyle, FilterField, Layer, Scene
+from .style.statistics import DISCRETIZE_METHODS
+from .utils import NUMERIC_FIELD_TYPES
 
 
 class SceneListSerializer(ModelSerializer):
@@ -135,3 +139,23 @@ class LayerDetailSerializer(ModelSerializer):
     class Meta:
         model = Layer
         fields = "__all__"
+
+
+class HistogramQuerySerializer(serializers.Serializer):
+    source = PrimaryKeyRelatedField(queryset=Source.objects.all())
+    field = serializers.CharField()
+    method = serializers.ChoiceField(choices=DISCRETIZE_METHODS)
+    class_count = serializers.IntegerField(min_value=1, max_value=100)
+    bins = serializers.IntegerField(min_value=1, max_value=1000, default=20)
+
+    def validate(self, data):
+        field = data["source"].fields.filter(name=data["field"]).first()
+        if field is None:
+            raise serializers.ValidationError(
+                {"field": f"Field {data['field']} does not exist in source"}
+            )
+        if field.data_type not in NUMERIC_FIELD_TYPES:
+            raise serializers.ValidationError(
+                {"field": f"Field {data['field']} is not numeric"}
+            )
+        return data
@@ -6,3 +6,31 @@ default_settings = getattr(settings, "TERRA_LAYER_STYLE_SETTINGS", {})
 DEFAULT_CIRCLE_MIN_LEGEND_HEIGHT = default_settings.get("circle_min_legend_height", 14)
 DEFAULT_SIZE_MIN_LEGEND_HEIGHT = default_settings.get("size_min_legend_height", 1)
 DEFAULT_NO_VALUE_FILL_COLOR = default_settings.get("no_value_fill_color", "#000000")
+# Seconds during which wizard field statistics are kept in cache, 0 to disable.
+DEFAULT_STATISTICS_CACHE_TIMEOUT = default_settings.get(
+    "statistics_cache_timeout", 60 * 60 * 24
+)
+# Number of sampled features used by "approx_quantile" discretization.
+DEFAULT_QUANTILE_SAMPLE_SIZE = default_settings.get("quantile_sample_size", 100000)
+# Number of features, as estimated by the database, above which "quantile"
+# discretization is approximated, None to disable.
+DEFAULT_QUANTILE_SAMPLE_THRESHOLD = default_settings.get(
+    "quantile_sample_threshold", None
+)
+# Number of sampled features used by "fisher_jenks" discretization on large layers.
+DEFAULT_JENKS_SAMPLE_SIZE = default_settings.get("jenks_sample_size", 100000)
+# Max number of distinct values classified by "fisher_jenks", merged above.
+DEFAULT_JENKS_MAX_VALUES = default_settings.get("jenks_max_values", 2000)
+# Threads computing wizard field statistics concurrently, 1 to compute them serially.
+DEFAULT_STATISTICS_WORKERS = default_settings.get("statistics_workers", 1)
+
+cache_settings = getattr(settings, "TERRA_LAYER_CACHE_SETTINGS", {})
+
+# Rebuild layers trees in background after changes, previous ones being served meanwhile.
+CACHE_BACKGROUND_REFRESH = cache_settings.get("background_refresh", False)
+# Number of threads used to rebuild layers trees.
+CACHE_REFRESH_WORKERS = cache_settings.get("refresh_workers", 2)
+# Cache layers trees as rendered JSON bytes for each user groups, served as is.
+CACHE_RENDERED_RESPONSE = cache_settings.get("rendered_response", False)
+# Compressed variants of rendered layers trees, among "gzip" and "br" (requires brotli).
+CACHE_RENDERED_ENCODINGS = cache_settings.get("rendered_encodings", ["gzip"])
@@ -0,0 +1,60 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django_geosource.models import Field, Source
+from django_geosource.signals import refresh_data_done
+from geostore.models import Feature
+
+from .models import CustomStyle, FilterField
+from .tree_cache import (
+    clear_changes_scenes_cache_on_commit,
+    clear_scene_cache,
+    get_layers_scenes,
+)
+from .utils import (
+    invalidate_layer_data_revision,
+    invalidate_layer_data_revision_on_commit,
+)
+
+
+@receiver(post_save, sender=Feature)
+@receiver(post_delete, sender=Feature)
+def feature_changed(sender, instance, **kwargs):
+    invalidate_layer_data_revision_on_commit(instance.layer_id)
+
+
+@receiver(refresh_data_done)
+def source_refreshed(sender, layer, **kwargs):
+    invalidate_layer_data_revision(layer)
+
+
+@receiver(post_save)
+def source_changed(sender, instance, **kwargs):
+    # Source is polymorphic, signals are sent by its subclasses
+    if isinstance(instance, Source):
+        clear_changes_scenes_cache_on_commit(source_pks=[instance.pk])
+
+
+@receiver(pre_delete)
+def source_deleted(sender, instance, **kwargs):
+    if isinstance(instance, Source):
+        # Layers are gone once the transaction is committed, their scenes are
+        # looked up before
+        for scene_pk in get_layers_scenes(source_pks=[instance.pk]):
+            transaction.on_commit(partial(clear_scene_cache, scene_pk))
+
+
+@receiver(post_save, sender=Field)
+@receiver(post_delete, sender=Field)
+def field_changed(sender, instance, **kwargs):
+    clear_changes_scenes_cache_on_commit(source_pks=[instance.source_id])
+
+
+@receiver(post_save, sender=FilterField)
+@receiver(post_delete, sender=FilterField)
+@receiver(post_save, sender=CustomStyle)
+@receiver(post_delete, sender=CustomStyle)
+def layer_content_changed(sender, instance, **kwargs):
+    clear_changes_scenes_cache_on_commit(layer_pks=[instance.layer_id])
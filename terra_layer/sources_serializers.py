@@ -9,10 +9,16 @@ DEFAULT_SOURCE_NAME = "terra"
 
 
 class SourceSerializer(serializers.BaseSerializer):
+    def __init__(self, instance=None, source=None, **kwargs):
+        super().__init__(instance, **kwargs)
+        if source is not None:
+            # Real source instance already fetched by the caller
+            self.source_object = source
+
     @classmethod
-    def get_object_serializer(cls, obj):
+    def get_object_serializer(cls, obj, source=None):
 
-        source = obj.source.get_real_instance()
+        source = source or obj.source.get_real_instance()
         clsmembers = inspect.getmembers(sys.modules[__name__], inspect.isclass)
 
         for _, serializer in clsmembers:
@@ -20,9 +26,9 @@ class SourceSerializer(serializers.BaseSerializer):
                 serializer.__module__ == __name__
                 and serializer.Meta.model is source.__class__
             ):
-                return serializer(obj)
+                return serializer(obj, source=source)
 
-        return cls(obj)
+        return cls(obj, source=source)
 
     @cached_property
     def source_object(self):
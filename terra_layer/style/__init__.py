@@ -1,7 +1,14 @@
+import json
+from hashlib import md5
+
+from django.core.serializers.json import DjangoJSONEncoder
+
 from terra_layer.settings import (
     DEFAULT_NO_VALUE_FILL_COLOR,
 )
+from terra_layer.utils import get_layer_data_revision
 
+from .statistics import STATISTICS_METHODS, StatisticsContext
 from .utils import get_style_no_value_condition, style_type_2_legend_property
 
 from .all import (
@@ -67,10 +74,74 @@ def get_layer_type(map_style_type):
     return map_style_type
 
 
-def generate_style_from_wizard(geo_layer, config):
+def get_wizard_fingerprint(geo_layer, config, revision=None):
+    """
+    Return a hash of everything a style generated from a wizard setting
+    depends on: the setting itself and the geostore layer data revision,
+    fetched if not provided.
+    """
+    if revision is None:
+        revision = get_layer_data_revision(geo_layer.pk)
+    wizard_config = {
+        key: value
+        for key, value in config.items()
+        if key not in ("map_style", "fingerprint")
+    }
+    return md5(
+        json.dumps(
+            [geo_layer.pk, revision, wizard_config],
+            sort_keys=True,
+            cls=DjangoJSONEncoder,
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def get_wizard_statistics_requests(config):
+    """
+    Return the field statistics needed to generate a style from a wizard
+    setting, as accepted by `StatisticsContext.prefetch`.
+    """
+    map_style_type = config["map_style_type"]
+    requests = set()
+
+    for map_field, prop_config in config["style"].items():
+        # Ignore style from other representation
+        if prop_config.get("type") != "variable" or not map_field.replace(
+            "fill_extrusion", "extrusion"
+        ).startswith(map_style_type.replace("fill-extrusion", "extrusion")):
+            continue
+
+        data_field = prop_config["field"]
+        analysis = prop_config["analysis"]
+        if analysis == "proportionnal":
+            requests.add(("statistics", data_field))
+        elif (
+            analysis == "graduated"
+            and "boundaries" not in prop_config
+            and "method" in prop_config
+        ):
+            if prop_config["method"] in STATISTICS_METHODS:
+                # Computed from field statistics
+                requests.add(("statistics", data_field))
+            else:
+                requests.add(
+                    (
+                        "discretize",
+                        data_field,
+                        prop_config["method"],
+                        len(prop_config["values"]),
+                    )
+                )
+
+    return requests
+
+
+def generate_style_from_wizard(geo_layer, config, stats=None):
     """
     Return a Mapbox GL Style and a Legend from a wizard setting.
+    `stats` is a StatisticsContext to share field statistics with other wizards.
     """
+    stats = stats or StatisticsContext()
 
     # fill, fill_extrusion, line, text, symbol, circle
     map_style_type = config["map_style_type"]
@@ -112,12 +183,23 @@ def generate_style_from_wizard(geo_layer, config):
             variation_type = field_2_variation_type(map_field)
             analysis = prop_config["analysis"]
 
+            if analysis == "graduated" and "boundaries" not in prop_config:
+                method = prop_config.get("method")
+                effective_method = stats.get_discretize_method(
+                    geo_layer, data_field, method
+                )
+                if effective_method != method:
+                    # Boundaries are approximated, unlike asked by the wizard
+                    map_style.setdefault("metadata", {}).setdefault(
+                        "discretize_methods", {}
+                    )[map_field] = effective_method
+
             if variation_type == "color":
                 if analysis == "graduated":
                     map_style.setdefault(paint_or_layout, {})[
                         map_style_prop
                     ] = gen_graduated_color_style(
-                        geo_layer, data_field, map_field, prop_config
+                        geo_layer, data_field, map_field, prop_config, stats
                     )
                     if prop_config.get("generate_legend"):
                         legend = gen_graduated_color_legend(
@@ -126,9 +208,9 @@ def generate_style_from_wizard(geo_layer, config):
                             map_style_type,
                             prop_config,
                             style_type_2_legend_property(map_field),
+                            stats=stats,
                         )
                         legend["uid"] = f"{suid}__{map_field}"
-                        # TODO reuse previous computations
                         legends.append(legend)
                 elif analysis == "categorized":
                     map_style.setdefault(paint_or_layout, {})[
@@ -187,7 +269,7 @@ def generate_style_from_wizard(geo_layer, config):
                     map_style.setdefault(paint_or_layout, {})[
                         map_style_prop
                     ] = gen_proportionnal_radius_style(
-                        geo_layer, data_field, map_field, prop_config
+                        geo_layer, data_field, map_field, prop_config, stats
                     )
                     # Add sort key
                     # TODO find more smart way to do that
@@ -195,7 +277,6 @@ def generate_style_from_wizard(geo_layer, config):
                         f"{map_style_type}-sort-key": ["-", ["get", data_field]]
                     }
                     if prop_config.get("generate_legend"):
-                        # TODO reuse previous computations
                         color = (
                             config["style"]
                             .get(f"{map_style_type}_color", {})
@@ -213,6 +294,7 @@ def generate_style_from_wizard(geo_layer, config):
                             prop_config,
                             color,
                             no_value_color,
+                            stats=stats,
                         )
                         legend["uid"] = f"{suid}__{map_field}"
                         legends.append(legend)
@@ -224,10 +306,9 @@ def generate_style_from_wizard(geo_layer, config):
                     map_style.setdefault(paint_or_layout, {})[
                         map_style_prop
                     ] = gen_graduated_size_style(
-                        geo_layer, data_field, map_field, prop_config
+                        geo_layer, data_field, map_field, prop_config, stats
                     )
                     if prop_config.get("generate_legend"):
-                        # TODO reuse previous computations
                         color = (
                             config["style"]
                             .get(f"{map_style_type}_color", {})
@@ -246,6 +327,7 @@ def generate_style_from_wizard(geo_layer, config):
                             color,
                             no_value_color,
                             style_type_2_legend_property(map_field),
+                            stats=stats,
                         )
                         legend["uid"] = f"{suid}__{map_field}"
                         legends.append(legend)
@@ -281,10 +363,9 @@ def generate_style_from_wizard(geo_layer, config):
                     map_style.setdefault(paint_or_layout, {})[
                         map_style_prop
                     ] = gen_proportionnal_size_style(
-                        geo_layer, data_field, map_field, prop_config
+                        geo_layer, data_field, map_field, prop_config, stats
                     )
                     if prop_config.get("generate_legend"):
-                        # TODO reuse previous computations
                         color = (
                             config["style"]
                             .get(f"{map_style_type}_color", {})
@@ -303,6 +384,7 @@ def generate_style_from_wizard(geo_layer, config):
                             color,
                             no_value_color,
                             style_type_2_legend_property(map_field),
+                            stats=stats,
                         )
                         legend["uid"] = f"{suid}__{map_field}"
                         legends.append(legend)
@@ -1,5 +1,5 @@
+from .statistics import StatisticsContext
 from .utils import (
-    discretize,
     gen_style_steps,
     get_style_no_value_condition,
     style_type_2_legend_shape,
@@ -40,7 +40,10 @@ def gen_color_legend_steps(boundaries, colors, no_value_color, legend_field="col
     return ret
 
 
-def gen_graduated_color_style(geo_layer, data_field, map_field, prop_config):
+def gen_graduated_color_style(
+    geo_layer, data_field, map_field, prop_config, stats=None
+):
+    stats = stats or StatisticsContext()
     colors = prop_config["values"]
     no_value = prop_config.get("no_value")
 
@@ -50,7 +53,7 @@ def gen_graduated_color_style(geo_layer, data_field, map_field, prop_config):
         if len(boundaries) < 2:
             raise ValueError('"boundaries" must be at least a list of two values')
     elif "method" in prop_config:
-        boundaries = discretize(
+        boundaries = stats.discretize(
             geo_layer, data_field, prop_config["method"], len(colors)
         )
     else:
@@ -74,8 +77,9 @@ def gen_graduated_color_style(geo_layer, data_field, map_field, prop_config):
 
 
 def gen_graduated_color_legend(
-    geo_layer, data_field, map_style_type, prop_config, legend_field
+    geo_layer, data_field, map_style_type, prop_config, legend_field, stats=None
 ):
+    stats = stats or StatisticsContext()
     colors = prop_config["values"]
     no_value = prop_config.get("no_value")
 
@@ -83,7 +87,7 @@ def gen_graduated_color_legend(
     if "boundaries" in prop_config:
         boundaries = prop_config["boundaries"]
     elif "method" in prop_config:
-        boundaries = discretize(
+        boundaries = stats.discretize(
             geo_layer, data_field, prop_config["method"], len(colors)
         )
 
@@ -0,0 +1,124 @@
+try:
+    import numpy as np
+except ImportError:  # numpy is optional
+    np = None
+
+from terra_layer.settings import DEFAULT_JENKS_MAX_VALUES, DEFAULT_JENKS_SAMPLE_SIZE
+
+from .utils import get_field_statistics, get_value_histogram
+
+
+def group_histogram(values, counts, max_values):
+    """
+    Merge consecutive values of a histogram into at most `max_values` groups
+    of about the same number of occurrences.
+    Return start index of each group, with occurrences, sum and sum of squares
+    of their values.
+    """
+    weights = counts.astype(float)
+    if len(values) > max_values:
+        group_ids = np.floor(
+            (np.cumsum(weights) - weights) * max_values / weights.sum()
+        ).astype(int)
+        _, starts = np.unique(group_ids, return_index=True)
+    else:
+        starts = np.arange(len(values))
+
+    return (
+        starts,
+        np.add.reduceat(weights, starts),
+        np.add.reduceat(weights * values, starts),
+        np.add.reduceat(weights * values**2, starts),
+    )
+
+
+def fisher_jenks_breaks(weights, sums, squares, class_count):
+    """
+    Return start index of each class of the optimal partition of sorted
+    weighted values in `class_count` classes, minimizing the sum of squared
+    deviations from class means (Fisher-Jenks dynamic program).
+    Values are given as their weights, weighted sums and weighted sums of squares.
+    """
+    n = len(weights)
+    W = np.concatenate([[0.0], np.cumsum(weights)])
+    S = np.concatenate([[0.0], np.cumsum(sums)])
+    Q = np.concatenate([[0.0], np.cumsum(squares)])
+
+    def cost(starts, end):
+        # Sum of squared deviations of values from starts to end (included)
+        w = W[end + 1] - W[starts]
+        s = S[end + 1] - S[starts]
+        return (Q[end + 1] - Q[starts]) - s * s / w
+
+    # Cost of the best partition of values up to i in m + 1 classes
+    previous = cost(np.zeros(n, dtype=int), np.arange(n))
+    backtrack = np.zeros((class_count, n), dtype=int)
+
+    for m in range(1, class_count):
+        current = np.full(n, np.inf)
+        for i in range(m, n):
+            starts = np.arange(m, i + 1)
+            candidates = previous[starts - 1] + cost(starts, i)
+            best = np.argmin(candidates)
+            current[i] = candidates[best]
+            backtrack[m, i] = starts[best]
+        previous = current
+
+    class_starts = []
+    end = n - 1
+    for m in range(class_count - 1, 0, -1):
+        start = backtrack[m, end]
+        class_starts.append(start)
+        end = start - 1
+    return [0, *[int(start) for start in reversed(class_starts)]]
+
+
+def discretize_fisher_jenks(
+    geo_layer,
+    field,
+    class_count,
+    statistics=None,
+    sample_size=None,
+    max_values=None,
+):
+    """
+    Compute exact Jenks natural breaks class boundaries from a layer property.
+    Distinct values are fetched once with their occurrences, then classified
+    in Python, deterministically. Null values are ignored.
+
+    Properties with more values than `sample_size` are classified from
+    sampled features of the layer, the same ones as long as data are
+    unchanged, and above `max_values` distinct values, consecutive values are
+    merged, so boundaries are then approximated. First and last boundaries are always the exact min and max.
+    """
+    if np is None:
+        raise ValueError('"fisher_jenks" discretize method requires numpy')
+
+    statistics = statistics or get_field_statistics(geo_layer, field)
+    sample_size = sample_size or DEFAULT_JENKS_SAMPLE_SIZE
+    max_values = max_values or DEFAULT_JENKS_MAX_VALUES
+
+    if not statistics["count"]:
+        # Same as discretize_jenks: None without features, [] with null values only
+        return [] if statistics["is_null"] else None
+
+    histogram = get_value_histogram(
+        geo_layer, field, sample_size=sample_size, count=statistics["count"]
+    )
+    if not histogram:
+        return [statistics["min"], statistics["max"]]
+
+    values = np.array([float(value) for value, _ in histogram])
+    counts = np.array([count for _, count in histogram])
+
+    starts, weights, sums, squares = group_histogram(values, counts, max_values)
+    class_starts = fisher_jenks_breaks(
+        weights, sums, squares, min(class_count, len(starts))
+    )
+
+    # Each class start + last class end
+    return [
+        statistics["min"],
+        *[values[starts[start]].item() for start in class_starts[1:]],
+        statistics["max"],
+    ]
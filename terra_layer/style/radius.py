@@ -3,9 +3,9 @@ from terra_layer.settings import (
     DEFAULT_CIRCLE_MIN_LEGEND_HEIGHT,
 )
 
+from .statistics import StatisticsContext
 from .utils import (
     get_style_no_value_condition,
-    get_positive_min_max,
     gen_style_interpolate,
     boundaries_round,
     circle_boundaries_candidate,
@@ -53,13 +53,16 @@ def gen_proportionnal_radius_legend_items(
     return ret
 
 
-def gen_proportionnal_radius_style(geo_layer, data_field, map_field, prop_config):
+def gen_proportionnal_radius_style(
+    geo_layer, data_field, map_field, prop_config, stats=None
+):
+    stats = stats or StatisticsContext()
     field_getter = ["get", data_field]
     max_value = prop_config["max_radius"]
     no_value = prop_config.get("no_value")
 
     # Get min max value
-    mm = get_positive_min_max(geo_layer, data_field)
+    mm = stats.get_positive_min_max(geo_layer, data_field)
 
     if mm[1] is not None and mm[2] is not None:
         mm = boundaries_round(mm[1:])
@@ -79,13 +82,20 @@ def gen_proportionnal_radius_style(geo_layer, data_field, map_field, prop_config
 
 
 def gen_proportionnal_radius_legend(
-    geo_layer, data_field, map_style_type, prop_config, color, no_value_color
+    geo_layer,
+    data_field,
+    map_style_type,
+    prop_config,
+    color,
+    no_value_color,
+    stats=None,
 ):
+    stats = stats or StatisticsContext()
     no_value_size = prop_config.get("no_value")
     max_value = prop_config["max_radius"]
 
     # Get min max value
-    mm = get_positive_min_max(geo_layer, data_field)
+    mm = stats.get_positive_min_max(geo_layer, data_field)
 
     if mm[1] is not None and mm[2] is not None:
         mm = boundaries_round(mm[1:])
@@ -2,11 +2,10 @@ from terra_layer.settings import (
     DEFAULT_SIZE_MIN_LEGEND_HEIGHT,
 )
 
+from .statistics import StatisticsContext
 from .utils import (
-    discretize,
     gen_style_steps,
     get_style_no_value_condition,
-    get_positive_min_max,
     gen_style_interpolate,
     boundaries_round,
     size_boundaries_candidate,
@@ -85,7 +84,8 @@ def gen_proportionnal_size_legend_items(
     return ret
 
 
-def gen_graduated_size_style(geo_layer, data_field, map_field, prop_config):
+def gen_graduated_size_style(geo_layer, data_field, map_field, prop_config, stats=None):
+    stats = stats or StatisticsContext()
     values = prop_config["values"]
     no_value = prop_config.get("no_value")
 
@@ -95,7 +95,7 @@ def gen_graduated_size_style(geo_layer, data_field, map_field, prop_config):
         if len(boundaries) < 2:
             raise ValueError('"boundaries" must be at least a list of two values')
     elif "method" in prop_config:
-        boundaries = discretize(
+        boundaries = stats.discretize(
             geo_layer, data_field, prop_config["method"], len(values)
         )
     else:
@@ -126,7 +126,9 @@ def gen_graduated_size_legend(
     color,
     no_value_color,
     legend_field,
+    stats=None,
 ):
+    stats = stats or StatisticsContext()
     values = prop_config["values"]
     no_value = prop_config.get("no_value")
 
@@ -134,7 +136,7 @@ def gen_graduated_size_legend(
     if "boundaries" in prop_config:
         boundaries = prop_config["boundaries"]
     elif "method" in prop_config:
-        boundaries = discretize(
+        boundaries = stats.discretize(
             geo_layer, data_field, prop_config["method"], len(values)
         )
 
@@ -161,13 +163,16 @@ def gen_graduated_size_legend(
         }
 
 
-def gen_proportionnal_size_style(geo_layer, data_field, map_field, prop_config):
+def gen_proportionnal_size_style(
+    geo_layer, data_field, map_field, prop_config, stats=None
+):
+    stats = stats or StatisticsContext()
     field_getter = ["get", data_field]
     max_value = prop_config["max_value"]
     no_value = prop_config.get("no_value")
 
     # Get min max value
-    mm = get_positive_min_max(geo_layer, data_field)
+    mm = stats.get_positive_min_max(geo_layer, data_field)
 
     if mm[1] is not None and mm[2] is not None:
         mm = boundaries_round(mm[1:])
@@ -193,12 +198,14 @@ def gen_proportionnal_size_legend(
     color,
     no_value_color,
     legend_field,
+    stats=None,
 ):
+    stats = stats or StatisticsContext()
     no_value_size = prop_config.get("no_value")
     max_value = prop_config["max_value"]
 
     # Get min max value
-    mm = get_positive_min_max(geo_layer, data_field)
+    mm = stats.get_positive_min_max(geo_layer, data_field)
 
     if mm[1] is not None and mm[2] is not None:
         mm = boundaries_round(mm[1:])
@@ -0,0 +1,253 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import md5
+
+from django.core.cache import cache
+from django.db import connection
+
+from terra_layer.settings import (
+    DEFAULT_QUANTILE_SAMPLE_THRESHOLD,
+    DEFAULT_STATISTICS_CACHE_TIMEOUT,
+    DEFAULT_STATISTICS_WORKERS,
+)
+from terra_layer.utils import get_layer_data_revision
+
+from .jenks import discretize_fisher_jenks
+from .utils import (
+    discretize_approx_quantile,
+    discretize_head_tail,
+    discretize_jenks,
+    discretize_quantile,
+    equal_interval_boundaries,
+    estimate_feature_count,
+    geometric_interval_boundaries,
+    get_binned_histogram,
+    get_field_statistics,
+    standard_deviation_boundaries,
+)
+
+DISCRETIZE_METHODS = (
+    "quantile",
+    "approx_quantile",
+    "jenks",
+    "fisher_jenks",
+    "equal_interval",
+    "standard_deviation",
+    "geometric_interval",
+    "head_tail",
+)
+
+# Discretize methods only depending on field statistics
+STATISTICS_METHODS = ("equal_interval", "standard_deviation", "geometric_interval")
+
+
+class StatisticsContext:
+    """
+    Share field statistics between every style and legend generated from
+    wizards during a single save.
+
+    Each (layer, field) pair is scanned once for its min/max statistics, and
+    each discretization is computed once whatever the number of styles and
+    legends needing it.
+
+    Results are also stored in the Django cache, keyed by the geostore layer
+    data revision, so later saves skip the queries as long as the layer
+    features are left untouched.
+    """
+
+    def __init__(self, timeout=DEFAULT_STATISTICS_CACHE_TIMEOUT):
+        self.timeout = timeout
+        self._revisions = {}
+        self._statistics = {}
+        self._boundaries = {}
+        self._feature_counts = {}
+
+    def get_revision(self, geo_layer):
+        if geo_layer.pk not in self._revisions:
+            self._revisions[geo_layer.pk] = get_layer_data_revision(geo_layer.pk)
+        return self._revisions[geo_layer.pk]
+
+    def get_cache_key(self, geo_layer, field, *extras):
+        revision = self.get_revision(geo_layer)
+        field_hash = md5(field.encode("utf-8")).hexdigest()
+        extras_joined = "-".join(str(extra) for extra in extras)
+        return (
+            f"terra-layer-stats-{geo_layer.pk}-{revision}-{field_hash}-{extras_joined}"
+        )
+
+    def _cached(self, cache_key, compute):
+        if not self.timeout:
+            return compute()
+
+        value = cache.get(cache_key)
+        if value is None:
+            value = {"value": compute()}
+            cache.set(cache_key, value, self.timeout)
+        return value["value"]
+
+    def get_field_statistics(self, geo_layer, field):
+        key = (geo_layer.pk, field)
+        if key not in self._statistics:
+            self._statistics[key] = self._cached(
+                self.get_cache_key(geo_layer, field, "field-statistics"),
+                lambda: get_field_statistics(geo_layer, field),
+            )
+        return self._statistics[key]
+
+    def get_min_max(self, geo_layer, field):
+        """
+        Same as `utils.get_min_max` using shared statistics.
+        """
+        statistics = self.get_field_statistics(geo_layer, field)
+        return [statistics["is_null"], statistics["min"], statistics["max"]]
+
+    def get_positive_min_max(self, geo_layer, field):
+        """
+        Same as `utils.get_positive_min_max` using shared statistics.
+        """
+        statistics = self.get_field_statistics(geo_layer, field)
+        return [False, statistics["positive_min"], statistics["positive_max"]]
+
+    def get_histogram(self, geo_layer, field, bins):
+        """
+        Return the number of values of a field in `bins` intervals of the
+        same width between its min and max.
+        """
+        statistics = self.get_field_statistics(geo_layer, field)
+        return self._cached(
+            self.get_cache_key(geo_layer, field, "histogram", bins),
+            lambda: get_binned_histogram(
+                geo_layer,
+                field,
+                statistics["min"],
+                statistics["max"],
+                bins,
+                count=statistics["count"],
+            ),
+        )
+
+    def discretize(self, geo_layer, field, method, class_count):
+        """
+        Same as `utils.discretize` using shared statistics.
+        """
+        method = self.get_discretize_method(geo_layer, field, method)
+        key = (geo_layer.pk, field, method, class_count)
+        if key not in self._boundaries:
+            if method in STATISTICS_METHODS:
+                # Cheap to compute from already shared statistics
+                self._boundaries[key] = self._discretize(
+                    geo_layer, field, method, class_count
+                )
+            else:
+                self._boundaries[key] = self._cached(
+                    self.get_cache_key(geo_layer, field, method, class_count),
+                    lambda: self._discretize(geo_layer, field, method, class_count),
+                )
+        return self._boundaries[key]
+
+    def prefetch(self, geo_layer, requests, workers=DEFAULT_STATISTICS_WORKERS):
+        """
+        Compute concurrently field statistics of a geostore layer, so that
+        styles generated afterwards are only bounded by the slowest query.
+
+        :param requests: ("statistics", field) or
+            ("discretize", field, method, class_count) tuples
+
+        Each thread queries through its own database connection, which does
+        not see uncommitted data. Inside a transaction, statistics are only
+        computed concurrently when the transaction did not change the layer
+        features, as when layers are saved.
+        """
+        pending = [
+            request
+            for request in set(requests)
+            if (geo_layer.pk, *request[1:]) not in self._statistics
+            and (geo_layer.pk, *request[1:]) not in self._boundaries
+        ]
+        if workers <= 1 or len(pending) <= 1:
+            return
+
+        # Revision is fetched once, before threads would compete for it
+        revision = self.get_revision(geo_layer)
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            if (
+                connection.in_atomic_block
+                and executor.submit(self._get_committed_revision, geo_layer).result()
+                != revision
+            ):
+                # Features changed by the transaction are left to this connection
+                return
+            list(executor.map(partial(self._prefetch, geo_layer), pending))
+
+    def _get_committed_revision(self, geo_layer):
+        try:
+            return get_layer_data_revision(geo_layer.pk)
+        finally:
+            connection.close()
+
+    def _prefetch(self, geo_layer, request):
+        try:
+            if request[0] == "statistics":
+                self.get_field_statistics(geo_layer, request[1])
+            else:
+                self.discretize(geo_layer, *request[1:])
+        except Exception:
+            # Raised again when the style is generated
+            pass
+        finally:
+            # Each worker thread owns its database connection
+            connection.close()
+
+    def get_discretize_method(self, geo_layer, field, method):
+        """
+        Return the method actually used to discretize a field: "quantile" is
+        approximated on layers with more features than the
+        `quantile_sample_threshold` setting, as estimated by the database.
+        """
+        if method == "quantile" and DEFAULT_QUANTILE_SAMPLE_THRESHOLD is not None:
+            if geo_layer.pk not in self._feature_counts:
+                self._feature_counts[geo_layer.pk] = estimate_feature_count(geo_layer)
+            if self._feature_counts[geo_layer.pk] > DEFAULT_QUANTILE_SAMPLE_THRESHOLD:
+                return "approx_quantile"
+        return method
+
+    def _discretize(self, geo_layer, field, method, class_count):
+        if method == "quantile":
+            return discretize_quantile(geo_layer, field, class_count)
+        elif method == "approx_quantile":
+            # Sampled without scanning the whole layer for statistics first
+            return discretize_approx_quantile(
+                geo_layer,
+                field,
+                class_count,
+                statistics=self._statistics.get((geo_layer.pk, field)),
+            )
+        elif method == "jenks":
+            return discretize_jenks(geo_layer, field, class_count)
+        elif method == "fisher_jenks":
+            return discretize_fisher_jenks(
+                geo_layer,
+                field,
+                class_count,
+                statistics=self.get_field_statistics(geo_layer, field),
+            )
+        elif method == "equal_interval":
+            is_null, min, max = self.get_min_max(geo_layer, field)
+            return equal_interval_boundaries(min, max, class_count)
+        elif method == "standard_deviation":
+            return standard_deviation_boundaries(
+                self.get_field_statistics(geo_layer, field), class_count
+            )
+        elif method == "geometric_interval":
+            is_null, min, max = self.get_min_max(geo_layer, field)
+            return geometric_interval_boundaries(min, max, class_count)
+        elif method == "head_tail":
+            return discretize_head_tail(
+                geo_layer,
+                field,
+                class_count,
+                statistics=self.get_field_statistics(geo_layer, field),
+            )
+        else:
+            raise ValueError(f'Unknow discretize method "{method}"')
@@ -3,6 +3,8 @@ import numbers
 import math
 from functools import reduce
 
+from terra_layer.settings import DEFAULT_QUANTILE_SAMPLE_SIZE
+
 style_type_2_legend_shape = {
     "fill-extrusion": "square",
     "fill": "square",
@@ -81,6 +83,57 @@ def get_positive_min_max(geo_layer, field):
         return [is_null == True, min, max]  # noqa
 
 
+def get_field_statistics(geo_layer, field):
+    """
+    Return null presence, count, min, max, mean and standard deviation of non
+    null values of a property, along with min and max of its strictly positive
+    values, computed in a single scan.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT
+                bool_or(value IS NULL) AS is_null,
+                count(value) AS count,
+                min(value) AS min,
+                max(value) AS max,
+                avg(value) AS mean,
+                stddev_pop(value) AS stddev,
+                min(value) FILTER (WHERE value > 0) AS positive_min,
+                max(value) FILTER (WHERE value > 0) AS positive_max
+            FROM (
+                SELECT
+                    (properties->>%(field)s)::numeric AS value
+                FROM
+                    geostore_feature
+                WHERE
+                    layer_id = %(layer_id)s
+            ) AS feature
+            """,
+            {"field": field, "layer_id": geo_layer.id},
+        )
+        (
+            is_null,
+            count,
+            min,
+            max,
+            mean,
+            stddev,
+            positive_min,
+            positive_max,
+        ) = cursor.fetchone()
+        return {
+            "is_null": is_null == True,  # noqa
+            "count": count,
+            "min": min,
+            "max": max,
+            "mean": mean,
+            "stddev": stddev,
+            "positive_min": positive_min,
+            "positive_max": positive_max,
+        }
+
+
 def discretize_quantile(geo_layer, field, class_count):
     """
     Compute Quantile class boundaries from a layer property.
@@ -129,6 +182,212 @@ def discretize_quantile(geo_layer, field, class_count):
                 return [r[0] for r in rows] + [rows[-1][1]]
 
 
+def estimate_feature_count(geo_layer):
+    """
+    Return the number of features of a layer estimated by the query planner,
+    without reading them.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "EXPLAIN (FORMAT JSON) SELECT 1 FROM geostore_feature WHERE layer_id = %s",
+            [geo_layer.id],
+        )
+        return cursor.fetchone()[0][0]["Plan"]["Plan Rows"]
+
+
+def get_feature_sample(count, sample_size):
+    """
+    Return the table sample clause, the filter condition and their params
+    selecting about `sample_size` of the `count` features of a layer. Selected
+    features stay the same as long as data are unchanged, so results computed
+    from them can be reused.
+
+    Pages of the whole features table are sampled when reading them costs
+    less than reading every feature of the layer, otherwise features of the
+    layer are selected from a hash of their identifier.
+    """
+    fraction = sample_size / count
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples FROM pg_class WHERE oid = 'geostore_feature'::regclass"
+        )
+        table_count = cursor.fetchone()[0]
+
+    if 0 < fraction * table_count < count:
+        return (
+            "TABLESAMPLE SYSTEM (%(sample_percent)s) REPEATABLE (0)",
+            "TRUE",
+            {"sample_percent": 100 * fraction},
+        )
+    return (
+        "",
+        "hashtext(identifier)::bigint + 2147483648 < %(sample_limit)s",
+        {"sample_limit": fraction * 2**32},
+    )
+
+
+def discretize_approx_quantile(
+    geo_layer, field, class_count, statistics=None, sample_size=None
+):
+    """
+    Compute approximate Quantile class boundaries from a sample of a layer property.
+    Inner boundaries are percentiles of about `sample_size` values of sampled
+    features of the layer, the same ones as long as data are unchanged. Null
+    values are ignored. Properties with fewer values than the sample size are
+    computed exactly.
+    With `statistics`, first and last boundaries are their min and max.
+    Otherwise the number of features is estimated by the query planner, and
+    min and max are the exact ones when every feature of the layer is read,
+    those of the sample when only pages of the table are.
+    """
+    sample_size = sample_size or DEFAULT_QUANTILE_SAMPLE_SIZE
+    count = statistics["count"] if statistics else estimate_feature_count(geo_layer)
+
+    if count <= sample_size:
+        return discretize_quantile(geo_layer, field, class_count)
+
+    tablesample, sample, params = get_feature_sample(count, sample_size)
+    min_max = "min(value), max(value)" if statistics is None else "NULL, NULL"
+    if statistics is None and not tablesample:
+        # Every feature of the layer is read, exact min and max along with
+        # the sample
+        percentile_sample, feature_sample = "FILTER (WHERE sampled)", "TRUE"
+    else:
+        # Only sampled features are read
+        percentile_sample, feature_sample = "", sample
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT
+                {min_max},
+                percentile_disc(%(fractions)s::float8[]) WITHIN GROUP (ORDER BY value) {percentile_sample}
+            FROM (
+                SELECT
+                    (properties->>%(field)s)::numeric AS value,
+                    {sample} AS sampled
+                FROM
+                    geostore_feature {tablesample}
+                WHERE
+                    layer_id = %(layer_id)s AND {feature_sample}
+            ) AS feature
+            WHERE
+                value IS NOT NULL
+            """,
+            {
+                "field": field,
+                "fractions": [i / class_count for i in range(1, class_count)],
+                "layer_id": geo_layer.id,
+                **params,
+            },
+        )
+        min, max, percentiles = cursor.fetchone()
+
+    if percentiles is None:
+        # No value sampled
+        return discretize_quantile(geo_layer, field, class_count)
+
+    if statistics is not None:
+        min, max = statistics["min"], statistics["max"]
+
+    # Each class start + last class end
+    return [min, *percentiles, max]
+
+
+def get_value_histogram(geo_layer, field, sample_size=None, count=None):
+    """
+    Return distinct non null values of a layer property, sorted, along with
+    their number of occurrences. With `sample_size` lower than the `count` of
+    features, only about this number of sampled features of the layer are
+    read, the same ones as long as data are unchanged.
+    """
+    tablesample, sample, params = "", "TRUE", {}
+    if sample_size is not None and count and count > sample_size:
+        tablesample, sample, params = get_feature_sample(count, sample_size)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT
+                value,
+                count(*) AS count
+            FROM (
+                SELECT
+                    (properties->>%(field)s)::numeric AS value
+                FROM
+                    geostore_feature {tablesample}
+                WHERE
+                    layer_id = %(layer_id)s AND {sample}
+            ) AS feature
+            WHERE
+                value IS NOT NULL
+            GROUP BY
+                value
+            ORDER BY
+                value
+            """,
+            {"field": field, "layer_id": geo_layer.id, **params},
+        )
+        return cursor.fetchall()
+
+
+def get_binned_histogram(geo_layer, field, min, max, bins, count=None):
+    """
+    Return the number of non null values of a layer property in each of
+    `bins` intervals of the same width between min and max.
+    `count` of non null values, when already known, spares a query when
+    min and max are equal.
+    """
+    if min is None or max is None:
+        return []
+
+    if min == max:
+        bins = 1
+        if count is None:
+            count = get_field_statistics(geo_layer, field)["count"]
+        counts = [count]
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT
+                    least(width_bucket(value, %(min)s, %(max)s, %(bins)s), %(bins)s) AS bucket,
+                    count(*) AS count
+                FROM (
+                    SELECT
+                        (properties->>%(field)s)::numeric AS value
+                    FROM
+                        geostore_feature
+                    WHERE
+                        layer_id = %(layer_id)s
+                ) AS feature
+                WHERE
+                    value IS NOT NULL
+                GROUP BY
+                    bucket
+                """,
+                {
+                    "field": field,
+                    "min": min,
+                    "max": max,
+                    "bins": bins,
+                    "layer_id": geo_layer.id,
+                },
+            )
+            buckets = dict(cursor.fetchall())
+        counts = [buckets.get(bucket, 0) for bucket in range(1, bins + 1)]
+
+    width = (max - min) / bins
+    return [
+        {
+            "lower": min + width * index,
+            "upper": max if index == bins - 1 else min + width * (index + 1),
+            "count": count,
+        }
+        for index, count in enumerate(counts)
+    ]
+
+
 def discretize_jenks(geo_layer, field, class_count):
     """
     Compute Jenks class boundaries from a layer property.
@@ -178,6 +437,13 @@ def discretize_equal_interval(geo_layer, field, class_count):
     Compute QuantiEqual Interval class boundaries from a layer property.
     """
     is_null, min, max = get_min_max(geo_layer, field)
+    return equal_interval_boundaries(min, max, class_count)
+
+
+def equal_interval_boundaries(min, max, class_count):
+    """
+    Compute Equal Interval class boundaries from known min and max values.
+    """
     if min is not None and max is not None and isinstance(min, numbers.Number):
         delta = (max - min) / class_count
         return [min + delta * i for i in range(0, class_count + 1)]
@@ -185,6 +451,84 @@ def discretize_equal_interval(geo_layer, field, class_count):
         return None
 
 
+def standard_deviation_boundaries(statistics, class_count):
+    """
+    Compute Standard Deviation class boundaries from known field statistics:
+    classes are one standard deviation wide, centered on the mean. Classes
+    beyond min and max are dropped.
+    """
+    if statistics["min"] is None or statistics["max"] is None:
+        return None
+
+    min, max = float(statistics["min"]), float(statistics["max"])
+    mean, stddev = float(statistics["mean"]), float(statistics["stddev"])
+    breaks = [
+        mean + (index - class_count / 2) * stddev for index in range(1, class_count)
+    ]
+    return [min, *[b for b in breaks if min < b < max], max]
+
+
+def geometric_interval_boundaries(min, max, class_count):
+    """
+    Compute Geometric Interval class boundaries from known min and max values:
+    each class is wider than the previous one by a constant ratio. Values are
+    shifted to be strictly positive when needed.
+    """
+    if min is None or max is None or not isinstance(min, numbers.Number):
+        return None
+
+    min, max = float(min), float(max)
+    offset = 1 - min if min <= 0 else 0
+    ratio = ((max + offset) / (min + offset)) ** (1 / class_count)
+    return [(min + offset) * ratio**i - offset for i in range(0, class_count)] + [max]
+
+
+def head_tail_boundaries(histogram, class_count, head_ratio=0.4):
+    """
+    Compute Head/Tail Breaks class boundaries from a histogram of values, for
+    heavy-tailed distributions: values are split around their mean, then the
+    head, values above the mean, is split again while it holds less than
+    `head_ratio` of values, up to `class_count` classes.
+    """
+    if not histogram:
+        return []
+
+    values = [float(value) for value, _ in histogram]
+    counts = [count for _, count in histogram]
+    boundaries = [values[0]]
+
+    start = 0
+    while len(boundaries) < class_count:
+        total = sum(counts[start:])
+        mean = sum(v * c for v, c in zip(values[start:], counts[start:])) / total
+        # First value of the head, above the mean
+        head = next((i for i in range(start, len(values)) if values[i] > mean), None)
+        if head is None or sum(counts[head:]) / total > head_ratio:
+            break
+        boundaries.append(mean)
+        start = head
+
+    return boundaries + [values[-1]]
+
+
+def discretize_head_tail(
+    geo_layer, field, class_count, statistics=None, head_ratio=0.4
+):
+    """
+    Compute Head/Tail Breaks class boundaries from a layer property. Its
+    sorted distinct values are read in a single query, successive head means
+    are computed from them in Python.
+    """
+    histogram = get_value_histogram(geo_layer, field)
+    if not histogram:
+        # None without features, [] with null values only
+        is_null = (
+            statistics["is_null"] if statistics else get_min_max(geo_layer, field)[0]
+        )
+        return [] if is_null else None
+    return head_tail_boundaries(histogram, class_count, head_ratio)
+
+
 def discretize(geo_layer, field, method, class_count):
     """
     Select a method to compute class boundaries.
@@ -193,10 +537,26 @@ def discretize(geo_layer, field, method, class_count):
     """
     if method == "quantile":
         return discretize_quantile(geo_layer, field, class_count)
+    elif method == "approx_quantile":
+        return discretize_approx_quantile(geo_layer, field, class_count)
     elif method == "jenks":
         return discretize_jenks(geo_layer, field, class_count)
+    elif method == "fisher_jenks":
+        # Imported here as jenks module depends on this one
+        from .jenks import discretize_fisher_jenks
+
+        return discretize_fisher_jenks(geo_layer, field, class_count)
     elif method == "equal_interval":
         return discretize_equal_interval(geo_layer, field, class_count)
+    elif method == "standard_deviation":
+        return standard_deviation_boundaries(
+            get_field_statistics(geo_layer, field), class_count
+        )
+    elif method == "geometric_interval":
+        is_null, min, max = get_min_max(geo_layer, field)
+        return geometric_interval_boundaries(min, max, class_count)
+    elif method == "head_tail":
+        return discretize_head_tail(geo_layer, field, class_count)
     else:
         raise ValueError(f'Unknow discretize method "{method}"')
 
@@ -1,4 +1,5 @@
 import factory
+from django_geosource.models import PostGISSource
 
 from ..models import Scene, Layer
 
@@ -13,3 +14,15 @@ class SceneFactory(factory.django.DjangoModelFactory):
 class LayerFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = Layer
+
+
+class PostGISSourceFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = PostGISSource
+
+    name = factory.Sequence(lambda n: f"source_{n}")
+    db_name = "test"
+    db_password = "test"
+    db_host = "localhost"
+    geom_type = 1
+    refresh = -1
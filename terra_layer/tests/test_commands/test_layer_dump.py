@@ -64,6 +64,25 @@ class LayerDumpTestCase(TestCase):
             },
         )
 
+    def test_command_launch_ndjson(self):
+        layers = [
+            Layer.objects.create(source=self.source, name=f"layer_{index}")
+            for index in range(3)
+        ]
+        out = StringIO()
+        call_command("layer_dump", ndjson=True, chunk_size=2, stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(
+            [json.loads(line)["uuid"] for line in lines],
+            [str(layer.uuid) for layer in layers],
+        )
+        self.assertEqual(json.loads(lines[0])["source"], "test_view")
+
+        out = StringIO()
+        call_command("layer_dump", ndjson=True, sources=["other"], stdout=out)
+        self.assertEqual(out.getvalue(), "")
+
     def test_command_fail(self):
         with self.assertRaisesRegexp(CommandError, "Layer does not exist"):
             call_command("layer_dump", pk=999)
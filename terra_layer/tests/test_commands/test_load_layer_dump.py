@@ -1,4 +1,8 @@
+import json
 import os
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest import mock
 
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
@@ -93,3 +97,171 @@ class LayerDumpTestCase(TestCase):
                 }
             ],
         )
+
+    def get_ndjson_file(self, *uuids, **data):
+        with open(self.file) as f:
+            layer_data = json.load(f)
+        ndjson_file = NamedTemporaryFile("w", suffix=".json")
+        self.addCleanup(ndjson_file.close)
+        for uuid in uuids:
+            ndjson_file.write(json.dumps({**layer_data, **data, "uuid": uuid}))
+            ndjson_file.write("\n")
+        ndjson_file.flush()
+        return ndjson_file.name
+
+    def test_command_launch_ndjson(self):
+        file = self.get_ndjson_file(
+            "91c60192-9060-4bf6-b0de-818c5a362d89",
+            "91c60192-9060-4bf6-b0de-818c5a362d90",
+            "91c60192-9060-4bf6-b0de-818c5a362d91",
+        )
+        out = StringIO()
+        call_command(
+            "layer_load_dump", f"-file={file}", ndjson=True, batch_size=2, stdout=out
+        )
+
+        self.assertEqual(Layer.objects.count(), 3)
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            [
+                "2 layer(s) loaded, next offset is 2",
+                "3 layer(s) loaded, next offset is 3",
+            ],
+        )
+        self.scene.refresh_from_db()
+        self.assertEqual(len(self.scene.tree), 2)
+
+    def test_command_launch_ndjson_resume(self):
+        file = self.get_ndjson_file(
+            "91c60192-9060-4bf6-b0de-818c5a362d90",
+            "91c60192-9060-4bf6-b0de-818c5a362d91",
+            order="wrong",
+        )
+        with self.assertRaisesRegex(CommandError, "resume with --offset 1"):
+            call_command(
+                "layer_load_dump",
+                f"-file={file}",
+                ndjson=True,
+                batch_size=1,
+                offset=1,
+                stdout=StringIO(),
+            )
+        self.assertEqual(Layer.objects.count(), 1)
+
+    def test_command_launch_ndjson_resume_blank_lines(self):
+        with open(self.file) as f:
+            layer_data = json.load(f)
+        ndjson_file = NamedTemporaryFile("w", suffix=".json")
+        self.addCleanup(ndjson_file.close)
+        ndjson_file.write(
+            "\n".join(
+                [
+                    json.dumps(
+                        {**layer_data, "uuid": "91c60192-9060-4bf6-b0de-818c5a362d90"}
+                    ),
+                    "",
+                    json.dumps(
+                        {
+                            **layer_data,
+                            "uuid": "91c60192-9060-4bf6-b0de-818c5a362d91",
+                            "order": "wrong",
+                        }
+                    ),
+                ]
+            )
+        )
+        ndjson_file.flush()
+
+        # Offsets count lines of the file, blank ones included
+        with self.assertRaisesRegex(CommandError, "resume with --offset 2"):
+            call_command(
+                "layer_load_dump",
+                f"-file={ndjson_file.name}",
+                ndjson=True,
+                batch_size=1,
+                stdout=StringIO(),
+            )
+        self.assertTrue(
+            Layer.objects.filter(uuid="91c60192-9060-4bf6-b0de-818c5a362d90").exists()
+        )
+
+    def test_command_launch_ndjson_bulk(self):
+        file = self.get_ndjson_file(
+            "91c60192-9060-4bf6-b0de-818c5a362d89",
+            "91c60192-9060-4bf6-b0de-818c5a362d90",
+            "91c60192-9060-4bf6-b0de-818c5a362d91",
+        )
+        out = StringIO()
+        with mock.patch(
+            "terra_layer.models.Scene.sync_tree2models",
+            autospec=True,
+            side_effect=Scene.sync_tree2models,
+        ) as mocked_sync:
+            call_command(
+                "layer_load_dump",
+                f"-file={file}",
+                ndjson=True,
+                bulk=True,
+                batch_size=2,
+                stdout=out,
+            )
+            # Tree is built once for both new layers
+            mocked_sync.assert_called_once()
+
+        self.assertIn("3 layer(s) loaded, 1 scene tree(s) updated", out.getvalue())
+        self.scene.refresh_from_db()
+        self.assertEqual(len(self.scene.tree), 2)
+        self.assertEqual(Layer.objects.filter(group__view=self.scene).count(), 2)
+
+    def test_command_launch_ndjson_malformed(self):
+        with open(self.file) as f:
+            layer_data = json.load(f)
+        del layer_data["group"]
+        ndjson_file = NamedTemporaryFile("w", suffix=".json")
+        self.addCleanup(ndjson_file.close)
+        ndjson_file.write(json.dumps(layer_data) + "\n" + json.dumps(["layer"]))
+        ndjson_file.flush()
+
+        # Missing group, then not a layer
+        for offset in (0, 1):
+            with self.assertRaisesRegex(CommandError, f"resume with --offset {offset}"):
+                call_command(
+                    "layer_load_dump",
+                    f"-file={ndjson_file.name}",
+                    ndjson=True,
+                    batch_size=1,
+                    offset=offset,
+                    stdout=StringIO(),
+                )
+            with self.assertRaisesRegex(
+                CommandError, f"Layer of line {offset} not loaded"
+            ):
+                call_command(
+                    "layer_load_dump",
+                    f"-file={ndjson_file.name}",
+                    ndjson=True,
+                    bulk=True,
+                    batch_size=1,
+                    offset=offset,
+                    stdout=StringIO(),
+                )
+
+    def test_command_launch_bulk_without_ndjson(self):
+        with self.assertRaisesRegex(CommandError, "--bulk requires --ndjson"):
+            call_command("layer_load_dump", f"-file={self.file}", bulk=True)
+
+    def test_command_launch_ndjson_bulk_error(self):
+        file = self.get_ndjson_file(
+            "91c60192-9060-4bf6-b0de-818c5a362d90",
+            "91c60192-9060-4bf6-b0de-818c5a362d91",
+            order="wrong",
+        )
+        with self.assertRaisesRegex(CommandError, "Layer of line 0 not loaded"):
+            call_command(
+                "layer_load_dump",
+                f"-file={file}",
+                ndjson=True,
+                bulk=True,
+                stdout=StringIO(),
+            )
+        self.assertEqual(Layer.objects.count(), 1)
@@ -0,0 +1,86 @@
+from copy import deepcopy
+from io import StringIO
+
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from geostore.models import Feature
+
+from terra_layer.models import CustomStyle, Layer, LayerGroup
+from terra_layer.tests.factories import PostGISSourceFactory, SceneFactory
+from terra_layer.utils import get_layer_group_cache_key
+
+
+class RestyleLayersTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.scene = SceneFactory(name="test_scene")
+        self.source = PostGISSourceFactory(name="test_view")
+        geo_layer = self.source.get_layer()
+        for value in (1, 2):
+            Feature.objects.create(
+                layer=geo_layer,
+                geom=Point(-1.560408, 47.218658),
+                properties={"a": value},
+            )
+
+        self.style_config = {
+            "map_style_type": "circle",
+            "type": "wizard",
+            "style": {
+                "circle_color": {
+                    "type": "variable",
+                    "field": "a",
+                    "analysis": "graduated",
+                    "method": "equal_interval",
+                    "values": ["#aa0000", "#000000"],
+                    "generate_legend": True,
+                },
+            },
+        }
+        self.layers = [
+            Layer.objects.create(
+                name=f"layer_{index}",
+                source=self.source,
+                group=LayerGroup.objects.get(view=self.scene),
+                main_style=deepcopy(self.style_config),
+            )
+            for index in range(2)
+        ]
+        self.extra_style = CustomStyle.objects.create(
+            layer=self.layers[0], source=self.source, style_config=self.style_config
+        )
+        # Styles changed without generation
+        Layer.objects.update(main_style=self.style_config, legends=[])
+
+    def test_restyle_layers(self):
+        cache.set(get_layer_group_cache_key(self.scene), "cached")
+        out = StringIO()
+        call_command("restyle_layers", workers=1, stdout=out)
+
+        self.assertIn("[1/1] Source test_view: 2 layer(s) restyled", out.getvalue())
+        self.assertIn("2 layer(s) restyled in 1 scene(s)", out.getvalue())
+        # Main style and extra style legends
+        for layer, legend_count in zip(self.layers, (2, 1)):
+            layer.refresh_from_db()
+            self.assertIn("map_style", layer.main_style)
+            self.assertIn("fingerprint", layer.main_style)
+            self.assertEqual(len(layer.legends), legend_count)
+        self.extra_style.refresh_from_db()
+        self.assertIn("map_style", self.extra_style.style_config)
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
+
+        # Up to date styles are not counted as restyled
+        out = StringIO()
+        call_command("restyle_layers", workers=1, stdout=out)
+        self.assertIn("[1/1] Source test_view: 0 layer(s) restyled", out.getvalue())
+        self.assertIn("0 layer(s) restyled in 0 scene(s)", out.getvalue())
+
+    def test_restyle_layers_other_scene(self):
+        out = StringIO()
+        call_command("restyle_layers", scenes=["other"], workers=1, stdout=out)
+
+        self.assertIn("0 layer(s) restyled in 0 scene(s)", out.getvalue())
+        self.layers[0].refresh_from_db()
+        self.assertNotIn("map_style", self.layers[0].main_style)
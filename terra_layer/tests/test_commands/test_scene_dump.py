@@ -0,0 +1,97 @@
+import json
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django_geosource.models import Field
+
+from terra_layer.models import CustomStyle, FilterField, Layer, Scene
+from terra_layer.tests.factories import PostGISSourceFactory
+
+
+class SceneDumpTestCase(TestCase):
+    def setUp(self):
+        self.source = PostGISSourceFactory(name="test_view")
+        field = Field.objects.create(source=self.source, name="tutu")
+        self.layers = [
+            Layer.objects.create(source=self.source, name=f"layer_{index}")
+            for index in range(3)
+        ]
+        FilterField.objects.create(label="Test", field=field, layer=self.layers[0])
+        CustomStyle.objects.create(layer=self.layers[1], source=self.source)
+        self.scene = Scene.objects.create(
+            name="test_scene",
+            tree=[
+                {"geolayer": self.layers[0].pk, "label": "layer_0"},
+                {
+                    "group": True,
+                    "label": "group",
+                    "children": [{"geolayer": self.layers[1].pk, "label": "layer_1"}],
+                },
+            ],
+        )
+
+    def test_command_launch(self):
+        out = StringIO()
+        call_command("scene_dump", slug="test_scene", stdout=out)
+
+        dump = json.loads(out.getvalue())
+        self.assertEqual(dump["scene"]["slug"], "test_scene")
+        self.assertEqual(
+            dump["scene"]["tree"],
+            [
+                {"geolayer": str(self.layers[0].uuid), "label": "layer_0"},
+                {
+                    "group": True,
+                    "label": "group",
+                    "children": [
+                        {"geolayer": str(self.layers[1].uuid), "label": "layer_1"}
+                    ],
+                },
+            ],
+        )
+        layers = {layer["name"]: layer for layer in dump["layers"]}
+        self.assertEqual(set(layers), {"layer_0", "layer_1"})
+        self.assertEqual(layers["layer_0"]["fields"][0]["field"], "tutu")
+        self.assertEqual(layers["layer_1"]["extra_styles"][0]["source"], "test_view")
+        self.assertEqual(layers["layer_1"]["group"], "group")
+        self.assertEqual(layers["layer_1"]["view"], "test_scene")
+
+    def test_command_load(self):
+        dump = NamedTemporaryFile("w", suffix=".json")
+        self.addCleanup(dump.close)
+        call_command("scene_dump", slug="test_scene", stdout=dump)
+        dump.flush()
+
+        uuids = [layer.uuid for layer in self.layers[:2]]
+        Layer.objects.filter(pk=self.layers[0].pk).delete()
+        self.scene.delete()
+
+        out = StringIO()
+        with patch.object(
+            Layer, "update_styles", autospec=True, side_effect=Layer.update_styles
+        ) as mocked_update_styles:
+            call_command("scene_load_dump", f"-file={dump.name}", stdout=out)
+            # Styles are generated once for each layer after they are saved,
+            # sharing field statistics
+            self.assertEqual(mocked_update_styles.call_count, 2)
+            for _, kwargs in mocked_update_styles.call_args_list:
+                self.assertIsNotNone(kwargs.get("stats"))
+
+        self.assertIn("Scene test_scene: 2 layer(s) loaded", out.getvalue())
+
+        self.assertEqual(Layer.objects.count(), 3)
+        self.assertEqual(Layer.objects.filter(uuid__in=uuids).count(), 2)
+        scene = Scene.objects.get(slug="test_scene")
+        created_layer = Layer.objects.get(uuid=uuids[0])
+        self.assertEqual(created_layer.group.view, scene)
+        self.assertEqual(created_layer.fields_filters.get().field.name, "tutu")
+        self.assertEqual(Layer.objects.get(uuid=uuids[1]).group.label, "group")
+        self.assertEqual(scene.tree[0]["geolayer"], created_layer.pk)
+
+    def test_command_fail(self):
+        with self.assertRaisesRegexp(CommandError, "Scene does not exist"):
+            call_command("scene_dump", slug="missing")
@@ -0,0 +1,68 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django_geosource.models import Field, FieldTypes
+
+from terra_layer.management.commands.sync_wizard_indexes import (
+    get_existing_indexes,
+    get_index_name,
+)
+from terra_layer.models import Layer
+from terra_layer.tests.factories import PostGISSourceFactory
+
+
+class SyncWizardIndexesTestCase(TestCase):
+    def setUp(self):
+        self.source = PostGISSourceFactory(name="test")
+        Field.objects.create(
+            source=self.source, name="a", data_type=FieldTypes.Float.value
+        )
+        self.layer = Layer.objects.create(
+            source=self.source,
+            name="layer_test",
+            main_style={
+                "map_style_type": "circle",
+                "type": "wizard",
+                "style": {
+                    "circle_color": {
+                        "type": "variable",
+                        "field": "a",
+                        "analysis": "graduated",
+                        "method": "equal_interval",
+                        "values": ["#aa0000", "#000000"],
+                    },
+                },
+            },
+        )
+        self.index_name = get_index_name(self.source.get_layer().pk, "a")
+
+    def test_index_created_and_dropped(self):
+        out = StringIO()
+        call_command("sync_wizard_indexes", stdout=out)
+        self.assertIn(f"Create index {self.index_name}", out.getvalue())
+        self.assertIn(self.index_name, get_existing_indexes())
+
+        self.layer.main_style = {}
+        self.layer.save()
+
+        out = StringIO()
+        call_command("sync_wizard_indexes", stdout=out)
+        self.assertIn(f"Drop index {self.index_name}", out.getvalue())
+        self.assertNotIn(self.index_name, get_existing_indexes())
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command("sync_wizard_indexes", dry_run=True, stdout=out)
+        self.assertIn(f"Create index {self.index_name}", out.getvalue())
+        self.assertNotIn(self.index_name, get_existing_indexes())
+
+    def test_non_numeric_field_not_indexed(self):
+        Field.objects.filter(source=self.source, name="a").update(
+            data_type=FieldTypes.String.value
+        )
+
+        out = StringIO()
+        call_command("sync_wizard_indexes", stdout=out)
+        self.assertNotIn(f"Create index {self.index_name}", out.getvalue())
+        self.assertNotIn(self.index_name, get_existing_indexes())
@@ -1,3 +1,6 @@
+import json
+from io import StringIO
+from tempfile import NamedTemporaryFile
 from unittest.mock import patch
 
 from django.core.management import call_command
@@ -37,6 +40,56 @@ class UpdatePostgisSourceTestCase(TestCase):
         # no fields matchs file and no dry-run option
         mocked_replace_source.assert_called_with(self.new_source, {}, False)
 
+    def test_replace_source_of_many_layers(self, mocked_replace_source):
+        other_layer = Layer.objects.create(source=self.source, name="other_layer")
+        call_command(
+            "update_postgis_source",
+            self.layer.pk,
+            other_layer.pk,
+            self.new_source.name,
+            stdout=StringIO(),
+        )
+        self.assertEqual(mocked_replace_source.call_count, 2)
+
+    def test_replace_source_of_source_layers(self, mocked_replace_source):
+        Layer.objects.create(source=self.new_source, name="other_layer")
+        out = StringIO()
+        call_command(
+            "update_postgis_source",
+            self.new_source.name,
+            from_source=self.source.name,
+            stdout=out,
+        )
+        mocked_replace_source.assert_called_once_with(self.new_source, {}, False)
+        self.assertIn(f"Layer {self.layer.pk}: source replaced", out.getvalue())
+
+    def test_apply_plan(self, mocked_replace_source):
+        plan = self.layer.get_replace_source_plan(self.new_source)
+        plan_file = NamedTemporaryFile("w", suffix=".json")
+        self.addCleanup(plan_file.close)
+        json.dump([plan], plan_file)
+        plan_file.flush()
+
+        out = StringIO()
+        call_command(
+            "update_postgis_source",
+            self.new_source.name,
+            plan=plan_file.name,
+            stdout=out,
+        )
+        mocked_replace_source.assert_not_called()
+        self.layer.refresh_from_db()
+        self.assertEqual(self.layer.source, self.new_source)
+
+        # Plan is not applied again on the new source
+        call_command(
+            "update_postgis_source",
+            self.new_source.name,
+            plan=plan_file.name,
+            stdout=out,
+        )
+        self.assertIn("Plan does not apply", out.getvalue())
+
     def test_invalid_layer_does_not_call_replace_source_method(
         self, mocked_replace_source
     ):
@@ -0,0 +1,45 @@
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from terra_layer.models import Layer, LayerGroup
+from terra_layer.tests.factories import PostGISSourceFactory, SceneFactory
+from terra_layer.utils import get_layer_group_cache_key
+
+UserModel = get_user_model()
+
+
+class WarmLayersTreeCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.scene = SceneFactory(name="test_scene")
+        self.group = Group.objects.create(name="private")
+        user = UserModel.objects.create(**{UserModel.USERNAME_FIELD: "private_user"})
+        self.group.user_set.add(user)
+
+        source = PostGISSourceFactory(
+            name="test_view", settings={"groups": [self.group.pk]}
+        )
+        Layer.objects.create(
+            name="private_layer",
+            source=source,
+            group=LayerGroup.objects.get(view=self.scene),
+        )
+        self.group.authorized_layers.add(source.get_layer())
+
+    def test_warm_cache(self):
+        out = StringIO()
+        call_command("warm_layers_tree_cache", workers=1, stdout=out)
+
+        self.assertIn("Scene test_scene: layers tree cached", out.getvalue())
+        self.assertIsNotNone(cache.get(get_layer_group_cache_key(self.scene)))
+
+    def test_warm_cache_other_scene(self):
+        call_command(
+            "warm_layers_tree_cache", scenes=["other"], workers=1, stdout=StringIO()
+        )
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
@@ -1,22 +1,24 @@
-from django.test import TestCase
+import json
+from unittest.mock import patch
 
-from terra_layer.models import Layer
+from django.core.cache import cache
+from django.db import connection
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-from django_geosource.models import PostGISSource
+from terra_layer.models import CustomStyle, Layer, LayerGroup
+from terra_layer.tree_cache import _refresh_scene_cache_task
+from terra_layer.utils import get_layer_group_cache_key
 
-from .factories import SceneFactory, LayerFactory
+from django_geosource.models import Field
+
+from .factories import LayerFactory, PostGISSourceFactory, SceneFactory
 
 
 class LayerTestCase(TestCase):
     def test_str(self):
-        source = PostGISSource.objects.create(
-            name="test",
-            db_name="test",
-            db_password="test",
-            db_host="localhost",
-            geom_type=1,
-            refresh=-1,
-        )
+        source = PostGISSourceFactory(name="test")
         layer = Layer.objects.create(
             source=source,
             name="foo",
@@ -27,14 +29,7 @@ class LayerTestCase(TestCase):
     def test_scene_insert_in_tree(self):
         scene = SceneFactory()
 
-        source = PostGISSource.objects.create(
-            name="test",
-            db_name="test",
-            db_password="test",
-            db_host="localhost",
-            geom_type=1,
-            refresh=-1,
-        )
+        source = PostGISSourceFactory(name="test")
 
         # Initial value
         self.assertEqual(scene.tree, [])
@@ -146,3 +141,296 @@ class LayerTestCase(TestCase):
                 },
             ],
         )
+
+    def test_scene_tree2models(self):
+        source = PostGISSourceFactory(name="test")
+        layers = [LayerFactory(source=source) for x in range(4)]
+
+        scene = SceneFactory(
+            tree=[
+                {
+                    "group": True,
+                    "label": "level1",
+                    "exclusive": True,
+                    "children": [
+                        {"geolayer": layers[0].id},
+                        {
+                            "group": True,
+                            "label": "level2",
+                            "children": [{"geolayer": layers[1].id}],
+                        },
+                    ],
+                },
+                {"geolayer": layers[2].id},
+            ]
+        )
+
+        root = scene.layer_groups.get(parent=None)
+        level1 = scene.layer_groups.get(label="level1")
+        level2 = scene.layer_groups.get(label="level2")
+        self.assertEqual(level1.parent, root)
+        self.assertTrue(level1.exclusive)
+        self.assertEqual(level2.parent, level1)
+        self.assertEqual(level2.order, 1)
+
+        [layer.refresh_from_db() for layer in layers]
+        self.assertEqual((layers[0].group, layers[0].order), (level1, 0))
+        self.assertEqual((layers[1].group, layers[1].order), (level2, 0))
+        self.assertEqual((layers[2].group, layers[2].order), (root, 1))
+        self.assertIsNone(layers[3].group)
+
+    def test_scene_tree2models_queries(self):
+        source = PostGISSourceFactory(name="test")
+        scene = SceneFactory()
+
+        def count_queries(layer_count):
+            scene.tree = [
+                {
+                    "group": True,
+                    "label": f"group {x}",
+                    "children": [{"geolayer": LayerFactory(source=source).id}],
+                }
+                for x in range(layer_count)
+            ]
+            with CaptureQueriesContext(connection) as queries:
+                scene.tree2models()
+            return len(queries)
+
+        count_queries(2)  # Start from a tree of the same depth
+        self.assertEqual(count_queries(20), count_queries(2))
+
+    def test_scene_sync_tree2models(self):
+        source = PostGISSourceFactory(name="test")
+        layers = [LayerFactory(source=source) for x in range(3)]
+
+        scene = SceneFactory(
+            tree=[
+                {
+                    "group": True,
+                    "label": "group1",
+                    "children": [{"geolayer": layers[0].id}],
+                },
+                {
+                    "group": True,
+                    "label": "group2",
+                    "children": [
+                        {"geolayer": layers[1].id},
+                        {"geolayer": layers[2].id},
+                    ],
+                },
+            ]
+        )
+        groups = {group.label: group.pk for group in scene.layer_groups.all()}
+
+        # Move a layer to the first group, drop the second one
+        scene.tree = [
+            {
+                "group": True,
+                "label": "group1",
+                "exclusive": True,
+                "children": [
+                    {"geolayer": layers[2].id},
+                    {"geolayer": layers[0].id},
+                ],
+            },
+        ]
+        scene.save()
+
+        # Group ids are kept
+        self.assertEqual(
+            {group.label: group.pk for group in scene.layer_groups.all()},
+            {"Root": groups["Root"], "group1": groups["group1"]},
+        )
+        self.assertTrue(scene.layer_groups.get(label="group1").exclusive)
+
+        [layer.refresh_from_db() for layer in layers]
+        self.assertEqual((layers[0].group_id, layers[0].order), (groups["group1"], 1))
+        self.assertIsNone(layers[1].group)
+        self.assertEqual((layers[2].group_id, layers[2].order), (groups["group1"], 0))
+
+        # Nothing is written when tree is unchanged
+        with CaptureQueriesContext(connection) as queries:
+            scene.sync_tree2models()
+        self.assertFalse(
+            [
+                query
+                for query in queries
+                if query["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+            ]
+        )
+
+    def test_layer_replace_source(self):
+        sources = [PostGISSourceFactory(name=name) for name in ("old", "new")]
+        layer = Layer.objects.create(source=sources[0], name="foo")
+        for name in ("a", "b", "c"):
+            layer.fields_filters.create(
+                field=Field.objects.create(source=sources[0], name=name)
+            )
+        new_fields = {
+            name: Field.objects.create(source=sources[1], name=name)
+            for name in ("a", "b2", "d")
+        }
+
+        filter_fields = {
+            filter_field.field.name: filter_field.pk
+            for filter_field in layer.fields_filters.select_related("field")
+        }
+        plan = layer.replace_source(sources[1], {"b": "b2"}, dry_run=True)
+        self.assertEqual(layer.fields_filters.count(), 3)
+
+        plan = json.loads(json.dumps(plan))
+        self.assertEqual(plan["source"], {"old": sources[0].pk, "new": sources[1].pk})
+        self.assertEqual(
+            sorted(plan["remapped"], key=lambda remapped: remapped["old_field"]),
+            [
+                {
+                    "filter_field": filter_fields[old_name],
+                    "old_field": old_name,
+                    "new_field": new_name,
+                    "new_field_id": new_fields[new_name].pk,
+                }
+                for old_name, new_name in (("a", "a"), ("b", "b2"))
+            ],
+        )
+        self.assertEqual(
+            plan["deleted"], [{"filter_field": filter_fields["c"], "field": "c"}]
+        )
+        self.assertEqual(
+            plan["created"], [{"field": "d", "field_id": new_fields["d"].pk}]
+        )
+
+        # Plan is applied without being computed again
+        with patch.object(Layer, "get_replace_source_plan") as mocked_plan:
+            layer.apply_replace_source_plan(plan)
+            mocked_plan.assert_not_called()
+        with self.assertRaises(ValueError):
+            layer.apply_replace_source_plan(plan)
+
+        layer.refresh_from_db()
+        self.assertEqual(layer.source, sources[1])
+        self.assertEqual(
+            {filter_field.field for filter_field in layer.fields_filters.all()},
+            set(new_fields.values()),
+        )
+
+    def test_layer_replace_source_stale_plan(self):
+        sources = [PostGISSourceFactory(name=name) for name in ("old", "new")]
+        layer = Layer.objects.create(source=sources[0], name="foo")
+        for name in ("a", "b"):
+            layer.fields_filters.create(
+                field=Field.objects.create(source=sources[0], name=name)
+            )
+            Field.objects.create(source=sources[1], name=name)
+        plan = layer.get_replace_source_plan(sources[1])
+
+        # Fields of the new source removed since the plan
+        sources[1].fields.filter(name="b").delete()
+        with self.assertRaisesRegex(ValueError, "changed since the plan"):
+            layer.apply_replace_source_plan(plan)
+
+        # Filter fields of the layer changed since the plan
+        plan = layer.get_replace_source_plan(sources[1])
+        layer.fields_filters.create(
+            field=Field.objects.create(source=sources[0], name="c")
+        )
+        with self.assertRaisesRegex(ValueError, "changed since the plan"):
+            layer.apply_replace_source_plan(plan)
+
+        # New source differs from the planned one
+        plan = layer.get_replace_source_plan(sources[1])
+        with self.assertRaisesRegex(ValueError, "does not replace source"):
+            layer.apply_replace_source_plan(plan, PostGISSourceFactory(name="other"))
+
+        layer.refresh_from_db()
+        self.assertEqual(layer.source, sources[0])
+        self.assertEqual(layer.fields_filters.count(), 3)
+
+
+class SceneCacheInvalidationTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.scene = SceneFactory()
+        self.source = PostGISSourceFactory(name="test")
+        self.layer = Layer.objects.create(
+            source=self.source,
+            name="foo",
+            group=LayerGroup.objects.get(view=self.scene),
+        )
+        self.cache_key = get_layer_group_cache_key(self.scene)
+        cache.set(self.cache_key, "cached")
+
+    def test_source_change(self):
+        self.source.credit = "new credit"
+        self.source.save()
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
+
+    def test_extra_style_source_change(self):
+        sub_source = PostGISSourceFactory(name="sub")
+        CustomStyle.objects.create(layer=self.layer, source=sub_source)
+        self.cache_key = get_layer_group_cache_key(self.scene)
+        cache.set(self.cache_key, "cached")
+
+        sub_source.save()
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
+
+    def test_field_changes_collapsed(self):
+        with transaction.atomic():
+            for i in range(10):
+                Field.objects.create(source=self.source, name=f"field_{i}")
+            # Invalidated when the transaction is committed
+            self.assertEqual(cache.get(self.cache_key), "cached")
+
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
+
+    def test_other_scene_untouched(self):
+        other_source = PostGISSourceFactory(name="other")
+        other_source.save()
+        self.assertEqual(cache.get(get_layer_group_cache_key(self.scene)), "cached")
+
+    def test_scene_clear_layers_cache(self):
+        scene = SceneFactory()
+        keys = [
+            get_layer_group_cache_key(scene),
+            get_layer_group_cache_key(scene, ["rendered", "etag"]),
+        ]
+        cache.set_many({key: "cached" for key in keys})
+        other_scene_key = get_layer_group_cache_key(SceneFactory())
+        cache.set(other_scene_key, "cached")
+
+        with self.assertNumQueries(0):
+            scene.clear_layers_cache()
+
+        self.assertIsNone(cache.get(get_layer_group_cache_key(scene)))
+        self.assertIsNone(
+            cache.get(get_layer_group_cache_key(scene, ["rendered", "etag"]))
+        )
+        self.assertEqual(cache.get(other_scene_key), "cached")
+
+    def test_layer_change_in_transaction(self):
+        with transaction.atomic():
+            self.layer.name = "bar"
+            self.layer.save()
+            # Invalidated when the transaction is committed
+            self.assertEqual(cache.get(self.cache_key), "cached")
+
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
+
+    @override_settings(
+        GEOSOURCE_DELETE_LAYER_CALLBACK="django_geosource.geostore_callbacks.delete_layer"
+    )
+    def test_source_delete(self):
+        with transaction.atomic():
+            self.source.delete()
+            # Invalidated when the transaction is committed
+            self.assertEqual(cache.get(self.cache_key), "cached")
+
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
+
+    def test_background_refresh_failure(self):
+        with patch(
+            "terra_layer.tree_cache.refresh_scene_cache", side_effect=Exception
+        ), self.assertLogs("terra_layer.tree_cache", "ERROR"):
+            _refresh_scene_cache_task(self.scene.pk)
+
+        # Outdated tree is not served anymore
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
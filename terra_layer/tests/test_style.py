@@ -1,21 +1,43 @@
+import math
 import random
+import threading
+from collections import Counter
+from unittest.mock import patch
 
 from django.contrib.gis.geos import Point
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 
 from terra_layer.models import Layer, CustomStyle
 
 from django_geosource.models import PostGISSource
 from geostore.models import Feature
 
+from terra_layer.style import (
+    generate_style_from_wizard,
+    get_wizard_statistics_requests,
+)
+from terra_layer.style.jenks import discretize_fisher_jenks
+from terra_layer.style.statistics import StatisticsContext
+from terra_layer.style import statistics
 from terra_layer.style.utils import (
     trunc_scale,
+    discretize_approx_quantile,
+    discretize_head_tail,
+    discretize_quantile,
+    geometric_interval_boundaries,
+    head_tail_boundaries,
+    standard_deviation_boundaries,
+    get_field_statistics,
     get_min_max,
     round_scale,
     ceil_scale,
     circle_boundaries_candidate,
     circle_boundaries_filter_values,
 )
+from terra_layer.utils import get_layer_data_revision, invalidate_layer_data_revision
+
+from .factories import PostGISSourceFactory
 
 
 class StyleTestCase(TestCase):
@@ -64,6 +86,445 @@ class StyleTestCase(TestCase):
         geo_layer = self.source.get_layer()
         self.assertEqual(get_min_max(geo_layer, "a"), [False, None, None])
 
+    def test_get_field_statistics(self):
+        geo_layer = self.source.get_layer()
+        self._feature_factory(geo_layer, a=-1),
+        self._feature_factory(geo_layer, a=1),
+        self._feature_factory(geo_layer, a=2),
+        self._feature_factory(geo_layer, a=None),
+
+        statistics = get_field_statistics(geo_layer, "a")
+        self.assertAlmostEqual(float(statistics.pop("mean")), 2 / 3)
+        self.assertAlmostEqual(float(statistics.pop("stddev")), math.sqrt(14 / 9))
+        self.assertEqual(
+            statistics,
+            {
+                "is_null": True,
+                "count": 3,
+                "min": -1.0,
+                "max": 2.0,
+                "positive_min": 1.0,
+                "positive_max": 2.0,
+            },
+        )
+
+    def test_discretize_approx_quantile(self):
+        geo_layer = self.source.get_layer()
+        for a in range(10):
+            self._feature_factory(geo_layer, a=a)
+
+        # Exact quantiles when there are fewer values than the sample size
+        self.assertEqual(
+            discretize_approx_quantile(geo_layer, "a", 3),
+            discretize_quantile(geo_layer, "a", 3),
+        )
+
+        # Features of other layers are not sampled
+        other_geo_layer = PostGISSourceFactory(name="other").get_layer()
+        for a in range(100, 110):
+            self._feature_factory(other_geo_layer, a=a)
+
+        # Sampled without scanning the whole layer for statistics first
+        with patch(
+            "terra_layer.style.utils.get_field_statistics"
+        ) as mocked_statistics, patch(
+            "terra_layer.style.utils.estimate_feature_count", return_value=10
+        ):
+            boundaries = discretize_approx_quantile(geo_layer, "a", 3, sample_size=5)
+            mocked_statistics.assert_not_called()
+            # Same features are sampled again
+            self.assertEqual(
+                discretize_approx_quantile(geo_layer, "a", 3, sample_size=5),
+                boundaries,
+            )
+        self.assertEqual(boundaries[0], 0)
+        self.assertEqual(boundaries[-1], 9)
+        self.assertLessEqual(len(boundaries), 4)
+        self.assertEqual(boundaries, sorted(boundaries))
+
+        boundaries = discretize_approx_quantile(
+            geo_layer,
+            "a",
+            3,
+            statistics=get_field_statistics(geo_layer, "a"),
+            sample_size=5,
+        )
+        self.assertEqual([boundaries[0], boundaries[-1]], [0, 9])
+        self.assertEqual(boundaries, sorted(boundaries))
+
+    def test_discretize_fisher_jenks(self):
+        geo_layer = self.source.get_layer()
+        for a in [1, 2, 2, 3, 10, 11, 12, 20, 21, None]:
+            self._feature_factory(geo_layer, a=a)
+
+        self.assertEqual(
+            discretize_fisher_jenks(geo_layer, "a", 3), [1.0, 10.0, 20.0, 21.0]
+        )
+        # Merged values still give ordered boundaries within min and max
+        boundaries = discretize_fisher_jenks(geo_layer, "a", 3, max_values=3)
+        self.assertEqual(boundaries, sorted(boundaries))
+        self.assertEqual([boundaries[0], boundaries[-1]], [1.0, 21.0])
+
+        # Same features are sampled again
+        boundaries = discretize_fisher_jenks(geo_layer, "a", 3, sample_size=5)
+        self.assertEqual(boundaries, sorted(boundaries))
+        self.assertEqual([boundaries[0], boundaries[-1]], [1.0, 21.0])
+        self.assertEqual(
+            discretize_fisher_jenks(geo_layer, "a", 3, sample_size=5), boundaries
+        )
+
+    def test_discretize_fisher_jenks_no_value(self):
+        geo_layer = self.source.get_layer()
+        self.assertIsNone(discretize_fisher_jenks(geo_layer, "a", 3))
+
+        self._feature_factory(geo_layer, a=None)
+        self.assertEqual(discretize_fisher_jenks(geo_layer, "a", 3), [])
+
+    def test_standard_deviation_boundaries(self):
+        statistics = {"min": 0, "max": 10, "mean": 5, "stddev": 2}
+        self.assertEqual(standard_deviation_boundaries(statistics, 4), [0, 3, 5, 7, 10])
+        self.assertEqual(standard_deviation_boundaries(statistics, 3), [0, 4, 6, 10])
+        # Classes beyond min and max are dropped
+        self.assertEqual(
+            standard_deviation_boundaries({**statistics, "stddev": 4}, 4),
+            [0, 1, 5, 9, 10],
+        )
+        self.assertEqual(
+            standard_deviation_boundaries({**statistics, "stddev": 6}, 4),
+            [0, 5, 10],
+        )
+
+    def test_geometric_interval_boundaries(self):
+        boundaries = geometric_interval_boundaries(1, 1000, 3)
+        self.assertEqual(len(boundaries), 4)
+        for boundary, expected in zip(boundaries, [1, 10, 100, 1000]):
+            self.assertAlmostEqual(boundary, expected)
+
+        # Values are shifted when not strictly positive
+        boundaries = geometric_interval_boundaries(-1, 9, 2)
+        self.assertAlmostEqual(boundaries[1], 1 / math.sqrt(11) * 11 - 2)
+        self.assertEqual([boundaries[0], boundaries[-1]], [-1, 9])
+
+        self.assertIsNone(geometric_interval_boundaries(None, None, 2))
+
+    def test_head_tail_boundaries(self):
+        values = [1, 1, 1, 1, 2, 2, 3, 5, 8, 20, 50, 100]
+        histogram = sorted(Counter(values).items())
+        boundaries = head_tail_boundaries(histogram, 5)
+        self.assertEqual(boundaries[0], 1)
+        self.assertAlmostEqual(boundaries[1], 194 / 12)
+        self.assertAlmostEqual(boundaries[2], 170 / 3)
+        self.assertEqual(boundaries[3], 100)
+
+        self.assertEqual(len(head_tail_boundaries(histogram, 2)), 3)
+        # Not heavy-tailed
+        self.assertEqual(head_tail_boundaries([(i, 1) for i in range(10)], 5), [0, 9])
+
+    def test_discretize_head_tail(self):
+        geo_layer = self.source.get_layer()
+        self.assertIsNone(discretize_head_tail(geo_layer, "a", 3))
+
+        self._feature_factory(geo_layer, a=None)
+        self.assertEqual(discretize_head_tail(geo_layer, "a", 3), [])
+
+        values = [1, 1, 1, 1, 2, 2, 3, 5, 8, 20, 50, 100]
+        for a in values:
+            self._feature_factory(geo_layer, a=a)
+        self.assertEqual(len(discretize_head_tail(geo_layer, "a", 3)), 4)
+
+        # Same boundaries as from the whole histogram, read in a single query
+        histogram = sorted(Counter(values).items())
+        with self.assertNumQueries(1):
+            boundaries = discretize_head_tail(geo_layer, "a", 5)
+        expected = head_tail_boundaries(histogram, 5)
+        self.assertEqual(len(boundaries), len(expected))
+        for boundary, expected_boundary in zip(boundaries, expected):
+            self.assertAlmostEqual(boundary, expected_boundary)
+
+    def test_statistics_context_shared(self):
+        geo_layer = self.source.get_layer()
+        self._feature_factory(geo_layer, a=1),
+        self._feature_factory(geo_layer, a=2),
+
+        stats = StatisticsContext()
+        with patch(
+            "terra_layer.style.statistics.get_field_statistics",
+            wraps=get_field_statistics,
+        ) as mocked:
+            self.assertEqual(stats.get_min_max(geo_layer, "a"), [False, 1.0, 2.0])
+            self.assertEqual(
+                stats.get_positive_min_max(geo_layer, "a"), [False, 1.0, 2.0]
+            )
+            self.assertEqual(
+                stats.discretize(geo_layer, "a", "equal_interval", 2), [1, 1.5, 2]
+            )
+            mocked.assert_called_once()
+
+    def test_statistics_context_cache(self):
+        geo_layer = self.source.get_layer()
+        self._feature_factory(geo_layer, a=1),
+        self._feature_factory(geo_layer, a=2),
+
+        self.assertEqual(
+            StatisticsContext().get_min_max(geo_layer, "a"), [False, 1.0, 2.0]
+        )
+
+        # Unchanged data are read from cache
+        with patch(
+            "terra_layer.style.statistics.get_field_statistics"
+        ) as mocked_statistics:
+            self.assertEqual(
+                StatisticsContext().get_min_max(geo_layer, "a"), [False, 1.0, 2.0]
+            )
+            mocked_statistics.assert_not_called()
+
+        # Any feature change invalidates cache
+        self._feature_factory(geo_layer, a=3),
+        self.assertEqual(
+            StatisticsContext().get_min_max(geo_layer, "a"), [False, 1.0, 3.0]
+        )
+
+        geo_layer.features.get(properties__a=3).delete()
+        self.assertEqual(
+            StatisticsContext().get_min_max(geo_layer, "a"), [False, 1.0, 2.0]
+        )
+
+    def test_statistics_context_on_save(self):
+        geo_layer = self.source.get_layer()
+        self._feature_factory(geo_layer, a=1),
+        self._feature_factory(geo_layer, a=2),
+
+        self.layer.main_style = {
+            "map_style_type": "circle",
+            "type": "wizard",
+            "uid": "a48f4bd8-3715-4ea0-ae02-b1d827bcb599",
+            "style": {
+                "circle_radius": {
+                    "type": "variable",
+                    "field": "a",
+                    "analysis": "proportionnal",
+                    "max_radius": 200,
+                    "generate_legend": True,
+                },
+                "circle_color": {
+                    "type": "variable",
+                    "field": "a",
+                    "analysis": "graduated",
+                    "method": "quantile",
+                    "values": ["#aa0000", "#000000"],
+                    "generate_legend": True,
+                },
+            },
+        }
+        with patch(
+            "terra_layer.style.statistics.get_field_statistics",
+            wraps=get_field_statistics,
+        ) as mocked_statistics, patch(
+            "terra_layer.style.statistics.discretize_quantile"
+        ) as mocked_quantile:
+            mocked_quantile.return_value = [1, 2]
+            self.layer.save()
+            mocked_statistics.assert_called_once()
+            mocked_quantile.assert_called_once()
+
+    def test_wizard_style_not_regenerated_when_unchanged(self):
+        geo_layer = self.source.get_layer()
+        self._feature_factory(geo_layer, a=1),
+        self._feature_factory(geo_layer, a=2),
+
+        self.layer.main_style = {
+            "map_style_type": "circle",
+            "type": "wizard",
+            "uid": "a48f4bd8-3715-4ea0-ae02-b1d827bcb599",
+            "style": {
+                "circle_color": {
+                    "type": "variable",
+                    "field": "a",
+                    "analysis": "graduated",
+                    "method": "equal_interval",
+                    "values": ["#aa0000", "#000000"],
+                    "generate_legend": True,
+                },
+            },
+        }
+        self.layer.save()
+        legends = self.layer.legends
+        self.assertEqual(len(legends), 1)
+
+        with patch("terra_layer.models.generate_style_from_wizard") as mocked_generate:
+            self.layer.description = "new description"
+            self.layer.save()
+            mocked_generate.assert_not_called()
+        self.assertEqual(self.layer.legends, legends)
+
+        # Changing data changes the fingerprint
+        self._feature_factory(geo_layer, a=3),
+        with patch(
+            "terra_layer.models.generate_style_from_wizard",
+            wraps=generate_style_from_wizard,
+        ) as mocked_generate:
+            self.layer.save()
+            mocked_generate.assert_called_once()
+
+        # Bulk imports send no signal, their explicit invalidation changes the
+        # fingerprint too
+        map_style = self.layer.main_style["map_style"]
+        Feature.objects.bulk_create(
+            [
+                Feature(
+                    layer=geo_layer,
+                    geom=Point(-1.560408, 47.218658),
+                    properties={"a": 10},
+                )
+            ]
+        )
+        invalidate_layer_data_revision(geo_layer.pk)
+        with patch(
+            "terra_layer.models.generate_style_from_wizard",
+            wraps=generate_style_from_wizard,
+        ) as mocked_generate:
+            self.layer.save()
+            mocked_generate.assert_called_once()
+        self.assertNotEqual(self.layer.main_style["map_style"], map_style)
+
+    def test_layer_data_revision(self):
+        geo_layer = self.source.get_layer()
+        revision = get_layer_data_revision(geo_layer.pk)
+        self.assertEqual(get_layer_data_revision(geo_layer.pk), revision)
+
+        # Bulk imports send no signal, they are invalidated explicitly
+        Feature.objects.bulk_create(
+            [
+                Feature(
+                    layer=geo_layer, geom=Point(-1.560408, 47.218658), properties={}
+                )
+                for _ in range(2)
+            ]
+        )
+        self.assertEqual(get_layer_data_revision(geo_layer.pk), revision)
+        invalidate_layer_data_revision(geo_layer.pk)
+        bulk_revision = get_layer_data_revision(geo_layer.pk)
+        self.assertNotEqual(bulk_revision, revision)
+
+        # Test case transaction is never committed
+        Feature.objects.filter(layer=geo_layer).first().delete()
+        delete_revision = get_layer_data_revision(geo_layer.pk)
+        self.assertNotEqual(delete_revision, bulk_revision)
+        self.assertEqual(get_layer_data_revision(geo_layer.pk), delete_revision)
+
+        self._feature_factory(geo_layer, a=1)
+        self.assertNotEqual(get_layer_data_revision(geo_layer.pk), delete_revision)
+
+    def test_get_wizard_statistics_requests(self):
+        config = {
+            "map_style_type": "circle",
+            "type": "wizard",
+            "uid": "a48f4bd8-3715-4ea0-ae02-b1d827bcb599",
+            "style": {
+                "circle_radius": {
+                    "type": "variable",
+                    "field": "a",
+                    "analysis": "proportionnal",
+                    "max_radius": 200,
+                },
+                "circle_color": {
+                    "type": "variable",
+                    "field": "b",
+                    "analysis": "graduated",
+                    "method": "jenks",
+                    "values": ["#aa0000", "#000000"],
+                },
+                "circle_stroke_color": {"type": "fixed", "value": "#ffffff"},
+                "fill_color": {
+                    "type": "variable",
+                    "field": "c",
+                    "analysis": "graduated",
+                    "method": "quantile",
+                    "values": ["#aa0000", "#000000"],
+                },
+            },
+        }
+        self.assertEqual(
+            get_wizard_statistics_requests(config),
+            {("statistics", "a"), ("discretize", "b", "jenks", 2)},
+        )
+
+    def test_statistics_context_histogram_single_value(self):
+        geo_layer = self.source.get_layer()
+        self._feature_factory(geo_layer, a=1)
+        self._feature_factory(geo_layer, a=1)
+
+        stats = StatisticsContext(timeout=0)
+        stats.get_field_statistics(geo_layer, "a")
+        with patch("terra_layer.style.utils.get_field_statistics") as mocked:
+            histogram = stats.get_histogram(geo_layer, "a", 5)
+            # Count of shared statistics is reused
+            mocked.assert_not_called()
+        self.assertEqual(histogram, [{"lower": 1, "upper": 1, "count": 2}])
+
+    def test_wizard_approximated_quantile(self):
+        geo_layer = self.source.get_layer()
+        for a in range(10):
+            self._feature_factory(geo_layer, a=a)
+        config = {
+            "map_style_type": "circle",
+            "type": "wizard",
+            "uid": "a48f4bd8-3715-4ea0-ae02-b1d827bcb599",
+            "style": {
+                "circle_color": {
+                    "type": "variable",
+                    "field": "a",
+                    "analysis": "graduated",
+                    "method": "quantile",
+                    "values": ["#aa0000", "#000000"],
+                },
+            },
+        }
+
+        map_style, _ = generate_style_from_wizard(geo_layer, config)
+        self.assertNotIn("metadata", map_style)
+
+        with patch(
+            "terra_layer.style.statistics.DEFAULT_QUANTILE_SAMPLE_THRESHOLD", 5
+        ), patch(
+            "terra_layer.style.statistics.estimate_feature_count", return_value=10
+        ):
+            map_style, _ = generate_style_from_wizard(geo_layer, config)
+        # Effective method is recorded along with the style
+        self.assertEqual(
+            map_style["metadata"],
+            {"discretize_methods": {"circle_color": "approx_quantile"}},
+        )
+
+    def test_statistics_context_prefetch(self):
+        geo_layer = self.source.get_layer()
+        stats = StatisticsContext(timeout=0)
+
+        with patch(
+            "terra_layer.style.statistics.connection"
+        ) as mocked_connection, patch(
+            "terra_layer.style.statistics.discretize_quantile"
+        ) as mocked_quantile, patch(
+            "terra_layer.style.statistics.discretize_jenks"
+        ) as mocked_jenks:
+            # Threads don't share the test transaction
+            mocked_connection.in_atomic_block = False
+            mocked_quantile.return_value = [1, 2]
+            mocked_jenks.return_value = [1, 3]
+
+            stats.prefetch(
+                geo_layer,
+                [("discretize", "a", "quantile", 2), ("discretize", "a", "jenks", 2)],
+                workers=2,
+            )
+            mocked_quantile.assert_called_once()
+            mocked_jenks.assert_called_once()
+            self.assertEqual(mocked_connection.close.call_count, 2)
+
+            self.assertEqual(stats.discretize(geo_layer, "a", "quantile", 2), [1, 2])
+            self.assertEqual(stats.discretize(geo_layer, "a", "jenks", 2), [1, 3])
+            mocked_quantile.assert_called_once()
+
     def test_circle_boundaries_0(self):
         min = 0
         max = 1
@@ -3320,3 +3781,96 @@ class StyleTestCase(TestCase):
         self.layer.save(preserve_legend=True)
 
         self.assertEqual(len(self.layer.legends), 1)
+
+
+class StatisticsPrefetchTestCase(TransactionTestCase):
+    def setUp(self):
+        self.geo_layer = PostGISSourceFactory(name="test").get_layer()
+        for value in range(10):
+            Feature.objects.create(
+                layer=self.geo_layer,
+                geom=Point(-1.560408, 47.218658),
+                properties={"a": value},
+            )
+        self.requests = [
+            ("discretize", "a", "quantile", 3),
+            ("discretize", "a", "jenks", 3),
+        ]
+
+    def prefetch_threads(self, stats):
+        """Return the threads which discretized the requests"""
+        threads = set()
+
+        def discretize(function):
+            def wrapped(*args, **kwargs):
+                threads.add(threading.get_ident())
+                return function(*args, **kwargs)
+
+            return wrapped
+
+        with patch(
+            "terra_layer.style.statistics.discretize_quantile",
+            discretize(statistics.discretize_quantile),
+        ), patch(
+            "terra_layer.style.statistics.discretize_jenks",
+            discretize(statistics.discretize_jenks),
+        ):
+            stats.prefetch(self.geo_layer, self.requests, workers=2)
+            for request in self.requests:
+                stats.discretize(self.geo_layer, *request[1:])
+        return threads
+
+    def test_prefetch_in_transaction(self):
+        expected = [
+            StatisticsContext(timeout=0).discretize(self.geo_layer, *request[1:])
+            for request in self.requests
+        ]
+
+        with transaction.atomic():
+            stats = StatisticsContext(timeout=0)
+            threads = self.prefetch_threads(stats)
+
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(
+            [
+                stats.discretize(self.geo_layer, *request[1:])
+                for request in self.requests
+            ],
+            expected,
+        )
+
+    def test_prefetch_in_transaction_changing_features(self):
+        with transaction.atomic():
+            Feature.objects.create(
+                layer=self.geo_layer,
+                geom=Point(-1.560408, 47.218658),
+                properties={"a": 100},
+            )
+            stats = StatisticsContext(timeout=0)
+            threads = self.prefetch_threads(stats)
+
+            # Uncommitted features are only seen by the transaction connection
+            self.assertEqual(threads, {threading.get_ident()})
+            self.assertEqual(
+                stats.discretize(self.geo_layer, "a", "quantile", 3)[-1], 100
+            )
+
+    def test_layer_data_revision_in_transaction(self):
+        revision = get_layer_data_revision(self.geo_layer.pk)
+
+        with transaction.atomic():
+            self.geo_layer.features.first().delete()
+            self.assertNotEqual(get_layer_data_revision(self.geo_layer.pk), revision)
+            with transaction.atomic():
+                self.geo_layer.features.first().delete()
+                changed_revision = get_layer_data_revision(self.geo_layer.pk)
+                transaction.set_rollback(True)
+            # Rolled back savepoint leaves changes of unknown state
+            self.assertNotIn(
+                get_layer_data_revision(self.geo_layer.pk), (revision, changed_revision)
+            )
+            transaction.set_rollback(True)
+        self.assertEqual(get_layer_data_revision(self.geo_layer.pk), revision)
+
+        self.geo_layer.features.first().delete()
+        self.assertNotEqual(get_layer_data_revision(self.geo_layer.pk), revision)
@@ -1,5 +1,5 @@
 from django.test import TestCase
-from ..utils import dict_merge
+from ..utils import dict_merge, get_accepted_encoding
 
 
 class UtilsTestCase(TestCase):
@@ -18,3 +18,11 @@ class UtilsTestCase(TestCase):
             False,
         )
         self.assertEqual(merged, {"initialState": "test", "other": {"other": 2}})
+
+    def test_get_accepted_encoding(self):
+        self.assertEqual(
+            get_accepted_encoding("gzip, deflate, br", ["br", "gzip"]), "br"
+        )
+        self.assertEqual(get_accepted_encoding("gzip;q=0.5", ["br", "gzip"]), "gzip")
+        self.assertEqual(get_accepted_encoding("gzip;q=0", ["gzip"]), "identity")
+        self.assertEqual(get_accepted_encoding("", ["gzip"]), "identity")
@@ -1,25 +1,41 @@
+import gzip
 import io
 import json
+from datetime import timedelta
 from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from django_geosource.models import PostGISSource, Source, FieldTypes, WMTSSource
+from django.utils import timezone
+from django.contrib.gis.geos import Point
+from django_geosource.models import (
+    Field,
+    PostGISSource,
+    Source,
+    FieldTypes,
+    WMTSSource,
+)
+from geostore.models import Feature
 from rest_framework.status import (
     HTTP_200_OK,
     HTTP_201_CREATED,
     HTTP_204_NO_CONTENT,
+    HTTP_304_NOT_MODIFIED,
     HTTP_400_BAD_REQUEST,
     HTTP_404_NOT_FOUND,
     HTTP_403_FORBIDDEN,
 )
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 
 from terra_layer.models import Layer, LayerGroup, FilterField, CustomStyle
 from terra_layer.utils import get_layer_group_cache_key
+from terra_layer.views import LayerView
+from terra_layer.views.layers import TOKENS_PERIOD
 
 from .factories import SceneFactory
 
@@ -622,6 +638,97 @@ class ModelSourceViewsetTestCase(TestCase):
         response = self.client.delete(reverse("layer-detail", kwargs={"pk": layer.id}))
         self.assertEqual(response.status_code, HTTP_204_NO_CONTENT)
 
+    def test_histogram_preview(self):
+        Field.objects.create(
+            source=self.source, name="a", data_type=FieldTypes.Float.value
+        )
+        geo_layer = self.source.get_layer()
+        for a in [1, 2, 2, 3, 10, None]:
+            Feature.objects.create(
+                layer=geo_layer, geom=Point(0, 0), properties={"a": a}
+            )
+        response = self.client.get(
+            reverse("layer-histogram"),
+            {
+                "source": self.source.pk,
+                "field": "a",
+                "method": "equal_interval",
+                "class_count": 3,
+                "bins": 3,
+            },
+        )
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data["count"], 5)
+        self.assertEqual(data["boundaries"], [1, 4, 7, 10])
+        self.assertEqual(
+            [
+                (item["lower"], item["upper"], item["count"])
+                for item in data["histogram"]
+            ],
+            [(1, 4, 4), (4, 7, 0), (7, 10, 1)],
+        )
+
+    def test_histogram_preview_invalid(self):
+        response = self.client.get(
+            reverse("layer-histogram"),
+            {
+                "source": self.source.pk,
+                "field": "unknown",
+                "method": "quantile",
+                "class_count": 3,
+            },
+        )
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertIn("field", response.json())
+
+        Field.objects.create(source=self.source, name="a")
+        response = self.client.get(
+            reverse("layer-histogram"),
+            {
+                "source": self.source.pk,
+                "field": "a",
+                "method": "unknown",
+                "class_count": 3,
+            },
+        )
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertIn("method", response.json())
+
+        # Non numeric fields can't be analyzed
+        Field.objects.create(
+            source=self.source, name="b", data_type=FieldTypes.String.value
+        )
+        response = self.client.get(
+            reverse("layer-histogram"),
+            {
+                "source": self.source.pk,
+                "field": "b",
+                "method": "quantile",
+                "class_count": 3,
+            },
+        )
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertIn("field", response.json())
+
+    @patch("terra_layer.style.jenks.np", None)
+    def test_histogram_preview_unavailable_method(self):
+        Field.objects.create(
+            source=self.source, name="a", data_type=FieldTypes.Float.value
+        )
+        self.source.get_layer().features.create(geom=Point(0, 0), properties={"a": 1})
+        response = self.client.get(
+            reverse("layer-histogram"),
+            {
+                "source": self.source.pk,
+                "field": "a",
+                "method": "fisher_jenks",
+                "class_count": 3,
+            },
+        )
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertIn("method", response.json())
+
 
 class ModelSourceViewsetAnonymousTestCase(TestCase):
     def setUp(self):
@@ -738,6 +845,237 @@ class LayerViewTestCase(APITestCase):
         cls.scene = SceneFactory(name="test_scene")
         cls.layer_group = LayerGroup.objects.get(view=cls.scene)
 
+    def setUp(self):
+        # Cache invalidation is only run on commit, never inside test cases
+        cache.clear()
+
+    def test_cache_updated_with_query_parameter(self):
+        source = PostGISSource.objects.create(**self.source_params)
+        Layer.objects.create(name="public_layer", source=source, group=self.layer_group)
+
+        self.client.get(reverse("layerview", args=[self.scene.slug]))
+
+        cache_key = get_layer_group_cache_key(self.scene)
+        self.assertIsNotNone(cache.get(cache_key))
+
+        response = self.client.get(
+            reverse("layerview", args=[self.scene.slug]), {"cache": "false"}
+        )
+
+        self.assertEqual(response.status_code, HTTP_200_OK)
+
+    def test_layers_tree_queries(self):
+        source = PostGISSource.objects.create(**self.source_params)
+        tree = []
+        for x in range(5):
+            layer = Layer.objects.create(name=f"layer {x}", source=source)
+            CustomStyle.objects.create(layer=layer, source=source)
+            tree.append(
+                {
+                    "group": True,
+                    "label": f"group {x}",
+                    "children": [{"geolayer": layer.pk}],
+                }
+            )
+        scene = SceneFactory(name="queries_scene", tree=tree)
+
+        view = LayerView()
+        view.scene = scene
+        view.authorized_sources = {source.slug}
+
+        # groups, layers, shown filters, enabled filters, extra styles and their sources
+        with self.assertNumQueries(6):
+            layers_tree = view.get_layers_tree(scene)
+
+        self.assertEqual(
+            [group["group"] for group in layers_tree],
+            [f"group {x}" for x in range(5)],
+        )
+
+    def test_shared_response_queries(self):
+        def get_shared_response_queries(layer_count):
+            scene = SceneFactory(name=f"queries_scene_{layer_count}")
+            layer_group = LayerGroup.objects.get(view=scene)
+            for x in range(layer_count):
+                source = PostGISSource.objects.create(
+                    **{**self.source_params, "name": f"view_{layer_count}_{x}"}
+                )
+                sub_source = PostGISSource.objects.create(
+                    **{**self.source_params, "name": f"sub_view_{layer_count}_{x}"}
+                )
+                source.get_layer()
+                sub_source.get_layer()
+                layer = Layer.objects.create(
+                    name=f"layer {x}", source=source, group=layer_group
+                )
+                CustomStyle.objects.create(layer=layer, source=sub_source)
+
+            view = LayerView()
+            view.scene = scene
+            with patch.object(
+                Source, "get_layer", autospec=True, side_effect=Source.get_layer
+            ) as mocked_get_layer, CaptureQueriesContext(connection) as queries:
+                view.get_shared_response()
+            # Geostore layers are resolved through the callback once per source
+            self.assertEqual(mocked_get_layer.call_count, 2 * layer_count)
+            return len(
+                [query for query in queries if "geostore_layer" not in query["sql"]]
+            )
+
+        # Sources are fetched at once, whatever the tree size
+        self.assertEqual(get_shared_response_queries(2), get_shared_response_queries(5))
+
+    def test_layer_view_sources_with_extra_styles(self):
+        source = PostGISSource.objects.create(**self.source_params)
+        sub_source = PostGISSource.objects.create(
+            **{**self.source_params, "name": "test_sub_view"}
+        )
+        layer = Layer.objects.create(
+            name="public_layer", source=source, group=self.layer_group
+        )
+        CustomStyle.objects.create(layer=layer, source=sub_source)
+
+        response = self.client.get(reverse("layerview", args=[self.scene.slug]))
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        custom_style = response.json()["map"]["customStyle"]
+
+        self.assertEqual(
+            [
+                (map_layer["source-layer"], map_layer["source"])
+                for map_layer in custom_style["layers"]
+            ],
+            [("test_view", "terra_0"), ("test_sub_view", "terra_0_0")],
+        )
+        self.assertEqual(
+            [source["id"] for source in custom_style["sources"]],
+            ["terra_0_0", "terra_0"],
+        )
+
+    def test_layers_tree_shared_between_users(self):
+        group = Group.objects.create(name="private")
+        group.user_set.add(self.user)
+        public_source = PostGISSource.objects.create(**self.source_params)
+        private_source = PostGISSource.objects.create(
+            **{**self.source_params, "name": "test_private_view"},
+            settings={"groups": [group.pk]},
+        )
+        Layer.objects.create(
+            name="public_layer", source=public_source, group=self.layer_group
+        )
+        Layer.objects.create(
+            name="private_layer", source=private_source, group=self.layer_group
+        )
+        group.authorized_layers.add(private_source.get_layer())
+
+        response = self.client.get(reverse("layerview", args=[self.scene.slug]))
+        self.assertEqual(
+            [layer["label"] for layer in response.json()["layersTree"]],
+            ["public_layer"],
+        )
+        self.assertEqual(
+            [
+                map_layer["source-layer"]
+                for map_layer in response.json()["map"]["customStyle"]["layers"]
+            ],
+            ["test_view"],
+        )
+
+        # Authenticated users get their own layers from the same cached tree
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse("layerview", args=[self.scene.slug]))
+        self.assertEqual(
+            sorted(layer["label"] for layer in response.json()["layersTree"]),
+            ["private_layer", "public_layer"],
+        )
+        for source in response.json()["map"]["customStyle"]["sources"]:
+            self.assertIn("token=", source["url"])
+
+    def test_layer_view_conditional_requests_signed_in(self):
+        source = PostGISSource.objects.create(**self.source_params)
+        Layer.objects.create(name="public_layer", source=source, group=self.layer_group)
+        url = reverse("layerview", args=[self.scene.slug])
+        self.client.force_authenticate(self.user)
+        now = timezone.now()
+
+        with patch("terra_layer.views.layers.timezone.now", return_value=now):
+            response = self.client.get(url)
+            etag, last_modified = response["ETag"], response["Last-Modified"]
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, HTTP_304_NOT_MODIFIED)
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, HTTP_304_NOT_MODIFIED)
+
+        # Clients get new tokens before theirs expire
+        later = now + timedelta(seconds=TOKENS_PERIOD)
+        with patch("terra_layer.views.layers.timezone.now", return_value=later):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, HTTP_200_OK)
+            self.assertNotEqual(response["ETag"], etag)
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, HTTP_200_OK)
+
+    @patch("terra_layer.views.layers.CACHE_RENDERED_RESPONSE", True)
+    def test_layer_view_rendered_response(self):
+        source = PostGISSource.objects.create(**self.source_params)
+        Layer.objects.create(name="public_layer", source=source, group=self.layer_group)
+        url = reverse("layerview", args=[self.scene.slug])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        layers_tree = json.loads(response.content)["layersTree"]
+        self.assertEqual([layer["label"] for layer in layers_tree], ["public_layer"])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(
+            json.loads(gzip.decompress(response.content))["layersTree"], layers_tree
+        )
+
+    @patch("terra_layer.views.layers.CACHE_RENDERED_RESPONSE", True)
+    def test_layer_view_rendered_response_signed_in(self):
+        source = PostGISSource.objects.create(**self.source_params)
+        Layer.objects.create(name="public_layer", source=source, group=self.layer_group)
+        url = reverse("layerview", args=[self.scene.slug])
+        self.client.force_authenticate(self.user)
+
+        with patch(
+            "terra_layer.views.layers.timezone.now", return_value=timezone.now()
+        ), patch.object(
+            LayerView,
+            "render_response",
+            autospec=True,
+            side_effect=LayerView.render_response,
+        ) as mocked_render:
+            contents = [self.client.get(url).content for _ in range(2)]
+
+        # Rendered once, with the tiles token, for both requests
+        mocked_render.assert_called_once()
+        self.assertEqual(contents[0], contents[1])
+        for source in json.loads(contents[0])["map"]["customStyle"]["sources"]:
+            self.assertIn("token=", source["url"])
+
+
+class LayerViewCacheTestCase(APITransactionTestCase):
+    """Scenes cache is invalidated once changes are committed"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserModel.objects.create(
+            **{UserModel.USERNAME_FIELD: "private_user"}
+        )
+        self.source_params = {
+            "name": "test_view",
+            "db_name": "test",
+            "db_password": "test",
+            "db_host": "localhost",
+            "geom_type": 1,
+            "refresh": -1,
+        }
+        self.scene = SceneFactory(name="test_scene")
+        self.layer_group = LayerGroup.objects.get(view=self.scene)
+
     def test_cache_is_cleared_after_private_layer_update(self):
         group = Group.objects.create(name="private")
         group.user_set.add(self.user)
@@ -754,18 +1092,15 @@ class LayerViewTestCase(APITestCase):
         self.client.force_authenticate(self.user)
         self.client.get(reverse("layerview", args=[self.scene.slug]))
 
-        cache_key = get_layer_group_cache_key(
-            self.scene,
-            [
-                group.name,
-            ],
-        )
+        cache_key = get_layer_group_cache_key(self.scene)
         self.assertIsNotNone(cache.get(cache_key))
 
         # updating layer to trigger cache reset
         layer.name = "new_name"
         layer.save()
-        self.assertIsNone(cache.get(cache_key))
+        # Entries of the previous scene revision are no longer read
+        self.assertNotEqual(get_layer_group_cache_key(self.scene), cache_key)
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
 
     def test_cache_cleared_after_public_layer_update(self):
         source = PostGISSource.objects.create(**self.source_params)
@@ -781,19 +1116,42 @@ class LayerViewTestCase(APITestCase):
         # updating layer to trigger cache reset
         layer.name = "new_name"
         layer.save()
-        self.assertIsNone(cache.get(cache_key))
+        # Entries of the previous scene revision are no longer read
+        self.assertNotEqual(get_layer_group_cache_key(self.scene), cache_key)
+        self.assertIsNone(cache.get(get_layer_group_cache_key(self.scene)))
 
-    def test_cache_updated_with_query_parameter(self):
+    def test_layer_view_conditional_requests(self):
         source = PostGISSource.objects.create(**self.source_params)
-        Layer.objects.create(name="public_layer", source=source, group=self.layer_group)
-
-        self.client.get(reverse("layerview", args=[self.scene.slug]))
+        layer = Layer.objects.create(
+            name="public_layer", source=source, group=self.layer_group
+        )
+        url = reverse("layerview", args=[self.scene.slug])
+
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertTrue(response.has_header("Last-Modified"))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        # Scene layers are left unread
+        self.assertFalse(
+            [query for query in queries if "terra_layer_layer" in query["sql"]]
+        )
 
-        cache_key = get_layer_group_cache_key(self.scene)
-        self.assertIsNotNone(cache.get(cache_key))
+        # Rebuilding an unchanged tree keeps the same ETag
+        response = self.client.get(url, {"cache": "false"}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTP_304_NOT_MODIFIED)
 
-        response = self.client.get(
-            reverse("layerview", args=[self.scene.slug]), {"cache": "false"}
-        )
+        layer.name = "new_name"
+        layer.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
 
+        # Authenticated users get their own ETag
+        self.client.force_authenticate(self.user)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
         self.assertEqual(response.status_code, HTTP_200_OK)
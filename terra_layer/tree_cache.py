@@ -0,0 +1,143 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.http import Http404
+
+from .settings import CACHE_BACKGROUND_REFRESH, CACHE_REFRESH_WORKERS
+from .utils import invalidate_scene_cache_revision
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_pending_scenes = set()
+_pending_lock = threading.Lock()
+# Layers and sources changed in the current transaction of each thread
+_changes = threading.local()
+
+
+def get_scene_view(scene):
+    """Return a LayerView ready to render the scene"""
+    # Imported here as views depend on models, which schedule refreshes
+    from .views import LayerView
+
+    view = LayerView()
+    view.prepare(scene)
+    return view
+
+
+def refresh_scene_cache(scene):
+    """Rebuild and store the layers tree of a scene, shared by all users.
+
+    Return False if the scene has no layer to render.
+    """
+    try:
+        get_scene_view(scene).refresh_cache()
+    except Http404:
+        return False
+    return True
+
+
+def _refresh_scene_cache_task(scene_pk):
+    # Imported here as models import this module
+    from .models import Scene
+
+    with _pending_lock:
+        _pending_scenes.discard(scene_pk)
+
+    try:
+        refreshed = refresh_scene_cache(Scene.objects.get(pk=scene_pk))
+    except Scene.DoesNotExist:
+        refreshed = False
+    except Exception:
+        logger.exception(f"Layers tree refresh of scene {scene_pk} failed")
+        refreshed = False
+
+    try:
+        if not refreshed:
+            # Outdated tree must not be served anymore
+            invalidate_scene_cache_revision(scene_pk)
+    finally:
+        # Each worker thread owns its database connection
+        connection.close()
+
+
+def schedule_scene_cache_refresh(scene_pk):
+    """
+    Rebuild the layers tree of a scene in a background thread. The currently
+    cached tree is still served until the new one is stored.
+    Refreshes requested while one is already pending are collapsed.
+    """
+    global _executor
+
+    with _pending_lock:
+        if scene_pk in _pending_scenes:
+            return
+        _pending_scenes.add(scene_pk)
+
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS)
+
+    _executor.submit(_refresh_scene_cache_task, scene_pk)
+
+
+def clear_scene_cache(scene_pk):
+    """
+    Invalidate every cached entry of a scene at once, without any query, once
+    the current transaction is committed: a tree built by a concurrent request
+    before the commit would otherwise be cached as up to date.
+
+    With background refresh enabled, the cached tree is kept and rebuilt
+    instead.
+    """
+    if CACHE_BACKGROUND_REFRESH:
+        transaction.on_commit(partial(schedule_scene_cache_refresh, scene_pk))
+    else:
+        transaction.on_commit(partial(invalidate_scene_cache_revision, scene_pk))
+
+
+def get_layers_scenes(layer_pks=(), source_pks=()):
+    """Return pks of scenes using given layers, or layers built on given sources"""
+    # Imported here as models import this module
+    from .models import Layer
+
+    return set(
+        Layer.objects.filter(
+            Q(pk__in=layer_pks)
+            | Q(source__in=source_pks)
+            | Q(extra_styles__source__in=source_pks),
+            group__isnull=False,
+        )
+        .values_list("group__view_id", flat=True)
+        .distinct()
+    )
+
+
+def _clear_changes_scenes_cache():
+    layer_pks = getattr(_changes, "layers", set())
+    source_pks = getattr(_changes, "sources", set())
+    _changes.layers, _changes.sources = set(), set()
+
+    if layer_pks or source_pks:
+        for scene_pk in get_layers_scenes(layer_pks, source_pks):
+            clear_scene_cache(scene_pk)
+
+
+def clear_changes_scenes_cache_on_commit(layer_pks=(), source_pks=()):
+    """
+    Invalidate cache of scenes using given layers or sources once the current
+    transaction is committed. Changes of a whole transaction are collapsed,
+    so that affected scenes are looked up with a single query and
+    invalidated once.
+    """
+    if not hasattr(_changes, "layers"):
+        _changes.layers, _changes.sources = set(), set()
+    _changes.layers.update(layer_pks)
+    _changes.sources.update(source_pks)
+
+    # The first callback run handles changes of the whole transaction,
+    # the following ones have nothing left to do.
+    transaction.on_commit(_clear_changes_scenes_cache)
@@ -1,4 +1,23 @@
 import collections
+import gzip
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django_geosource.models import FieldTypes
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+# Source fields types whose values can be analyzed as numbers
+NUMERIC_FIELD_TYPES = (FieldTypes.Integer.value, FieldTypes.Float.value)
+
+# Geostore layers whose features changed in the current transaction of each
+# thread, with a token identifying their uncommitted state
+_changed_layers = threading.local()
 
 
 def dict_merge(dct, merge_dct, add_keys=True):
@@ -19,11 +38,154 @@ def dict_merge(dct, merge_dct, add_keys=True):
     return dct
 
 
-def get_layer_group_cache_key(scene, extras=[]):
+def get_layer_group_cache_key(scene, extras=[], revision=None):
     """
     :param scene: The scene to be cached
+    :param revision: The scene cache revision, fetched if not provided
     :return: The cache key
     :rtype: string
     """
+    if revision is None:
+        revision = get_scene_cache_revision(scene.pk)
     extras_joined = "-".join(extras)
-    return f"terra-layer-{scene.pk}-{extras_joined}"
+    return f"terra-layer-{scene.pk}-{revision}-{extras_joined}"
+
+
+def get_cache_revision(cache_key):
+    """
+    Return a token stored at cache_key, identifying the current state of some
+    cached data. A new token is issued each time the revision is invalidated.
+    """
+    revision = cache.get(cache_key)
+    if revision is None:
+        revision = uuid.uuid4().hex
+        if not cache.add(cache_key, revision, timeout=None):
+            # Another process issued the revision meanwhile
+            revision = cache.get(cache_key, revision)
+    return revision
+
+
+def get_scene_cache_revision_key(scene_pk):
+    """
+    :param scene_pk: Pk of the scene
+    :return: The cache key of the scene cache revision
+    :rtype: string
+    """
+    return f"terra-layer-scene-revision-{scene_pk}"
+
+
+def get_scene_cache_revision(scene_pk):
+    """
+    Return a token part of every cache key of the scene, so that they are all
+    invalidated at once by issuing a new one.
+    """
+    return get_cache_revision(get_scene_cache_revision_key(scene_pk))
+
+
+def invalidate_scene_cache_revision(scene_pk):
+    cache.delete(get_scene_cache_revision_key(scene_pk))
+
+
+def get_layer_data_revision_cache_key(geo_layer_id):
+    """
+    :param geo_layer_id: Pk of the geostore layer
+    :return: The cache key of the layer data revision
+    :rtype: string
+    """
+    return f"terra-layer-data-revision-{geo_layer_id}"
+
+
+def get_layer_data_revision(geo_layer_id):
+    """
+    Return a token identifying the current state of a geostore layer features.
+
+    A new token is issued when features are saved or deleted one by one, and
+    when the data of a source is refreshed. Bulk operations and raw SQL
+    writes send no signal: they must be followed by a call to
+    `invalidate_layer_data_revision`.
+
+    Features changed by the current transaction are only seen by it, so it
+    gets a revision of its own until they are committed.
+    """
+    revision = get_cache_revision(get_layer_data_revision_cache_key(geo_layer_id))
+    uncommitted = _get_uncommitted_layers_changes().get(geo_layer_id)
+    if uncommitted is not None:
+        revision = f"{revision}-{uncommitted}"
+    return revision
+
+
+def invalidate_layer_data_revision(geo_layer_id):
+    cache.delete(get_layer_data_revision_cache_key(geo_layer_id))
+
+
+def _get_uncommitted_layers_changes():
+    changes = getattr(_changed_layers, "changes", {})
+    commit_hooks = transaction.get_connection().run_on_commit
+    if changes and _changed_layers.commit_hooks is not commit_hooks:
+        # The transaction ended, or a savepoint was rolled back since the
+        # changes were recorded. Those still to be committed are given a new
+        # token, as their state is unknown.
+        if any(hook[1] is _commit_layers_changes for hook in commit_hooks):
+            changes = {pk: uuid.uuid4().hex for pk in changes}
+        else:
+            changes = {}
+        _changed_layers.changes = changes
+        _changed_layers.commit_hooks = commit_hooks
+    return changes
+
+
+def _commit_layers_changes():
+    changes = getattr(_changed_layers, "changes", {})
+    _changed_layers.changes = {}
+
+    for geo_layer_id in changes:
+        invalidate_layer_data_revision(geo_layer_id)
+
+
+def invalidate_layer_data_revision_on_commit(geo_layer_id):
+    """
+    Invalidate the data revision of a geostore layer once the current
+    transaction is committed. Changes of a whole transaction are collapsed,
+    so that each layer revision is invalidated once.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        invalidate_layer_data_revision(geo_layer_id)
+        return
+
+    changes = _get_uncommitted_layers_changes()
+    if not changes:
+        transaction.on_commit(_commit_layers_changes)
+        _changed_layers.commit_hooks = connection.run_on_commit
+    changes[geo_layer_id] = uuid.uuid4().hex
+    _changed_layers.changes = changes
+
+
+def compress_content(content, encoding):
+    """
+    :param content: bytes to compress
+    :param encoding: "gzip" or "br"
+    :return: The compressed content, None if the encoding is not available
+    """
+    if encoding == "gzip":
+        return gzip.compress(content)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(content)
+    return None
+
+
+def get_accepted_encoding(accept_encoding, encodings):
+    """
+    Return the first of available encodings accepted by the client, according
+    to its Accept-Encoding header, or "identity".
+    """
+    accepted = set()
+    for value in accept_encoding.split(","):
+        encoding, _, params = value.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(encoding.strip())
+
+    for encoding in encodings:
+        if encoding in accepted:
+            return encoding
+    return "identity"
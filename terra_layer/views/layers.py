@@ -1,19 +1,29 @@
+import json
 import tempfile
 from copy import deepcopy
+from hashlib import md5
 
 from django.core.management import call_command, get_commands
 from django.conf import settings
 from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Prefetch, Q
-from django.http import Http404, QueryDict
+from django.http import Http404, HttpResponse, QueryDict
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils.functional import cached_property
-from django.utils.http import urlunquote
-from django_geosource.models import WMTSSource, FieldTypes
+from django.utils.http import http_date, quote_etag, urlunquote
+from django_geosource.models import Source, WMTSSource, FieldTypes
+from geostore.models import Layer as GeoLayer, LayerGroup as GeoLayerGroup
 
 from geostore.tokens import tiles_token_generator
+from token_tools.settings import TOKEN_TIMEOUT
 
+from rest_framework.decorators import action
 from rest_framework.generics import get_object_or_404
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
@@ -22,17 +32,30 @@ from rest_framework.serializers import ValidationError
 from ..models import Layer, LayerGroup, FilterField, Scene
 from ..permissions import LayerPermission, ScenePermission
 from ..serializers import (
+    HistogramQuerySerializer,
     LayerListSerializer,
     LayerDetailSerializer,
     SceneListSerializer,
     SceneDetailSerializer,
 )
 from ..sources_serializers import SourceSerializer
-from ..utils import dict_merge, get_layer_group_cache_key
+from ..style.statistics import StatisticsContext
+from ..settings import CACHE_RENDERED_ENCODINGS, CACHE_RENDERED_RESPONSE
+from ..utils import (
+    compress_content,
+    dict_merge,
+    get_accepted_encoding,
+    get_layer_group_cache_key,
+    get_scene_cache_revision,
+)
 
 # Map source field data_type to format_type
 TYPE_MAP = {a: b.name.lower() for a, b in dict(FieldTypes.choices()).items()}
 
+# Duration during which responses with tiles tokens are reused, so that
+# reused tokens are at most half their lifetime old
+TOKENS_PERIOD = max(TOKEN_TIMEOUT // 2, 1)
+
 
 class SceneViewset(ModelViewSet):
     model = Scene
@@ -130,6 +153,37 @@ class LayerViewset(ModelViewSet):
             return LayerDetailSerializer
         return LayerListSerializer
 
+    @action(detail=False, methods=["get"])
+    def histogram(self, request):
+        """Preview class boundaries computed by a discretize method on a source
+        field, along with the histogram of its values, without saving any layer.
+        """
+        serializer = HistogramQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        query = serializer.validated_data
+
+        geo_layer = query["source"].get_layer()
+        field = query["field"]
+        stats = StatisticsContext()
+        statistics = stats.get_field_statistics(geo_layer, field)
+        try:
+            boundaries = stats.discretize(
+                geo_layer, field, query["method"], query["class_count"]
+            )
+        except ValueError as e:
+            # Method unavailable, as fisher_jenks without numpy
+            raise ValidationError({"method": str(e)})
+
+        return Response(
+            {
+                "count": statistics["count"],
+                "min": statistics["min"],
+                "max": statistics["max"],
+                "boundaries": boundaries,
+                "histogram": stats.get_histogram(geo_layer, field, query["bins"]),
+            }
+        )
+
     def perform_destroy(self, instance):
         if instance.group:  # Prevent deletion of layer used in any layer tree
             raise ValidationError("Can't delete a layer linked to a scene")
@@ -148,7 +202,7 @@ class LayerView(APIView):
     prefetch_layers = Prefetch(
         "layers",
         (
-            Layer.objects.select_related("source").prefetch_related(
+            Layer.objects.select_related("source", "main_field").prefetch_related(
                 Prefetch(
                     "fields_filters",
                     FilterField.objects.filter(shown=True).select_related("field"),
@@ -169,34 +223,73 @@ class LayerView(APIView):
     scene = None
 
     def get(self, request, slug=None, format=None):
-        update_cache = request.query_params.get("cache") == "false"
+        self.prepare(get_object_or_404(Scene, slug=slug))
 
-        self.scene = get_object_or_404(Scene, slug=slug)
-        self.layergroup = self.layers.first().source.get_layer().layer_groups.first()
+        if request.query_params.get("cache") == "false":
+            self.refresh_cache()
 
-        self.user_groups = tiles_token_generator.get_groups_intersect(
-            self.request.user, self.layergroup
+        etag = self.get_etag(self.shared_revision)
+        last_modified = max(
+            self.shared_revision["last_modified"], self.tokens_period or 0
         )
-
-        cache_key = get_layer_group_cache_key(
-            self.scene, self.user_groups.values_list("name", flat=True)
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
         )
+        if not_modified is not None:
+            not_modified["ETag"] = etag
+            return not_modified
 
-        if update_cache:
-            response = self.get_response_with_sources()
-            cache.set(cache_key, response)
+        if CACHE_RENDERED_RESPONSE:
+            response = self.get_rendered_response(etag)
         else:
-            response = cache.get_or_set(cache_key, self.get_response_with_sources)
+            response = Response(self.get_response_with_sources(self.shared_response))
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        return response
 
-        return Response(response)
+    def prepare(self, scene):
+        """Set the scene to render"""
+        self.scene = scene
 
-    def get_response_with_sources(self):
-        """Return a response object containing the full layersTree with updated
-        user authentication.
+    @cached_property
+    def layergroup_pk(self):
+        """Pk of the geostore layer group of the scene, read along with the
+        shared revision so that the ETag is computed without the scene layers.
         """
+        return self.shared_revision["layergroup"]
 
-        layer_structure = self.get_layer_structure()
+    @cached_property
+    def layergroup(self):
+        return GeoLayerGroup.objects.filter(pk=self.layergroup_pk).first()
+
+    @cached_property
+    def user_groups(self):
+        """Groups of the requesting user allowed to see some scene layers"""
+        return tiles_token_generator.get_groups_intersect(
+            self.request.user, self.layergroup_pk
+        )
+
+    @cached_property
+    def cache_key(self):
+        return get_layer_group_cache_key(self.scene, revision=self.scene_cache_revision)
+
+    @cached_property
+    def scene_cache_revision(self):
+        return get_scene_cache_revision(self.scene.pk)
+
+    @cached_property
+    def tokens_period(self):
+        """Start timestamp of the period during which the tiles tokens sent to
+        the user are reused, None for anonymous users who get no token.
+        """
+        if self.request.user.is_anonymous:
+            return None
+        now = int(timezone.now().timestamp())
+        return now - now % TOKENS_PERIOD
 
+    @cached_property
+    def tiles_querystring(self):
+        """Querystring authenticating the user on tiles endpoints"""
         querystring = QueryDict(mutable=True)
 
         # When the user is not anonymous, we provide tokens in the URL to authenticated
@@ -212,54 +305,231 @@ class LayerView(APIView):
                     ),
                 }
             )
+        return querystring.urlencode()
+
+    @cached_property
+    def revision_cache_key(self):
+        return get_layer_group_cache_key(
+            self.scene, ["revision"], revision=self.scene_cache_revision
+        )
+
+    @cached_property
+    def shared_response(self):
+        """Shared response of the scene, from cache when available"""
+        return cache.get_or_set(self.cache_key, self.get_shared_response)
+
+    @cached_property
+    def shared_revision(self):
+        """Revision of the shared response, cached apart from it so that it can
+        be checked without loading the whole tree.
+        """
+        revision = cache.get(self.revision_cache_key)
+        if revision is None:
+            revision = {
+                "revision": self.shared_response["revision"],
+                "last_modified": self.shared_response["last_modified"],
+                "layergroup": self.shared_response["layergroup"],
+            }
+            cache.set(self.revision_cache_key, revision)
+        return revision
+
+    def get_rendered_response(self, etag):
+        """Return the response rendered for the user, as cached JSON bytes,
+        compressed if the client accepts one of the cached encodings.
+        Responses with tiles tokens are shared by users of the same groups
+        until the end of the tokens period.
+        """
+        rendered = cache.get_or_set(
+            get_layer_group_cache_key(
+                self.scene,
+                ["rendered", etag.strip('"')],
+                revision=self.scene_cache_revision,
+            ),
+            self.render_response,
+            DEFAULT_TIMEOUT if self.tokens_period is None else TOKENS_PERIOD,
+        )
+        encoding = get_accepted_encoding(
+            self.request.META.get("HTTP_ACCEPT_ENCODING", ""),
+            [encoding for encoding in rendered if encoding != "identity"],
+        )
+
+        response = HttpResponse(rendered[encoding], content_type="application/json")
+        if encoding != "identity":
+            response["Content-Encoding"] = encoding
+        patch_vary_headers(response, ["Accept-Encoding"])
+        return response
+
+    def render_response(self):
+        """Return the JSON response of the user with its compressed variants"""
+        content = JSONRenderer().render(
+            self.get_response_with_sources(self.shared_response)
+        )
+        rendered = {"identity": content}
+        for encoding in CACHE_RENDERED_ENCODINGS:
+            compressed = compress_content(content, encoding)
+            if compressed is not None:
+                rendered[encoding] = compressed
+        return rendered
+
+    def get_etag(self, shared_revision):
+        """Return the ETag of the response sent to the user, from the shared
+        response revision and what makes it specific to the user: authorized
+        sources, groups and the period of tiles tokens, so that clients get
+        new tokens before theirs expire.
+        """
+        user_revision = "-".join(
+            [
+                shared_revision["revision"],
+                str(self.tokens_period),
+                *[
+                    str(pk)
+                    for pk in sorted(set(self.user_groups.values_list("pk", flat=True)))
+                ],
+                *sorted(self.authorized_sources),
+            ]
+        )
+        return quote_etag(md5(user_revision.encode("utf-8")).hexdigest())
+
+    def refresh_cache(self):
+        """Build the shared response and store it in cache"""
+        self.shared_response = self.get_shared_response()
+        self.shared_revision = {
+            "revision": self.shared_response["revision"],
+            "last_modified": self.shared_response["last_modified"],
+            "layergroup": self.shared_response["layergroup"],
+        }
+        cache.set_many(
+            {
+                self.cache_key: self.shared_response,
+                self.revision_cache_key: self.shared_revision,
+            }
+        )
+        return self.shared_response
+
+    def get_shared_response(self):
+        """Return the full layersTree of the scene, whatever the user is, along
+        with the sources used by each layer and map layer, so it can be
+        filtered for each user.
+        """
+
+        layer_structure = self.get_layer_structure()
+
+        # Index non-raster map layers by layer and source layer, to set their source "id"
+        map_layers_index = {}
+        for map_layer in layer_structure["map"]["customStyle"]["layers"]:
+            if map_layer.get("type", "") == "raster":
+                continue
+            map_layers_index.setdefault(
+                (map_layer["layerId"], map_layer["source-layer"]), []
+            ).append(map_layer)
 
         custom_style_infos = []
-        for i, layer in enumerate(self.layers.all()):
-            if layer.extra_styles.exists():
-                # Layer's extra styles have "sub sources" & "sub layers" we need to handle
-                for y, style in enumerate(layer.extra_styles.all()):
-                    sub_source = style.source
-                    sub_layer = sub_source.get_layer()
-                    subl_url = reverse("layer-tilejson", args=(sub_layer.id,))
-                    sub_source_id = f"{self.DEFAULT_SOURCE_NAME}_{i}_{y}"
-                    custom_style_infos.append((subl_url, sub_source_id))
-
-                    for map_layer in layer_structure["map"]["customStyle"]["layers"]:
-                        if (
-                            map_layer.get("type", "") == "raster"
-                            or map_layer["layerId"] != layer.id
-                        ):
-                            continue
-                        if map_layer["source-layer"] != sub_source.slug:
-                            continue
-                        map_layer["source"] = sub_source_id
-
-            geolayer = layer.source.get_layer()
+        layers_sources = {}
+        map_layers_sources = {}
+        for i, layer in enumerate(self.layers):
+            layers_sources[layer.id] = [layer.source.slug]
+            map_layers_sources[layer.layer_identifier] = layer.source.slug
+
+            # Layer's extra styles have "sub sources" & "sub layers" we need to handle
+            for y, style in enumerate(layer.extra_styles.all()):
+                sub_source = style.source
+                sub_layer = self.get_geo_layer(sub_source)
+                subl_url = reverse("layer-tilejson", args=(sub_layer.id,))
+                sub_source_id = f"{self.DEFAULT_SOURCE_NAME}_{i}_{y}"
+                custom_style_infos.append((subl_url, sub_source_id))
+                layers_sources[layer.id].append(sub_source.slug)
+                map_layers_sources[style.layer_identifier] = sub_source.slug
+
+                for map_layer in map_layers_index.get((layer.id, sub_source.slug), []):
+                    map_layer["source"] = sub_source_id
+
+            geolayer = self.get_geo_layer(layer.source)
             url = reverse("layer-tilejson", args=(geolayer.id,))
             source_id = f"{self.DEFAULT_SOURCE_NAME}_{i}"
             custom_style_infos.append((url, source_id))
 
             # Set the correct source "id" for each non-raster layer in the customStyle field
-            for map_layer in layer_structure["map"]["customStyle"]["layers"]:
-                if (
-                    map_layer.get("type", "") == "raster"
-                    or map_layer["layerId"] != layer.id
-                ):
-                    continue
-                if map_layer["source-layer"] != layer.source.slug:
-                    continue
+            for map_layer in map_layers_index.get((layer.id, layer.source.slug), []):
                 map_layer["source"] = source_id
 
         layer_structure["map"]["customStyle"]["sources"] = [
             {
                 "id": source_id,
                 "type": self.DEFAULT_SOURCE_TYPE,
-                "url": f"{url}?{querystring.urlencode()}",
+                "url": url,
             }
             for url, source_id in custom_style_infos
         ]
 
-        return layer_structure
+        return {
+            "response": layer_structure,
+            "layers_sources": layers_sources,
+            "map_layers_sources": map_layers_sources,
+            # Content hash, stable as long as the tree is unchanged
+            "revision": md5(
+                json.dumps(
+                    layer_structure, sort_keys=True, cls=DjangoJSONEncoder
+                ).encode("utf-8")
+            ).hexdigest(),
+            # Truncated to the second, as in Last-Modified header
+            "last_modified": int(timezone.now().timestamp()),
+            "layergroup": self.get_geo_layer(self.layers[0].source)
+            .layer_groups.values_list("pk", flat=True)
+            .first(),
+        }
+
+    def get_response_with_sources(self, shared_response=None):
+        """Return a response object containing the layersTree the user is
+        allowed to see, with updated user authentication.
+        """
+        shared_response = shared_response or self.get_shared_response()
+        layer_structure = shared_response["response"]
+
+        # Exclude layers with non-authorized sources, or with any non-authorized extra style
+        authorized_layers = {
+            layer_id
+            for layer_id, sources in shared_response["layers_sources"].items()
+            if all(source in self.authorized_sources for source in sources)
+        }
+        custom_style = layer_structure["map"]["customStyle"]
+
+        return {
+            **layer_structure,
+            "layersTree": self.filter_layers_tree(
+                layer_structure["layersTree"], authorized_layers
+            ),
+            "map": {
+                **layer_structure["map"],
+                "customStyle": {
+                    **custom_style,
+                    "sources": [
+                        {**source, "url": f"{source['url']}?{self.tiles_querystring}"}
+                        for source in custom_style["sources"]
+                    ],
+                    "layers": [
+                        map_layer
+                        for map_layer in custom_style["layers"]
+                        if shared_response["map_layers_sources"][map_layer["id"]]
+                        in self.authorized_sources
+                    ],
+                },
+            },
+        }
+
+    def filter_layers_tree(self, nodes, authorized_layers):
+        """Return a copy of tree nodes with only authorized layers and non-empty groups"""
+        filtered_nodes = []
+        for node in nodes:
+            if "group" in node:
+                group_layers = self.filter_layers_tree(
+                    node["layers"], authorized_layers
+                )
+                # exclude empty groups
+                if group_layers:
+                    filtered_nodes.append({**node, "layers": group_layers})
+            elif node["id"] in authorized_layers:
+                filtered_nodes.append(node)
+        return filtered_nodes
 
     def get_map_settings(self, scene):
         """Return the default map settings overridden with map settings from the scene if present"""
@@ -312,20 +582,22 @@ class LayerView(APIView):
     def get_map_layers(self):
         """Return sources informations using serializer from sources_serializers module"""
         map_layers = []
-        for layer in self.layers.filter(source__slug__in=self.authorized_sources):
+        for layer in self.layers:
             map_layers += [
                 dict(
-                    **SourceSerializer.get_object_serializer(layer).data,
+                    **SourceSerializer.get_object_serializer(
+                        layer, self.real_sources[layer.source_id]
+                    ).data,
                     layerId=layer.id,
                 ),
                 *[
                     dict(
-                        **SourceSerializer.get_object_serializer(cs).data,
+                        **SourceSerializer.get_object_serializer(
+                            cs, self.real_sources[cs.source_id]
+                        ).data,
                         layerId=layer.id,
                     )
-                    for cs in layer.extra_styles.filter(
-                        source__slug__in=self.authorized_sources
-                    )
+                    for cs in layer.extra_styles.all()
                 ],
             ]
         return map_layers
@@ -348,7 +620,7 @@ class LayerView(APIView):
                     "url": urlunquote(
                         reverse(
                             "feature-detail",
-                            args=(layer.source.get_layer().pk, "{{id}}"),
+                            args=(self.get_geo_layer(layer.source).pk, "{{id}}"),
                         )
                     ),
                     "id": "_id",
@@ -398,7 +670,7 @@ class LayerView(APIView):
                     "url": urlunquote(
                         reverse(
                             "feature-detail",
-                            args=(layer.source.get_layer().pk, "{{id}}"),
+                            args=(self.get_geo_layer(layer.source).pk, "{{id}}"),
                         )
                     ),
                     "id": "_id",
@@ -421,10 +693,27 @@ class LayerView(APIView):
         ]
 
     def get_layers_tree(self, scene):
-        """Return the full layer tree of a scene object"""
-        root_group = LayerGroup.objects.prefetch_related(self.prefetch_layers).get(
-            view=scene, parent=None
-        )
+        """Return the full layer tree of a scene object.
+
+        All groups and layers of the scene are fetched at once, then the tree
+        is assembled in memory.
+        """
+        root_group = None
+        self.groups_children = {}
+        for group in LayerGroup.objects.filter(view=scene):
+            if group.parent_id is None:
+                root_group = root_group or group
+            else:
+                self.groups_children.setdefault(group.parent_id, []).append(group)
+
+        self.groups_layers = {}
+        for layer in self.prefetch_layers.queryset.filter(
+            group__view=scene, in_tree=True
+        ):
+            self.groups_layers.setdefault(layer.group_id, []).append(layer)
+
+        if root_group is None:
+            return []
 
         # Keep only child of root group
         return self.get_group_dict(root_group)["layers"]
@@ -445,19 +734,15 @@ class LayerView(APIView):
         }
 
         # Add subgroups
-        for sub_group in group.children.filter(view=group.view).prefetch_related(
-            self.prefetch_layers
-        ):
+        for sub_group in self.groups_children.get(group.pk, []):
             group_dict = self.get_group_dict(sub_group)
             # exclude empty groups
             if group_dict["layers"]:
                 group_content["layers"].append(group_dict)
 
         # Add layers of group
-        for layer in group.layers.filter(in_tree=True):
-            layer_dict = self.get_layer_dict(layer)
-            if layer_dict:
-                group_content["layers"].append(layer_dict)
+        for layer in self.groups_layers.get(group.pk, []):
+            group_content["layers"].append(self.get_layer_dict(layer))
 
         # Group en layer ordering
         group_content["layers"].sort(key=lambda x: x["order"])
@@ -468,15 +753,6 @@ class LayerView(APIView):
         return group_content
 
     def get_layer_dict(self, layer):
-        if (
-            layer.source.slug not in self.authorized_sources
-            or layer.extra_styles.exclude(
-                source__slug__in=self.authorized_sources
-            ).exists()
-        ):
-            # Exclude layers with non-authorized sources
-            return None
-
         default_values = {
             "initialState": {
                 "active": layer.active_by_default,
@@ -550,21 +826,47 @@ class LayerView(APIView):
     def authorized_sources(self):
         """Cached property of authorized sources from the authenticated user's groups"""
         groups = self.user_groups
-        sources_slug = list(
-            self.layergroup.layers.filter(
-                Q(authorized_groups__isnull=True) | Q(authorized_groups__in=groups)
-            ).values_list("name", flat=True)
-        ) + list(WMTSSource.objects.values_list("slug", flat=True))
+        sources_slug = set(
+            GeoLayer.objects.filter(layer_groups=self.layergroup_pk)
+            .filter(Q(authorized_groups__isnull=True) | Q(authorized_groups__in=groups))
+            .values_list("name", flat=True)
+        ) | set(WMTSSource.objects.values_list("slug", flat=True))
 
         return sources_slug
 
+    @cached_property
+    def real_sources(self):
+        """Real instances of the sources of the scene layers and their extra
+        styles by pk, fetched with one query per source type.
+        """
+        source_ids = set()
+        for layer in self.layers:
+            source_ids.add(layer.source_id)
+            source_ids.update(cs.source_id for cs in layer.extra_styles.all())
+        return {
+            source.pk: source for source in Source.objects.filter(pk__in=source_ids)
+        }
+
+    @cached_property
+    def geo_layers(self):
+        """Geostore layers by source pk, resolved once per request"""
+        return {}
+
+    def get_geo_layer(self, source):
+        """Return the geostore layer of a source, resolved through the
+        geosource layer callback once per request
+        """
+        if source.pk not in self.geo_layers:
+            self.geo_layers[source.pk] = source.get_layer()
+        return self.geo_layers[source.pk]
+
     @cached_property
     def layers(self):
         """List of layers of the selected scene"""
         layers = (
             self.model.objects.filter(group__view=self.scene.pk)
             .order_by("order")
-            .select_related("source")
+            .select_related("source", "main_field")
             .prefetch_related("extra_styles__source")
         )
 